@@ -1,8 +1,19 @@
 import os
 import unittest
+import functools
 import vtk, qt, ctk, numpy, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+from TOFLib.RegistrationScheduler import RegistrationScheduler, defaultMaxConcurrent
+from TOFLib.TransformCache import TransformCache
+from TOFLib.PreAlignment import PreAligner
+from TOFLib.VolumeStatistics import statisticsCache
+from TOFLib import Kernels, Phantom
+from TOFLib.SceneIndex import sceneIndex
+from TOFLib.Instrumentation import Profiler
+from TOFLib.Projections import VIEWS, ProjectionCache, labelBounds
+from TOFLib.LongitudinalStack import LongitudinalStack
+from TOFLib.Worker import Cancelled, InterfaceLock, Progress, Worker
 
 # TOFDiff
 class TOFDiff(ScriptedLoadableModule):
@@ -28,6 +39,7 @@ class TOFDiffWidget(ScriptedLoadableModuleWidget):
 
         # Parameters Area
         parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.parametersCollapsibleButton = parametersCollapsibleButton
         parametersCollapsibleButton.text = "Parameters"
         self.layout.addWidget(parametersCollapsibleButton)
 
@@ -60,12 +72,56 @@ class TOFDiffWidget(ScriptedLoadableModuleWidget):
         self.ROISelector.setToolTip("Insira A ROI.")
         parametersFormLayout.addRow("ROI: ", self.ROISelector)
 
+        # Numero de registros simultaneos
+        self.concurrentSpinBox = qt.QSpinBox()
+        self.concurrentSpinBox.setMinimum(1)
+        self.concurrentSpinBox.setMaximum(16)
+        self.concurrentSpinBox.setValue(defaultMaxConcurrent())
+        self.concurrentSpinBox.setToolTip("Quantidade de registros BRAINSFit executados ao mesmo tempo.")
+        parametersFormLayout.addRow("Registros simultaneos: ", self.concurrentSpinBox)
+
+        # Reaproveitar registros ja calculados
+        self.transformCacheCheckBox = qt.QCheckBox()
+        self.transformCacheCheckBox.checked = True
+        self.transformCacheCheckBox.setToolTip("Reutiliza transformacoes salvas quando os volumes e parametros nao mudaram.")
+        parametersFormLayout.addRow("Cache de registro: ", self.transformCacheCheckBox)
+
+        # Pre-alinhamento por correlacao de fase
+        self.preAlignCheckBox = qt.QCheckBox()
+        self.preAlignCheckBox.checked = True
+        self.preAlignCheckBox.setToolTip("Estima a translacao entre os exames por FFT em volumes reduzidos e a usa como transformacao inicial do BRAINSFit.")
+        parametersFormLayout.addRow("Pre-alinhamento (FFT): ", self.preAlignCheckBox)
+
+        # MIPs limitadas a ROI
+        self.projectionROICheckBox = qt.QCheckBox()
+        self.projectionROICheckBox.checked = False
+        self.projectionROICheckBox.setToolTip("Calcula as MIPs apenas na caixa que envolve a ROI.")
+        parametersFormLayout.addRow("MIP apenas na ROI: ", self.projectionROICheckBox)
+
+        # Volume rendering do ultimo volume
+        self.volumeRenderingCheckBox = qt.QCheckBox()
+        self.volumeRenderingCheckBox.checked = True
+        self.volumeRenderingCheckBox.setToolTip("Cria o volume rendering (MIP) do ultimo volume de subtracao. Lento sem GPU.")
+        parametersFormLayout.addRow("Volume rendering: ", self.volumeRenderingCheckBox)
+
+        # Pilha 4D dos exames registrados
+        self.longitudinalCheckBox = qt.QCheckBox()
+        self.longitudinalCheckBox.checked = False
+        self.longitudinalCheckBox.setToolTip("Cria a tabela longitudinal e os volumes de maximo, maior variacao e inclinacao. Sem ROI empilha os volumes inteiros (memoria e tres volumes a mais na cena).")
+        parametersFormLayout.addRow("Estatisticas longitudinais: ", self.longitudinalCheckBox)
+
         # Apply Button
         self.applyButton = qt.QPushButton("Apply")
         self.applyButton.toolTip = "Run the algorithm."
         self.applyButton.enabled = False
         parametersFormLayout.addRow(self.applyButton)
 
+        # Cancel Button
+        self.cancelButton = qt.QPushButton("Cancelar")
+        self.cancelButton.toolTip = "Interrompe a execucao ao fim da etapa atual."
+        self.cancelButton.setVisible(False)
+        parametersFormLayout.addRow(self.cancelButton)
+
         # Progress Bar
         self.progressBar = qt.QProgressBar()
         self.progressBar.setMinimum(0)
@@ -73,13 +129,43 @@ class TOFDiffWidget(ScriptedLoadableModuleWidget):
         self.progressBar.setVisible(False)
         parametersFormLayout.addRow(self.progressBar)
 
+        # MIPs dos volumes de subtracao
+        projectionCollapsibleButton = ctk.ctkCollapsibleButton()
+        projectionCollapsibleButton.text = "MIP"
+        self.layout.addWidget(projectionCollapsibleButton)
+        projectionFormLayout = qt.QFormLayout(projectionCollapsibleButton)
+
+        self.viewComboBox = qt.QComboBox()
+        self.viewComboBox.addItems(VIEWS)
+        projectionFormLayout.addRow("Vista: ", self.viewComboBox)
+
+        self.timepointSlider = qt.QSlider(qt.Qt.Horizontal)
+        self.timepointSlider.setMinimum(0)
+        self.timepointSlider.setMaximum(0)
+        self.timepointSlider.setToolTip("Percorre os volumes de subtracao.")
+        projectionFormLayout.addRow("Exame: ", self.timepointSlider)
+
+        self.projectionNameLabel = qt.QLabel()
+        projectionFormLayout.addRow(self.projectionNameLabel)
+        self.projectionLabel = qt.QLabel()
+        self.projectionLabel.setAlignment(qt.Qt.AlignCenter)
+        projectionFormLayout.addRow(self.projectionLabel)
+        # QPixmaps ja carregados, por (id do volume, vista)
+        self.pixmaps = {}
+        self.projectionIDs = []
+        self.projectionCache = None
+        self.logic = None
+
         # Add vertical spacer
         self.layout.addStretch(1)
 
         # connections
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
         self.firstSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.ROISelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+        self.viewComboBox.connect("currentIndexChanged(int)", self.showProjection)
+        self.timepointSlider.connect("valueChanged(int)", self.showProjection)
 
         # Refresh Apply button state
         self.onSelect()
@@ -93,18 +179,104 @@ class TOFDiffWidget(ScriptedLoadableModuleWidget):
     def onApplyButton(self):
         self.applyButton.setText("Aguarde...")
         self.applyButton.setEnabled(False)
+        self.progressBar.setMaximum(0)
         self.progressBar.setVisible(True)
-        slicer.app.processEvents()
-
-        logic = TOFDiffLogic()
-        logic.run(self.firstSelector.currentNode(), self.ROISelector.currentNode())
-
-        self.applyButton.setText("Iniciar")
-        self.applyButton.setEnabled(True)
-        self.progressBar.setVisible(False)
+        self.cancelButton.setEnabled(True)
+        self.cancelButton.setVisible(True)
+        try:
+            slicer.app.processEvents()
+
+            logic = TOFDiffLogic()
+            logic.projectionROIOnly = self.projectionROICheckBox.checked
+            logic.volumeRendering = self.volumeRenderingCheckBox.checked
+            logic.longitudinalStatistics = self.longitudinalCheckBox.checked
+            logic.progress.callback = self.onProgress
+            self.logic = logic
+            with InterfaceLock(self.inputWidgets(), logic.progress):
+                if logic.run(self.firstSelector.currentNode(), self.ROISelector.currentNode(), self.concurrentSpinBox.value,
+                        self.transformCacheCheckBox.checked, self.preAlignCheckBox.checked):
+                    self.setProjections(logic.projectionCache)
+        finally:
+            # Tambem depois de uma excecao
+            self.logic = None
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+            self.progressBar.setVisible(False)
+            self.cancelButton.setVisible(False)
+
+    def inputWidgets(self):
+        "Widgets dos parametros travados durante a execucao (todos menos Cancelar e a barra de progresso)"
+        return [child for child in self.parametersCollapsibleButton.children()
+            if isinstance(child, qt.QWidget) and child not in (self.cancelButton, self.progressBar)]
+
+    def onCancelButton(self):
+        if self.logic:
+            self.cancelButton.setEnabled(False)
+            self.logic.progress.cancel()
+
+    def onProgress(self, done, total, text):
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+        if text:
+            self.progressBar.setFormat(text + ' (%v/%m)')
+
+    def setProjections(self, projectionCache):
+        "Mostra as MIPs da ultima execucao"
+        self.projectionCache = projectionCache
+        self.projectionIDs = list(projectionCache.entries.keys())
+        self.pixmaps = {}
+        self.timepointSlider.setMaximum(max(0, len(self.projectionIDs) - 1))
+        self.timepointSlider.setValue(len(self.projectionIDs) - 1)
+        self.showProjection()
+
+    def showProjection(self):
+        if not self.projectionIDs:
+            self.projectionNameLabel.setText("")
+            self.projectionLabel.clear()
+            return
+        volumeID = self.projectionIDs[self.timepointSlider.value]
+        view = self.viewComboBox.currentText
+        key = (volumeID, view)
+        if key not in self.pixmaps:
+            entry = self.projectionCache.entries[volumeID]
+            pixmap = qt.QPixmap(entry['paths'][view])
+            # Pixels nao isotropicos: corrige a altura pela proporcao do espacamento
+            height = int(round(pixmap.height() * entry['aspect'][view]))
+            self.pixmaps[key] = pixmap.scaled(pixmap.width(), height, qt.Qt.IgnoreAspectRatio, qt.Qt.SmoothTransformation)
+        self.projectionNameLabel.setText(self.projectionCache.entries[volumeID]['name'])
+        self.projectionLabel.setPixmap(self.pixmaps[key])
 
 # TOFDiffLogic
 class TOFDiffLogic(ScriptedLoadableModuleLogic):
+    # Subtracao: voxels por slab e threads (None = todos os nucleos)
+    subtractionSlabVoxels = Kernels.SLAB_VOXELS
+    subtractionThreads = None
+    # MIPs: apenas na caixa da ROI e/ou em um slab (k0, k1); volume rendering do ultimo volume
+    projectionROIOnly = False
+    projectionSlab = None
+    volumeRendering = True
+    # Pilha 4D dos exames registrados: estatisticas por exame e mapas de variacao
+    longitudinalStatistics = False
+    longitudinalPerc = 0.75
+
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        # Volumes de subtracao da ultima execucao, na ordem da cena
+        self.subtractVolumes = []
+        # VolumeStore opcional: volumes registrados e de subtracao em arquivos com memmap
+        self.volumeStore = None
+        # Tempo e memoria por etapa da ultima execucao
+        self.profiler = Profiler('TOFDiff')
+        # MIPs em PNG dos volumes de subtracao
+        self.projectionCache = ProjectionCache()
+        # Pilha 4D, tabela e volumes de variacao da ultima execucao
+        self.longitudinalStack = None
+        self.longitudinalTable = None
+        self.longitudinalVolumes = []
+        # Progresso e cancelamento; as contas do NumPy rodam na thread do worker
+        self.progress = Progress()
+        self.worker = Worker()
+
     def isValidInputOutputData(self, inputVolumeNode, outputVolumeNode):
         "Validates if the output is not the same as input"
         if not inputVolumeNode:
@@ -127,14 +299,10 @@ class TOFDiffLogic(ScriptedLoadableModuleLogic):
             slicer.util.errorDisplay('Mean: Input volume is the same as output volume. Choose a different output volume.')
             return False
 
-        stataccum = vtk.vtkImageAccumulate()
-        stataccum.SetInputConnection(ROIVolume.GetImageDataConnection())
-        stataccum.Update()
-        lo = int(stataccum.GetMin()[0])
-        hi = int(stataccum.GetMax()[0])
-        a = slicer.util.array(ROIVolume.GetName())
-        print a.max()
-        labelValue=a.max()
+        # Media pelo indice de voxels do label (em cache) quando os volumes tem a mesma grade
+        labelValue = statisticsCache().maximum(ROIVolume)
+        if ROIVolume.GetImageData().GetDimensions() == inputVolume.GetImageData().GetDimensions():
+            return statisticsCache().mean(inputVolume, ROIVolume, labelValue)
 
         # Create the binary volume of the label
         thresholder = vtk.vtkImageThreshold()
@@ -158,7 +326,25 @@ class TOFDiffLogic(ScriptedLoadableModuleLogic):
 
         return stat1.GetMean()[0]
 
-    def run(self, firstVolume, ROIVolume):
+    def projectionBounds(self, firstVolume, ROIVolume):
+        "Caixa das MIPs: a da ROI (se pedida e na mesma grade), limitada ao slab"
+        dimensions = firstVolume.GetImageData().GetDimensions()
+        bounds = None
+        if self.projectionROIOnly and ROIVolume:
+            if ROIVolume.GetImageData().GetDimensions() == dimensions:
+                bounds = labelBounds(slicer.util.arrayFromVolume(ROIVolume))
+            else:
+                logging.warning('ROI em outra grade, MIP no volume inteiro')
+        if self.projectionSlab:
+            k0, k1 = self.projectionSlab
+            if bounds:
+                (b0, b1), rows, columns = bounds
+                bounds = ((max(b0, k0), min(b1, k1)), rows, columns)
+            else:
+                bounds = ((k0, min(dimensions[2], k1)), (0, dimensions[1]), (0, dimensions[0]))
+        return bounds
+
+    def run(self, firstVolume, ROIVolume, maxConcurrentRegistrations=None, useTransformCache=True, preAlign=True):
         "Run the actual algorithm"
         if not firstVolume:
             logging.debug('Faltando primeiro volume.')
@@ -169,84 +355,188 @@ class TOFDiffLogic(ScriptedLoadableModuleLogic):
             slicer.util.errorDisplay('Primeiro volume e label sao iguais. Por favor corrija.')
             return False
 
+        self.progress.reset()
+        statisticsCache().runner = self.worker.call
+        try:
+            return self.process(firstVolume, ROIVolume, maxConcurrentRegistrations, useTransformCache, preAlign)
+        except Cancelled:
+            logging.info('Processamento cancelado')
+            self.profiler.publish()
+            return False
+        finally:
+            statisticsCache().runner = None
+            self.worker.close()
+
+    def process(self, firstVolume, ROIVolume, maxConcurrentRegistrations, useTransformCache, preAlign):
+        "Etapas de run(); o progresso e' informado por etapa e exame"
         logging.info('Processing started')
+        self.profiler.reset()
 
         # Buscando a media do primeiro Volume
-        if ROIVolume:
-            meanFirstVolume = self.mean(firstVolume, ROIVolume)
-        else:
-            a = slicer.util.array(firstVolume.GetName())
-            meanFirstVolume = a.mean()
+        self.progress.addSteps(1)
+        with self.profiler.stage('media', firstVolume.GetName()):
+            if ROIVolume:
+                meanFirstVolume = self.mean(firstVolume, ROIVolume)
+            else:
+                meanFirstVolume = statisticsCache().mean(firstVolume)
+        self.progress.step('media')
 
         print('Mean firstVolume: ', meanFirstVolume)
 
-        # Identificar todos os volumes e processar
-        for node in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
+        # Identificar todos os volumes e agendar o registro
+        transformCache = TransformCache() if useTransformCache else None
+        scheduler = RegistrationScheduler(maxConcurrentRegistrations, transformCache, PreAligner() if preAlign else None, self.progress)
+        subtractVolumes = []
+        registeredVolumes = []
+        for node in sceneIndex().scalarVolumes():
             logging.info('\nProcessando ' + node.GetName())
-            if node.GetName() == firstVolume.GetName():
+            if node.GetID() == firstVolume.GetID():
                 logging.info('Ignorando primeiro volume: ' + node.GetName())
                 continue
 
             if ROIVolume:
-                if node.GetName() == ROIVolume.GetName():
+                if node.GetID() == ROIVolume.GetID():
                     logging.info('Ignorando label map: ' + node.GetName())
                     continue
+            # Volumes Reg, de subtracao e longitudinais de execucoes anteriores
+            if sceneIndex().source(node):
+                logging.info('Ignorando volume derivado: ' + node.GetName())
+                continue
 
             # Executar BrainsFit para corresgistro dos exames mais novos com o mais antigo
-            fixedVolume = firstVolume
-            movingVolume = node
             registeredVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", node.GetName() + ' Reg')
-            logging.info('Registrando: ' + registeredVolume.GetName())
-            brainsfitParameters = {'fixedVolume': fixedVolume.GetID(), 'movingVolume': movingVolume.GetID(), 'outputVolume': registeredVolume.GetID(), 'useRigid': True}
-            self.cliNode = slicer.cli.run(slicer.modules.brainsfit, None, brainsfitParameters)
+            sceneIndex().link(node, registeredVolume, 'registered')
+            subtractVolumes.append(None)
+            registeredVolumes.append(registeredVolume)
+            # Registro, normalizacao e subtracao
+            self.progress.addSteps(3)
+            scheduler.addRegistration(firstVolume, node, registeredVolume,
+                functools.partial(self.processRegistered, firstVolume=firstVolume, ROIVolume=ROIVolume,
+                    meanFirstVolume=meanFirstVolume, subtractVolumes=subtractVolumes, index=len(subtractVolumes)-1))
+
+        self.progress.addSteps(2)
+        with self.profiler.stage('registros e processamento'):
+            scheduler.wait()
+        self.progress.check()
+
+        registeredVolumes = [volume for volume, subtractVolume in zip(registeredVolumes, subtractVolumes) if subtractVolume]
+        subtractVolumes = [volume for volume in subtractVolumes if volume]
+        self.subtractVolumes = subtractVolumes
+
+        if self.longitudinalStatistics and registeredVolumes:
+            with self.profiler.stage('pilha 4D'):
+                self.longitudinal(firstVolume, registeredVolumes, ROIVolume)
+        self.progress.step('pilha 4D')
+        self.progress.check()
+
+        # MIPs de todos os volumes de subtracao, na CPU
+        with self.profiler.stage('MIP'):
+            self.projectionCache.compute(subtractVolumes, self.projectionBounds(firstVolume, ROIVolume))
+        self.progress.step('MIP')
+
+        #Executar VolumeRendering c/ MIP no ultimo volume (ordem da cena)
+        if subtractVolumes and self.volumeRendering:
+            logic = slicer.modules.volumerendering.logic()
+            volumeNode = subtractVolumes[-1]
+            displayNode = logic.CreateVolumeRenderingDisplayNode()
+            slicer.mrmlScene.AddNode(displayNode)
+            displayNode.SetRaycastTechnique(2)
+            logic.UpdateDisplayNodeFromVolumeNode(displayNode, volumeNode)
+            displayNode.UnRegister(logic)
+            volumeNode.AddAndObserveDisplayNodeID(displayNode.GetID())
 
-            while (self.cliNode.IsBusy()):
-                slicer.app.processEvents()
+        logging.info('Processing completed')
+        self.profiler.publish()
 
-            # Normalizando o segundo volume
+        return True
+
+    def longitudinal(self, firstVolume, registeredVolumes, ROIVolume=None):
+        """Empilha o primeiro volume e os registrados (normalizados) em um array 4D.
+
+        Com a ROI na grade do primeiro volume a pilha e' recortada na caixa da
+        ROI e as medias usam apenas o label. Cria a tabela "TOFDiff
+        Longitudinal" (media, min-max, limiar e quantidade por exame) e os
+        volumes do maximo no tempo, da maior variacao entre exames
+        consecutivos e da inclinacao por exame.
+        """
+        bounds = None
+        mask = None
+        if ROIVolume and ROIVolume.GetImageData().GetDimensions() == firstVolume.GetImageData().GetDimensions():
+            roiArray = slicer.util.arrayFromVolume(ROIVolume)
+            bounds = labelBounds(roiArray)
+            if bounds:
+                region = tuple(slice(lo, hi) for lo, hi in bounds)
+                mask = roiArray[region] == statisticsCache().maximum(ROIVolume)
+        volumes = [firstVolume] + list(registeredVolumes)
+        stack = self.worker.call(LongitudinalStack.fromArrays, [slicer.util.arrayFromVolume(volume) for volume in volumes],
+            [volume.GetName() for volume in volumes], bounds)
+        self.longitudinalStack = stack
+
+        self.longitudinalTable = stack.toTable('TOFDiff Longitudinal', self.longitudinalPerc, mask)
+        self.longitudinalVolumes = []
+        maps = self.worker.call(lambda: [('Maximo no tempo', stack.maximum()), ('Maior variacao', stack.maximumChange()),
+            ('Inclinacao', stack.slope())])
+        for name, array in maps:
+            volumeNode = stack.toVolume(array, firstVolume.GetName() + ' ' + name, firstVolume)
+            sceneIndex().link(firstVolume, volumeNode, 'longitudinal')
+            self.longitudinalVolumes.append(volumeNode)
+        return stack
+
+    def processRegistered(self, job, firstVolume, ROIVolume, meanFirstVolume, subtractVolumes, index):
+        "Normaliza o volume registrado e calcula a subtracao com o primeiro volume"
+        timepoint = job.movingVolume.GetName()
+        if job.preAlignTime is not None:
+            self.profiler.record('pre-alinhamento', timepoint, job.preAlignTime)
+        self.profiler.record(job.stageName(), timepoint, job.elapsed())
+        self.progress.step('registro ' + timepoint)
+        if not job.succeeded:
+            self.progress.step('', 2)
+            return
+        self.progress.check()
+        registeredVolume = job.outputVolume
+        if self.volumeStore:
+            with self.profiler.stage('memmap', timepoint):
+                self.volumeStore.store(registeredVolume)
+
+        # Normalizando o segundo volume
+        with self.profiler.stage('normalizar', timepoint):
             normVolume = registeredVolume
             if ROIVolume:
                 meanRegisteredVolume = self.mean(normVolume, ROIVolume)
             else:
-                a = slicer.util.array(normVolume.GetName())
-                meanRegisteredVolume = a.mean()
+                meanRegisteredVolume = statisticsCache().mean(normVolume)
             factor = meanRegisteredVolume / meanFirstVolume
             print('Mean First, Mean RegVolume, Factor: ', meanFirstVolume, meanRegisteredVolume, factor)
             print('Normalizando: ', normVolume.GetName())
-            a = slicer.util.array(normVolume.GetName())
-            a[:] = a / factor
+            a = slicer.util.arrayFromVolume(normVolume)
+            # a[:] = a / factor em slabs; volumes inteiros por tabela de consulta
+            self.worker.call(Kernels.normalizeBlock, a, factor, roundFloats=False)
             normVolume.GetImageData().Modified()
-
-            #Subtracao manual para testes
-            volumeLogic = slicer.modules.volumes.logic()
-            subtractVolume = volumeLogic.CloneVolume(slicer.mrmlScene, normVolume, registeredVolume.GetName() + ' - ' + firstVolume.GetName())
-            a = slicer.util.array(firstVolume.GetName())
-            b = slicer.util.array(normVolume.GetName())
-            c = slicer.util.array(subtractVolume.GetName())
-            c[:]=0
-            c[:]=numpy.absolute(a-b)
-            # Aparando as "rebarbas da imagem"
-            c[a==0]=0
-            c[b==0]=0
+        self.progress.step('normalizar ' + timepoint)
+        self.progress.check()
+
+        #Subtracao manual para testes
+        with self.profiler.stage('subtracao', timepoint):
+            subtractName = registeredVolume.GetName() + ' - ' + firstVolume.GetName()
+            if self.volumeStore:
+                # Arquivo esparso, sem copiar o volume normalizado
+                subtractVolume = self.volumeStore.createVolume(subtractName, normVolume)
+            else:
+                volumeLogic = slicer.modules.volumes.logic()
+                subtractVolume = volumeLogic.CloneVolume(slicer.mrmlScene, normVolume, subtractName)
+            sceneIndex().link(job.movingVolume, subtractVolume, 'subtraction')
+            a = slicer.util.arrayFromVolume(firstVolume)
+            b = slicer.util.arrayFromVolume(normVolume)
+            c = slicer.util.arrayFromVolume(subtractVolume)
+            # |a-b| por slabs em paralelo, aparando as "rebarbas da imagem" (a==0 ou b==0)
+            self.worker.call(Kernels.absoluteDifference, a, b, c, self.subtractionSlabVoxels, self.subtractionThreads)
             subtractVolume.GetImageData().Modified()
+        subtractVolumes[index] = subtractVolume
+        self.progress.step('subtracao ' + timepoint)
 
-            # Exibir o resultado
-            for color in ['Red', 'Yellow', 'Green']:
-                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(subtractVolume.GetID())
-
-        #Executar VolumeRendering c/ MIP
-        logic = slicer.modules.volumerendering.logic()
-        volumeNode = subtractVolume
-        displayNode = logic.CreateVolumeRenderingDisplayNode()
-        slicer.mrmlScene.AddNode(displayNode)
-        displayNode.SetRaycastTechnique(2)
-        logic.UpdateDisplayNodeFromVolumeNode(displayNode, volumeNode)
-        displayNode.UnRegister(logic)
-        volumeNode.AddAndObserveDisplayNodeID(displayNode.GetID())
-
-        logging.info('Processing completed')
-
-        return True
+        # Exibir o resultado
+        for color in ['Red', 'Yellow', 'Green']:
+            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(subtractVolume.GetID())
 
 class TOFDiffTest(ScriptedLoadableModuleTest):
   """
@@ -265,8 +555,27 @@ class TOFDiffTest(ScriptedLoadableModuleTest):
     self.test_TOFDiff1()
 
   def test_TOFDiff1(self):
-    " Test "
+    " Subtracao entre dois exames de um phantom TOF sintetico (TOFLib.Phantom) "
 
     self.delayDisplay("Starting the test")
-    logging.info('test\n' % (name, url))
+    shape = (48, 96, 96)
+    base, followUp = Phantom.tofSeries(2, shape)
+    region = tuple(slice(k0, k1) for k0, k1 in Phantom.aneurysmBounds(shape, margin=3))
+    roi = numpy.zeros(shape, dtype=numpy.int16)
+    roi[region] = 1
+    baseVolume = slicer.util.addVolumeFromArray(base, name='base')
+    slicer.util.addVolumeFromArray(followUp, name='seguimento')
+    roiVolume = slicer.util.addVolumeFromArray(roi, name='roi-label', nodeClassName='vtkMRMLLabelMapVolumeNode')
+
+    logic = TOFDiffLogic()
+    logic.longitudinalStatistics = True
+    self.assertTrue(logic.run(baseVolume, roiVolume, 1, False))
+    self.assertEqual(len(logic.subtractVolumes), 1)
+
+    # O aneurisma cresceu no seguimento: a diferenca se concentra na ROI
+    difference = slicer.util.arrayFromVolume(logic.subtractVolumes[0])
+    logging.info('Diferenca media na ROI %f, no volume %f' % (difference[region].mean(), difference.mean()))
+    self.assertGreater(difference[region].mean(), difference.mean())
+    self.assertEqual(len(logic.projectionCache.entries), 1)
+    self.assertEqual(logic.longitudinalTable.GetNumberOfRows(), 2)
     self.delayDisplay('Test passed!')
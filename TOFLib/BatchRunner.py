@@ -0,0 +1,238 @@
+"""Processamento em lote, sem interface, de uma coorte de estudos TOF longitudinais.
+
+Estrutura esperada (exames ordenados pelo nome, o primeiro e' a base):
+
+    coorte/
+      paciente01/
+        01-base.nrrd          (ou uma pasta por exame contendo um volume)
+        02-seguimento.nrrd
+        aneurisma.fcsv        (fiducial para a ROI do TOFVol)
+        roi-label.nrrd        (opcional, ROI do TOFDiff; nomes com "label")
+
+Coorte, em Python comum ou no Slicer, com um processo Slicer por paciente:
+
+    python BatchRunner.py --cohort coorte --output coorte.csv --slicer /opt/Slicer/Slicer --jobs 4
+
+Um paciente, dentro do Slicer:
+
+    Slicer --no-main-window --python-script BatchRunner.py --patient coorte/paciente01 --output paciente01.csv
+
+Com --memmap PASTA os exames e os volumes intermediarios ficam em arquivos raw
+acessados por memmap (TOFLib.VolumeStore), uma subpasta por paciente; so' as
+partes lidas ocupam memoria e as cargas seguintes reaproveitam a conversao.
+
+A saida tem as linhas da "Export Table" do TOFVol (Volume, Qtde, Min-Max,
+Range) de todos os pacientes, em CSV ou Parquet (extensao .parquet, requer
+pandas). A coluna Status marca os pacientes sem resultado do TOFVol (sem
+fiducial) ou com falha, que tem uma linha sem exame na saida.
+"""
+import os
+import sys
+import csv
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing.pool
+
+VOLUME_EXTENSIONS = ('.nrrd', '.nhdr', '.nii', '.nii.gz', '.mha', '.mhd')
+MARKUPS_EXTENSIONS = ('.fcsv', '.mrk.json')
+TABLE_COLUMNS = ["Volume", "Qtde", "Min-Max", "Range"]
+STATUS_COLUMN = "Status"
+STATUS_OK = 'ok'
+STATUS_NO_FIDUCIAL = 'sem fiducial, TOFVol ignorado'
+STATUS_FAILED = 'falha'
+
+def hasExtension(path, extensions):
+    return path.lower().endswith(extensions)
+
+def findPatients(cohortDirectory):
+    return [os.path.join(cohortDirectory, name) for name in sorted(os.listdir(cohortDirectory))
+        if os.path.isdir(os.path.join(cohortDirectory, name))]
+
+def patientFiles(patientDirectory):
+    "Retorna (volumes dos exames em ordem, fiducial ou None, label da ROI ou None)"
+    timepoints = []
+    fiducialPath = None
+    labelPath = None
+    for name in sorted(os.listdir(patientDirectory)):
+        path = os.path.join(patientDirectory, name)
+        if os.path.isdir(path):
+            volumes = [os.path.join(path, n) for n in sorted(os.listdir(path)) if hasExtension(n, VOLUME_EXTENSIONS)]
+            if volumes:
+                timepoints.append(volumes[0])
+        elif hasExtension(name, MARKUPS_EXTENSIONS):
+            fiducialPath = path
+        elif hasExtension(name, VOLUME_EXTENSIONS):
+            if 'label' in name.lower():
+                labelPath = path
+            else:
+                timepoints.append(path)
+    return timepoints, fiducialPath, labelPath
+
+def readRows(path):
+    with open(path) as f:
+        return list(csv.reader(f))[1:]
+
+def writeRows(path, columns, rows):
+    if path.lower().endswith('.parquet'):
+        import pandas
+        pandas.DataFrame(rows, columns=columns).to_parquet(path)
+        return
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+# Paciente (dentro do Slicer)
+
+def loadTimepoints(paths, volumeStore=None):
+    import slicer
+    volumes = []
+    for path in paths:
+        if volumeStore:
+            volumes.append(volumeStore.loadVolume(path))
+            continue
+        success, node = slicer.util.loadVolume(path, {}, returnNode=True)
+        if not success:
+            raise IOError('Falha ao carregar ' + path)
+        volumes.append(node)
+    return volumes
+
+def processPatient(patientDirectory, outputPath, volumesDirectory=None, registrations=1, useTransformCache=True, memmapDirectory=None):
+    """Executa TOFVol e TOFDiff para um paciente e grava as linhas da tabela do TOFVol.
+
+    Sem fiducial grava uma unica linha sem exame com o status STATUS_NO_FIDUCIAL.
+    """
+    import slicer
+    from TOFVol import TOFVolLogic
+    from TOFDiff import TOFDiffLogic
+    from TOFLib.VolumeStore import VolumeStore
+
+    volumeStore = VolumeStore(memmapDirectory) if memmapDirectory else None
+
+    timepoints, fiducialPath, labelPath = patientFiles(patientDirectory)
+    if not timepoints:
+        raise IOError('Nenhum volume em ' + patientDirectory)
+
+    # TOFVol, que precisa do fiducial para criar a ROI
+    rows = []
+    if fiducialPath:
+        volumes = loadTimepoints(timepoints, volumeStore)
+        success, fiducialNode = slicer.util.loadMarkupsFiducialList(fiducialPath, returnNode=True)
+        if not success:
+            raise IOError('Falha ao carregar ' + fiducialPath)
+        logic = TOFVolLogic()
+        logic.volumeStore = volumeStore
+        table = logic.run(volumes[0], logic.createROI(fiducialNode, volumes[0]), registrations, useTransformCache)
+        rows = [row + [STATUS_OK] for row in logic.tableRows(table)]
+    else:
+        logging.warning('Sem fiducial, TOFVol ignorado: ' + patientDirectory)
+        rows = [[''] * len(TABLE_COLUMNS) + [STATUS_NO_FIDUCIAL]]
+
+    # TOFDiff em uma cena limpa, pois ele processa todos os volumes da cena.
+    # Com o cache de transformacoes os registros do TOFVol sao reaproveitados.
+    if len(timepoints) > 1:
+        slicer.mrmlScene.Clear(0)
+        volumes = loadTimepoints(timepoints, volumeStore)
+        ROIVolume = None
+        if labelPath:
+            success, ROIVolume = slicer.util.loadLabelVolume(labelPath, {}, returnNode=True)
+        logic = TOFDiffLogic()
+        logic.volumeStore = volumeStore
+        logic.run(volumes[0], ROIVolume, registrations, useTransformCache)
+        if volumesDirectory:
+            if not os.path.exists(volumesDirectory):
+                os.makedirs(volumesDirectory)
+            for subtractVolume in logic.subtractVolumes:
+                slicer.util.saveNode(subtractVolume, os.path.join(volumesDirectory, subtractVolume.GetName() + '.nrrd'))
+
+    writeRows(outputPath, TABLE_COLUMNS + [STATUS_COLUMN], rows)
+
+# Coorte (Python comum), um processo Slicer por paciente
+
+def runCohort(cohortDirectory, outputPath, slicerExecutable, jobs, volumesDirectory=None, registrations=1, useTransformCache=True, memmapDirectory=None):
+    """Processa todos os pacientes e grava a tabela da coorte.
+
+    Retorna (pacientes com falha, pacientes sem resultado do TOFVol); os dois
+    tambem aparecem na saida, com uma linha sem exame e o status.
+    """
+    patients = findPatients(cohortDirectory)
+    workDirectory = tempfile.mkdtemp(prefix='TOFBatch')
+
+    def runPatient(patientDirectory):
+        name = os.path.basename(patientDirectory)
+        patientOutput = os.path.join(workDirectory, name + '.csv')
+        command = [slicerExecutable, '--no-main-window', '--no-splash', '--python-script', os.path.abspath(__file__),
+            '--patient', patientDirectory, '--output', patientOutput, '--registrations', str(registrations)]
+        if volumesDirectory:
+            command += ['--volumes', os.path.join(volumesDirectory, name)]
+        if not useTransformCache:
+            command += ['--no-transform-cache']
+        if memmapDirectory:
+            command += ['--memmap', os.path.join(memmapDirectory, name)]
+        logPath = os.path.join(os.path.dirname(os.path.abspath(outputPath)), name + '.log')
+        with open(logPath, 'w') as log:
+            returnCode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+        if returnCode != 0 or not os.path.exists(patientOutput):
+            logging.error('Falha no paciente %s (codigo %d), ver %s' % (name, returnCode, logPath))
+            return name, None
+        logging.info('Paciente concluido: ' + name)
+        return name, readRows(patientOutput)
+
+    pool = multiprocessing.pool.ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(runPatient, patients)
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = []
+    failed = []
+    skipped = []
+    for name, patientRows in results:
+        if patientRows is None:
+            failed.append(name)
+            patientRows = [[''] * len(TABLE_COLUMNS) + [STATUS_FAILED]]
+        elif not any(row[-1] == STATUS_OK for row in patientRows):
+            skipped.append(name)
+        rows += [[name] + row for row in patientRows]
+    writeRows(outputPath, ["Paciente"] + TABLE_COLUMNS + [STATUS_COLUMN], rows)
+    shutil.rmtree(workDirectory, ignore_errors=True)
+    if skipped:
+        logging.warning('Pacientes sem resultado do TOFVol: ' + ', '.join(skipped))
+    if failed:
+        logging.error('Pacientes com falha: ' + ', '.join(failed))
+    return failed, skipped
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Processamento em lote TOFVol/TOFDiff')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--cohort', help='pasta com um subdiretorio por paciente')
+    mode.add_argument('--patient', help='pasta de um paciente (executar dentro do Slicer)')
+    parser.add_argument('--output', required=True, help='arquivo .csv ou .parquet')
+    parser.add_argument('--slicer', default=os.environ.get('SLICER_EXECUTABLE'), help='executavel do Slicer (modo coorte)')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count() // 2 or 1, help='pacientes em paralelo')
+    parser.add_argument('--registrations', type=int, default=1, help='registros simultaneos por paciente')
+    parser.add_argument('--volumes', help='pasta para salvar os volumes de subtracao do TOFDiff')
+    parser.add_argument('--no-transform-cache', dest='useTransformCache', action='store_false')
+    parser.add_argument('--memmap', help='pasta para os volumes em arquivos raw com memmap (menos memoria por paciente)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.patient:
+        try:
+            processPatient(args.patient, args.output, args.volumes, args.registrations, args.useTransformCache, args.memmap)
+        except Exception:
+            logging.exception('Falha ao processar ' + args.patient)
+            return 1
+        return 0
+
+    if not args.slicer:
+        parser.error('--slicer (ou SLICER_EXECUTABLE) e\' obrigatorio no modo coorte')
+    failed, skipped = runCohort(args.cohort, args.output, args.slicer, args.jobs, args.volumes, args.registrations, args.useTransformCache, args.memmap)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""Benchmarks das etapas numericas dos modulos TOF (nao precisa do Slicer).
+
+Uso:
+    python -m TOFLib.Benchmark [--shape K J I] [--repeat N] [--phantom K J I] [--suite kernels|pipeline|all]
+
+"kernels" compara as implementacoes originais com as atuais em um bloco
+recortado; "pipeline" mede tempo e pico de memoria de cada etapa do TOFVol e
+do TOFDiff sobre um phantom TOF sintetico (TOFLib.Phantom).
+"""
+import sys
+import time
+import argparse
+import numpy
+
+from TOFLib import Kernels, Phantom
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Implementacoes originais, usadas como referencia
+
+def legacyThresholdLabel(arrayNode, perc, labelArray, label):
+    "Sequencia de chamadas original do TOFVol"
+    min = arrayNode.min()
+    max = arrayNode.max()
+    minValue = max - ((max-min)*perc)
+    arrayValue = arrayNode[arrayNode>=minValue]
+    meanValue = arrayValue.mean()
+    countValue = len(arrayValue)
+    labelArray[arrayNode>minValue] = label
+    return min, max, minValue, countValue, meanValue
+
+def legacyNormalize(array, factor):
+    "Normalizacao original do TOFVol sobre o volume inteiro"
+    array[:] = array / factor
+    array[:] = numpy.around(array, 0)
+
+def legacySubtraction(a, b, c):
+    "Subtracao original do TOFDiff"
+    c[:]=0
+    c[:]=numpy.absolute(a-b)
+    c[a==0]=0
+    c[b==0]=0
+
+def vtkImage(array):
+    "vtkImageData que compartilha a memoria do array (k, j, i)"
+    import vtk
+    from vtk.util import numpy_support
+    image = vtk.vtkImageData()
+    image.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    scalars = numpy_support.numpy_to_vtk(array.ravel(), deep=False)
+    scalars._array = array
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+def legacyStencilMean(volumeImage, labelImage, labelValue):
+    "Pipeline VTK original de TOFDiffLogic.mean (threshold + stencil + accumulate)"
+    import vtk
+    thresholder = vtk.vtkImageThreshold()
+    thresholder.SetInputData(labelImage)
+    thresholder.SetInValue(1)
+    thresholder.SetOutValue(0)
+    thresholder.ReplaceOutOn()
+    thresholder.ThresholdBetween(labelValue,labelValue)
+    thresholder.SetOutputScalarType(volumeImage.GetScalarType())
+    thresholder.Update()
+    stencil = vtk.vtkImageToImageStencil()
+    stencil.SetInputConnection(thresholder.GetOutputPort())
+    stencil.ThresholdBetween(1, 1)
+    stat1 = vtk.vtkImageAccumulate()
+    stat1.SetInputData(volumeImage)
+    stencil.Update()
+    stat1.SetStencilData(stencil.GetOutput())
+    stat1.Update()
+    return stat1.GetMean()[0]
+
+# Dados de teste
+
+def croppedBlock(shape, seed=0):
+    "Bloco int16 com ruido de fundo e um tubo brilhante, parecido com um recorte TOF"
+    random = numpy.random.RandomState(seed)
+    block = random.normal(100, 25, shape).clip(0, None).astype(numpy.int16)
+    k, j, i = numpy.ogrid[:shape[0], :shape[1], :shape[2]]
+    tube = (j - shape[1] // 2) ** 2 + (i - shape[2] // 2) ** 2 <= (min(shape[1:]) // 10) ** 2
+    block[numpy.broadcast_to(tube, shape)] += 400
+    return block
+
+# Medicao
+
+def bestTime(function, repeat, setup=None):
+    "Menor tempo de function(); com setup, function(setup()) e o setup fica fora da medida"
+    best = None
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def benchmarkThresholdLabel(shape, repeat):
+    block = croppedBlock(shape)
+    legacyLabel = numpy.zeros(shape, dtype=numpy.int16)
+    fusedLabel = numpy.zeros(shape, dtype=numpy.int16)
+    legacy = legacyThresholdLabel(block, 0.75, legacyLabel, 1)
+    fused = Kernels.thresholdLabel(block, 0.75, fusedLabel, 1)
+    assert legacy[3] == fused[3] and abs(legacy[4] - fused[4]) < 1e-6
+    return [
+        ('original', bestTime(lambda: legacyThresholdLabel(block, 0.75, legacyLabel, 1), repeat)),
+        ('fundido', bestTime(lambda: Kernels.thresholdLabel(block, 0.75, fusedLabel, 1), repeat)),
+        ]
+
+def benchmarkNormalize(shape, repeat):
+    # Volume registrado completo (float32, como a saida do BRAINSFit) com a ROI no centro
+    full = (shape[0] * 2, shape[1] * 2, shape[2] * 2)
+    volume = croppedBlock(full).astype(numpy.float32)
+    bounds = tuple((d // 2 - s // 2, d // 2 - s // 2 + s) for d, s in zip(full, shape))
+    return [
+        ('volume todo', bestTime(lambda: legacyNormalize(volume, 1.01), repeat)),
+        ('slabs', bestTime(lambda: Kernels.normalizeBlock(volume, 1.01), repeat)),
+        ('apenas ROI', bestTime(lambda: Kernels.normalizeBlock(volume, 1.01, bounds), repeat)),
+        ]
+
+def legacyIntegerNormalize(array, factor):
+    "Normalizacao original do TOFDiff (e do TOFVol, para volumes inteiros)"
+    array[:] = array / factor
+
+def benchmarkIntegerNormalize(shape, repeat):
+    # Volume int16 (exames com outputVolumePixelType inteiro ou lidos do disco)
+    volume = croppedBlock(shape)
+    legacy = volume.copy()
+    table = volume.copy()
+    legacyIntegerNormalize(legacy, 1.07)
+    Kernels.normalizeInteger(table, 1.07)
+    assert numpy.array_equal(legacy, table)
+    return [
+        ('original', bestTime(lambda: legacyIntegerNormalize(volume.copy(), 1.07), repeat)),
+        ('tabela', bestTime(lambda: Kernels.normalizeInteger(volume.copy(), 1.07), repeat)),
+        ]
+
+def benchmarkSubtraction(shape, repeat):
+    # Primeiro volume int16 e volume registrado float32, como no TOFDiff
+    a = croppedBlock(shape)
+    b = croppedBlock(shape, seed=1).astype(numpy.float32)
+    legacy = numpy.empty_like(b)
+    c = numpy.empty_like(b)
+    legacySubtraction(a, b, legacy)
+    Kernels.absoluteDifference(a, b, c)
+    assert numpy.array_equal(legacy, c)
+    return [
+        ('original', bestTime(lambda: legacySubtraction(a, b, legacy), repeat)),
+        ('slabs', bestTime(lambda: Kernels.absoluteDifference(a, b, c, threads=1), repeat)),
+        ('slabs+threads', bestTime(lambda: Kernels.absoluteDifference(a, b, c), repeat)),
+        ]
+
+def benchmarkMaskedMean(shape, repeat, timepoints=8):
+    # Uma ROI fixa (label map) e a media em cada um dos N volumes registrados
+    volumes = [croppedBlock(shape, seed) for seed in range(timepoints)]
+    label = numpy.zeros(shape, dtype=numpy.int16)
+    label[shape[0]//4:3*shape[0]//4, shape[1]//4:3*shape[1]//4, shape[2]//4:3*shape[2]//4] = 1
+    labelValue = label.max()
+
+    def maskedMeans():
+        return [volume[label == labelValue].mean() for volume in volumes]
+    def indexedMeans():
+        index = Kernels.labelIndex(label, labelValue)
+        return [Kernels.maskedMean(volume, index) for volume in volumes]
+
+    reference = maskedMeans()
+    assert numpy.allclose(reference, indexedMeans())
+    results = [('mascara', bestTime(maskedMeans, repeat))]
+    try:
+        import vtk
+    except ImportError:
+        vtk = None
+    if vtk:
+        labelImage = vtkImage(label)
+        volumeImages = [vtkImage(volume) for volume in volumes]
+        def stencilMeans():
+            return [legacyStencilMean(volumeImage, labelImage, labelValue) for volumeImage in volumeImages]
+        assert numpy.allclose(reference, stencilMeans())
+        results.insert(0, ('stencil VTK', bestTime(stencilMeans, repeat)))
+    results.append(('indice', bestTime(indexedMeans, repeat)))
+    return results
+
+BENCHMARKS = [
+    ('threshold/label', benchmarkThresholdLabel),
+    ('normalize', benchmarkNormalize),
+    ('normalize int16', benchmarkIntegerNormalize),
+    ('subtraction', benchmarkSubtraction),
+    ('masked mean x8', benchmarkMaskedMean),
+    ]
+
+# Etapas do pipeline sobre o phantom
+#
+# PhantomScene faz o papel da cena: guarda os arrays por nome e devolve-os em
+# arrayFromVolume, como slicer.util.arrayFromVolume, sem copia.
+
+class PhantomScene(object):
+    def __init__(self, shape, timepoints=2):
+        series = Phantom.tofSeries(timepoints, shape)
+        self.arrays = {'base': series[0]}
+        for index, volume in enumerate(series[1:]):
+            # O BRAINSFit produz volumes float32
+            self.arrays['exame%d Reg' % (index + 1)] = volume.astype(numpy.float32)
+        self.bounds = Phantom.aneurysmBounds(shape)
+        label = numpy.zeros(shape, dtype=numpy.int16)
+        label[self.region()] = 1
+        self.arrays['roi-label'] = label
+
+    def arrayFromVolume(self, name):
+        return self.arrays[name]
+
+    def registeredNames(self):
+        return sorted(name for name in self.arrays if name.endswith(' Reg'))
+
+    def region(self):
+        return tuple(slice(k0, k1) for k0, k1 in self.bounds)
+
+def pipelineStages(scene):
+    """Etapas (modulo, nome, funcao, setup) na ordem em que o TOFVol e o TOFDiff as executam.
+
+    As etapas que alteram o volume registrado no proprio array recebem uma
+    copia nova a cada repeticao (setup), entao as etapas seguintes sempre
+    veem os mesmos dados.
+    """
+    base = scene.arrayFromVolume('base')
+    registered = scene.arrayFromVolume(scene.registeredNames()[0])
+    roiLabel = scene.arrayFromVolume('roi-label')
+    factor = 1.05
+    subtraction = numpy.empty_like(registered)
+
+    def mean():
+        return Kernels.integerHistogram(base).mean(), float(registered.mean(dtype=numpy.float64))
+    def registeredCopy():
+        return registered.copy()
+    def normalizeROI(array):
+        Kernels.normalizeBlock(array, factor, scene.bounds)
+    def crop():
+        # Substituto do CropInterpolated: recorte alinhado aos eixos, sem interpolacao
+        return numpy.around(registered[scene.region()])
+    cropped = crop()
+    croppedLabel = numpy.zeros(cropped.shape, dtype=numpy.int16)
+    def thresholdLabel():
+        return Kernels.thresholdLabel(cropped, 0.75, croppedLabel, 2)
+    def normalizeVolume(array):
+        # Como o TOFDiff: volume todo, sem arredondar
+        Kernels.normalizeBlock(array, factor, roundFloats=False)
+    def subtract():
+        Kernels.absoluteDifference(base, registered, subtraction)
+    def maskedMean():
+        index = Kernels.labelIndex(roiLabel, 1)
+        return [Kernels.maskedMean(scene.arrayFromVolume(name), index) for name in ['base'] + scene.registeredNames()]
+
+    return [
+        ('TOFVol', 'media', mean, None),
+        ('TOFVol', 'normalizar ROI', normalizeROI, registeredCopy),
+        ('TOFVol', 'crop', crop, None),
+        ('TOFVol', 'threshold/label', thresholdLabel, None),
+        ('TOFDiff', 'normalizar', normalizeVolume, registeredCopy),
+        ('TOFDiff', 'subtracao', subtract, None),
+        ('TOFDiff', 'media mascarada', maskedMean, None),
+        ]
+
+def peakMemory(function, setup=None):
+    """Pico de memoria alocada (bytes) durante uma execucao de function (function(setup()) com setup).
+
+    Usa tracemalloc (o NumPy registra nele os seus buffers); sem ele (Python
+    2) usa o aumento do pico de RSS do processo, que so' cresce e portanto so'
+    aparece na etapa que estabelece um novo maximo. None se nenhum existir.
+    """
+    args = (setup(),) if setup else ()
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            function(*args)
+            return tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+    if resource:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        function(*args)
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+    return None
+
+def runPipeline(shape, repeat, timepoints=2):
+    print('Phantom %s int16, %d exames, melhor de %d execucoes' % ('x'.join(str(d) for d in shape), timepoints, repeat))
+    start = time.time()
+    scene = PhantomScene(shape, timepoints)
+    print('Phantom gerado em %.1f s' % (time.time() - start))
+    for module, name, stage, setup in pipelineStages(scene):
+        # Tempo sem tracemalloc (que deixa as alocacoes mais lentas) e memoria em uma execucao separada
+        elapsed = bestTime(stage, repeat, setup)
+        peak = peakMemory(stage, setup)
+        memory = '%9.1f MB' % (peak / 1048576.0) if peak is not None else '%12s' % '-'
+        print('%-8s %-20s %9.2f ms %s' % (module, name, elapsed * 1000.0, memory))
+
+def runKernels(shape, repeat):
+    print('Bloco %s, melhor de %d execucoes' % ('x'.join(str(d) for d in shape), repeat))
+    for name, benchmark in BENCHMARKS:
+        results = benchmark(shape, repeat)
+        reference = results[0][1]
+        for variant, elapsed in results:
+            print('%-20s %-12s %9.2f ms  %5.2fx' % (name, variant, elapsed * 1000.0, reference / elapsed))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks das etapas numericas TOF')
+    parser.add_argument('--suite', choices=['kernels', 'pipeline', 'all'], default='all')
+    parser.add_argument('--shape', type=int, nargs=3, default=[83, 233, 333], metavar=('K', 'J', 'I'),
+        help='dimensoes do bloco recortado (padrao: ROI de 100x70x25 mm com voxels de 0.3 mm)')
+    parser.add_argument('--phantom', type=int, nargs=3, default=[200, 512, 512], metavar=('K', 'J', 'I'),
+        help='dimensoes do phantom do pipeline')
+    parser.add_argument('--timepoints', type=int, default=2, help='exames do phantom (o primeiro e\' a base)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.suite in ('kernels', 'all'):
+        runKernels(tuple(args.shape), args.repeat)
+    if args.suite in ('pipeline', 'all'):
+        runPipeline(tuple(args.phantom), args.repeat, max(2, args.timepoints))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import logging
+import contextlib
+
+# Instrumentation
+#
+# Tempo de parede, tempo de CPU do processo e aumento do pico de RSS por
+# etapa e por exame. Cada medicao custa apenas algumas chamadas de sistema,
+# entao fica sempre ligada.
+
+try:
+    cpuTime = time.process_time
+except AttributeError:
+    # Python 2: time.clock e' o tempo de CPU do processo no Linux e no macOS
+    cpuTime = time.clock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peakRSS():
+    "Pico de memoria residente do processo em bytes, ou None se nao disponivel"
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KB no Linux, bytes no macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if sys.platform == 'win32':
+        import ctypes
+        import ctypes.wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', ctypes.wintypes.DWORD), ('PageFaultCount', ctypes.wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+def defaultProfileDirectory():
+    import slicer
+    return os.path.join(slicer.app.temporaryPath, 'TOFUtils', 'Profiles')
+
+class Profiler(object):
+    """Medicoes por etapa de uma execucao de um modulo TOF.
+
+    Uso:
+        with profiler.stage('crop', volumeNode.GetName()):
+            ...
+
+    publish() grava as medicoes em uma tabela "<nome> Profile" na cena e em
+    um arquivo JSON. O pico de RSS so' cresce, entao o aumento aparece na
+    etapa que estabeleceu um novo maximo do processo.
+    """
+
+    columns = ["Etapa", "Exame", "Tempo (s)", "CPU (s)", "Pico RSS (MB)"]
+
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.directory = directory
+        self.reset()
+
+    def reset(self):
+        self.records = []
+        self.started = time.time()
+        self.tableNode = None
+        self.jsonPath = None
+
+    @contextlib.contextmanager
+    def stage(self, stage, timepoint=''):
+        wallStart = time.time()
+        cpuStart = cpuTime()
+        rssStart = peakRSS()
+        try:
+            yield
+        finally:
+            rssEnd = peakRSS()
+            self.record(stage, timepoint, time.time() - wallStart, cpuTime() - cpuStart,
+                rssEnd - rssStart if rssStart is not None and rssEnd is not None else None)
+
+    def record(self, stage, timepoint, wallTime, cpuTime=None, rssDelta=None):
+        "Acrescenta uma medicao feita fora de stage() (por exemplo, a duracao de uma CLI)"
+        self.records.append({'stage': stage, 'timepoint': timepoint, 'wallTime': wallTime,
+            'cpuTime': cpuTime, 'peakRSSDelta': rssDelta})
+
+    def toTable(self):
+        "Tabela da cena com as medicoes (substitui a da publicacao anterior)"
+        import slicer
+        if self.tableNode and self.tableNode.GetScene():
+            slicer.mrmlScene.RemoveNode(self.tableNode)
+        table = slicer.vtkMRMLTableNode()
+        tableWasModified = table.StartModify()
+        table.SetName(self.name + ' Profile')
+        table.SetUseColumnNameAsColumnHeader(True)
+        for name in self.columns:
+            col = table.AddColumn(); col.SetName(name)
+        for record in self.records:
+            rowIndex = table.AddEmptyRow()
+            table.SetCellText(rowIndex, 0, record['stage'])
+            table.SetCellText(rowIndex, 1, record['timepoint'])
+            table.SetCellText(rowIndex, 2, '%.3f' % record['wallTime'])
+            table.SetCellText(rowIndex, 3, '%.3f' % record['cpuTime'] if record['cpuTime'] is not None else '')
+            table.SetCellText(rowIndex, 4, '%.1f' % (record['peakRSSDelta'] / 1048576.0) if record['peakRSSDelta'] is not None else '')
+        slicer.mrmlScene.AddNode(table)
+        table.EndModify(tableWasModified)
+        self.tableNode = table
+        return table
+
+    def saveJSON(self, path=None):
+        "Grava as medicoes em JSON; por padrao um arquivo por execucao na pasta de perfis"
+        if not path:
+            path = self.jsonPath or os.path.join(self.directory or defaultProfileDirectory(),
+                '%s-%s.json' % (self.name, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))))
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump({'name': self.name, 'started': self.started, 'peakRSS': peakRSS(), 'stages': self.records}, f, indent=1)
+        self.jsonPath = path
+        return path
+
+    def publish(self):
+        "Tabela na cena e arquivo JSON; falhas aqui nao interrompem o processamento"
+        try:
+            self.toTable()
+            logging.info('Perfil gravado em ' + self.saveJSON())
+        except Exception:
+            logging.exception('Falha ao publicar o perfil ' + self.name)
@@ -0,0 +1,297 @@
+import math
+import multiprocessing
+import multiprocessing.pool
+import numpy
+
+# Kernels
+#
+# Etapas numericas dos modulos TOF operando diretamente sobre arrays NumPy.
+# Nao dependem do Slicer para poderem ser testadas e medidas fora dele.
+
+# Quantidade aproximada de voxels processados por fatia de trabalho (slab)
+SLAB_VOXELS = 1 << 20
+
+def slabSize(shape, slabVoxels=SLAB_VOXELS):
+    "Numero de fatias k por slab para que cada slab tenha cerca de slabVoxels voxels"
+    sliceVoxels = 1
+    for dim in shape[1:]:
+        sliceVoxels *= dim
+    return max(1, slabVoxels // max(1, sliceVoxels))
+
+def slabRanges(depth, size):
+    "Intervalos [k0, k1) que cobrem 0..depth em passos de size"
+    return [(k0, min(k0 + size, depth)) for k0 in range(0, depth, size)]
+
+def defaultThreads():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def runSlabs(function, ranges, threads=None):
+    "Executa function(k0, k1) para cada slab, em paralelo (o NumPy libera o GIL)"
+    threads = min(threads or defaultThreads(), len(ranges))
+    if threads <= 1:
+        return [function(k0, k1) for k0, k1 in ranges]
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        return pool.map(lambda r: function(r[0], r[1]), ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+def thresholdLabel(array, perc, labelArray=None, label=1, slabVoxels=SLAB_VOXELS):
+    """Limiar dos pontos mais intensos e segmentacao em uma unica passada.
+
+    Calcula min, max, o limiar max - (max-min)*perc, a quantidade e a media
+    dos voxels >= limiar e, se labelArray for dado, escreve label nesses
+    voxels. Trabalha por slabs, entao as unicas copias temporarias tem o
+    tamanho de um slab. Retorna (min, max, limiar, quantidade, media).
+    """
+    min = array.min()
+    max = array.max()
+    minValue = float(max) - ((float(max) - float(min)) * perc)
+    threshold = minValue
+    if numpy.issubdtype(array.dtype, numpy.integer):
+        # Para inteiros x >= limiar equivale a x >= ceil(limiar), sem converter os voxels para float
+        threshold = array.dtype.type(numpy.clip(math.ceil(minValue), min, max))
+
+    size = slabSize(array.shape, slabVoxels)
+    mask = numpy.empty((size,) + array.shape[1:], dtype=bool)
+    countValue = 0
+    sumValue = 0.0
+    for k0, k1 in slabRanges(array.shape[0], size):
+        slab = array[k0:k1]
+        slabMask = mask[:k1 - k0]
+        numpy.greater_equal(slab, threshold, out=slabMask)
+        count = numpy.count_nonzero(slabMask)
+        if not count:
+            continue
+        countValue += count
+        sumValue += slab[slabMask].sum(dtype=numpy.float64)
+        if labelArray is not None:
+            numpy.copyto(labelArray[k0:k1], label, casting='unsafe', where=slabMask)
+
+    meanValue = sumValue / countValue if countValue else 0.0
+    return min, max, minValue, countValue, meanValue
+
+def normalizeBlock(array, factor, bounds=None, slabVoxels=SLAB_VOXELS, roundFloats=True):
+    """Divide array (ou apenas o sub-bloco bounds) por factor, no proprio array.
+
+    Equivale a a[:] = a / factor seguido de a[:] = numpy.around(a, 0) (sem o
+    arredondamento se roundFloats=False), mas sem temporarios do tamanho do
+    volume. Arrays inteiros usam normalizeInteger. bounds e'
+    ((k0, k1), (j0, j1), (i0, i1)).
+    """
+    if bounds:
+        (k0, k1), (j0, j1), (i0, i1) = bounds
+        array = array[k0:k1, j0:j1, i0:i1]
+    if numpy.issubdtype(array.dtype, numpy.integer) and normalizeInteger(array, factor):
+        return array
+    rounded = roundFloats and not numpy.issubdtype(array.dtype, numpy.integer)
+    for k0, k1 in slabRanges(array.shape[0], slabSize(array.shape, slabVoxels)):
+        slab = array[k0:k1]
+        numpy.divide(slab, factor, out=slab, casting='unsafe')
+        if rounded:
+            numpy.around(slab, 0, out=slab)
+    return array
+
+# Voxels por slab da normalizacao por tabela: o indice intp do slab cabe no cache
+LOOKUP_SLAB_VOXELS = 1 << 16
+
+def normalizationTable(values, factor):
+    """Resultado da normalizacao para cada valor inteiro de values.
+
+    A divisao e' feita com o dtype do volume, como em a / factor, e o resultado
+    e' truncado como na atribuicao a[:] = a / factor; valores fora do intervalo
+    do tipo sao saturados em vez de dar a volta.
+    """
+    quotient = numpy.divide(values, factor)
+    info = numpy.iinfo(values.dtype)
+    numpy.clip(quotient, info.min, info.max, out=quotient)
+    return quotient.astype(values.dtype)
+
+def normalizeInteger(array, factor, slabVoxels=LOOKUP_SLAB_VOXELS):
+    """a[:] = a / factor para arrays inteiros por tabela de consulta, no proprio array.
+
+    Para tipos de 8 e 16 bits a tabela cobre todos os valores do tipo e e'
+    indexada pela representacao sem sinal, sem precisar de min/max; para os
+    demais cobre o intervalo min..max presente no array. Cada voxel vira uma
+    leitura da tabela em vez de uma divisao em ponto flutuante, com o mesmo
+    resultado bit a bit (saturado no intervalo do tipo). Retorna False, sem
+    alterar o array, se a tabela seria maior que o proprio array.
+    """
+    dtype = array.dtype
+    if dtype.itemsize <= 2:
+        unsigned = numpy.dtype('u%d' % dtype.itemsize)
+        offset = 0
+        table = normalizationTable(numpy.arange(1 << (8 * dtype.itemsize)).astype(unsigned).view(dtype), factor)
+    else:
+        unsigned = None
+        offset = int(array.min())
+        high = int(array.max())
+        if high - offset + 1 > array.size:
+            return False
+        table = normalizationTable(numpy.arange(offset, high + 1).astype(dtype), factor)
+
+    size = slabSize(array.shape, slabVoxels)
+    index = numpy.empty((size,) + array.shape[1:], dtype=numpy.intp)
+    for k0, k1 in slabRanges(array.shape[0], size):
+        slab = array[k0:k1]
+        slabIndex = index[:k1 - k0]
+        numpy.copyto(slabIndex, slab.view(unsigned) if unsigned else slab, casting='unsafe')
+        if offset:
+            slabIndex -= offset
+        numpy.take(table, slabIndex, out=slab, mode='wrap')
+    return True
+
+class Histogram(object):
+    """Histograma de valores inteiros: counts[n] voxels com valor offset + n.
+
+    Media, minimo, maximo e percentis sao derivados do histograma sem
+    voltar a ler o volume.
+    """
+
+    def __init__(self, offset, counts):
+        self.offset = int(offset)
+        self.counts = counts
+        self.count = int(counts.sum())
+
+    def values(self):
+        return numpy.arange(self.offset, self.offset + len(self.counts), dtype=numpy.float64)
+
+    def min(self):
+        return self.offset + int(numpy.flatnonzero(self.counts)[0])
+
+    def max(self):
+        return self.offset + int(numpy.flatnonzero(self.counts)[-1])
+
+    def mean(self):
+        return float(numpy.dot(self.counts, self.values())) / self.count
+
+    def percentile(self, q):
+        "Percentil q (0-100) pelo metodo do posto mais proximo inferior"
+        rank = int(math.ceil(q / 100.0 * self.count))
+        return self.offset + int(numpy.searchsorted(numpy.cumsum(self.counts), max(1, rank)))
+
+def labelIndex(labelArray, labelValue=None, slabVoxels=SLAB_VOXELS):
+    """Indices planos (em array.ravel()) dos voxels com labelValue (ou != 0).
+
+    Calculado uma vez por ROI, permite que medias mascaradas sejam uma simples
+    coleta (numpy.take) em vez de uma nova mascara do tamanho do volume. Os
+    indices sao int32 (4 bytes por voxel da ROI) quando o volume permite.
+    """
+    dtype = numpy.int32 if labelArray.size < 2 ** 31 else numpy.intp
+    sliceVoxels = labelArray[0].size if labelArray.shape[0] else 0
+    parts = []
+    for k0, k1 in slabRanges(labelArray.shape[0], slabSize(labelArray.shape, slabVoxels)):
+        slab = labelArray[k0:k1]
+        mask = slab != 0 if labelValue is None else slab == labelValue
+        parts.append((numpy.flatnonzero(mask) + k0 * sliceVoxels).astype(dtype))
+    if not parts:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.concatenate(parts)
+
+def gatherChunks(array, index, slabVoxels=SLAB_VOXELS):
+    "Valores de array nos indices planos index, em blocos de ate slabVoxels"
+    flat = array.reshape(-1)
+    for start in range(0, len(index), slabVoxels):
+        yield numpy.take(flat, index[start:start + slabVoxels])
+
+def maskedMean(array, index, slabVoxels=SLAB_VOXELS):
+    "Media de array nos voxels de index (ver labelIndex)"
+    if not len(index):
+        return float('nan')
+    total = 0.0
+    for values in gatherChunks(array, index, slabVoxels):
+        total += values.sum(dtype=numpy.float64)
+    return total / len(index)
+
+# Tamanho do histograma sempre aceito, mesmo maior que o numero de voxels (faixa de 16 bits)
+HISTOGRAM_BINS = 1 << 16
+
+def integerHistogram(array, index=None, slabVoxels=SLAB_VOXELS):
+    """Histograma (Histogram) de um array inteiro, opcionalmente so' nos indices planos index.
+
+    Usa numpy.bincount por slabs para limitar os temporarios ao tamanho de um
+    slab; com index os valores sao coletados uma unica vez e a faixa vem
+    deles, sem ler o volume inteiro. Retorna None se nao houver voxels ou se
+    a faixa de valores pedir mais que max(voxels, HISTOGRAM_BINS) posicoes
+    (ex.: int32 com valores espalhados); o chamador usa entao as contas
+    diretas sobre os voxels.
+    """
+    if index is None:
+        if not array.size:
+            return None
+        min = int(array.min())
+        max = int(array.max())
+        chunks = [array[k0:k1] for k0, k1 in slabRanges(array.shape[0], slabSize(array.shape, slabVoxels))]
+    else:
+        if not len(index):
+            return None
+        chunks = list(gatherChunks(array, index, slabVoxels))
+        min = int(numpy.min([chunk.min() for chunk in chunks]))
+        max = int(numpy.max([chunk.max() for chunk in chunks]))
+    voxels = array.size if index is None else len(index)
+    if max - min + 1 > (voxels if voxels > HISTOGRAM_BINS else HISTOGRAM_BINS):
+        return None
+
+    counts = numpy.zeros(max - min + 1, dtype=numpy.int64)
+    for chunk in chunks:
+        if chunk.size:
+            counts += numpy.bincount(chunk.astype(numpy.intp).ravel() - min, minlength=len(counts))
+    if not counts.any():
+        return None
+    return Histogram(min, counts)
+
+def absoluteDifference(a, b, out, slabVoxels=SLAB_VOXELS, threads=None):
+    """out = |a - b|, zerado onde a ou b sao zero (bordas sem dado apos o registro).
+
+    Processa slabs de z em um pool de threads, escrevendo direto em out; a
+    memoria extra fica limitada a alguns slabs por thread. O resultado e' o
+    mesmo de out[:] = numpy.absolute(a - b); out[a == 0] = 0; out[b == 0] = 0.
+    """
+    resultType = numpy.result_type(a, b)
+    def subtractSlab(k0, k1):
+        target = out[k0:k1]
+        if target.dtype == resultType:
+            difference = numpy.subtract(a[k0:k1], b[k0:k1], out=target)
+        else:
+            difference = numpy.subtract(a[k0:k1], b[k0:k1])
+        numpy.absolute(difference, out=difference)
+        border = numpy.equal(a[k0:k1], 0)
+        numpy.logical_or(border, numpy.equal(b[k0:k1], 0), out=border)
+        numpy.copyto(difference, 0, where=border)
+        if difference is not target:
+            target[...] = difference
+    runSlabs(subtractSlab, slabRanges(out.shape[0], slabSize(out.shape, slabVoxels)), threads)
+    return out
+
+POPCOUNT = numpy.array([bin(value).count('1') for value in range(256)], dtype=numpy.uint8)
+
+def popcount(bits):
+    "Quantidade de bits 1 em um array uint8 (mascara de numpy.packbits)"
+    return int(POPCOUNT[bits].sum(dtype=numpy.int64))
+
+def maximumProjections(array, bounds=None, slabVoxels=SLAB_VOXELS):
+    """Projecoes de intensidade maxima (MIP) ao longo de k, j e i, em uma unica leitura.
+
+    Retorna (projecao em k (j, i), projecao em j (k, i), projecao em i (k, j)),
+    que para um exame adquirido em axial sao as MIPs axial, coronal e
+    sagital. bounds ((k0, k1), (j0, j1), (i0, i1)) limita as projecoes a
+    um sub-bloco (ROI ou slab).
+    """
+    if bounds:
+        (k0, k1), (j0, j1), (i0, i1) = bounds
+        array = array[k0:k1, j0:j1, i0:i1]
+    depth, rows, columns = array.shape
+    alongK = None
+    alongJ = numpy.empty((depth, columns), dtype=array.dtype)
+    alongI = numpy.empty((depth, rows), dtype=array.dtype)
+    for k0, k1 in slabRanges(depth, slabSize(array.shape, slabVoxels)):
+        slab = array[k0:k1]
+        slabMax = slab.max(axis=0)
+        alongK = slabMax if alongK is None else numpy.maximum(alongK, slabMax, out=alongK)
+        slab.max(axis=1, out=alongJ[k0:k1])
+        slab.max(axis=2, out=alongI[k0:k1])
+    return alongK, alongJ, alongI
@@ -0,0 +1,124 @@
+import json
+import zlib
+import base64
+import logging
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+from TOFLib.SceneIndex import sceneIndex
+
+# LabelStore
+#
+# Segmentacoes do TOFVol sem um label map por exame: cada mascara e' guardada
+# com um bit por voxel (numpy.packbits), comprimida com zlib, em um atributo
+# da tabela de resultados. As mascaras sao pequenas e esparsas, entao a
+# cena fica leve para salvar e carregar; o label map de um exame so' e'
+# criado quando alguem vai exibi-lo (materialize).
+
+ATTRIBUTE_PREFIX = 'TOFLabels.'
+
+def encodeMask(mask):
+    "Mascara booleana -> texto (bits empacotados, zlib, base64)"
+    packed = numpy.packbits(numpy.ascontiguousarray(mask, dtype=bool).reshape(-1))
+    return base64.b64encode(zlib.compress(packed.tobytes(), 6)).decode('ascii')
+
+def decodeMask(text, shape):
+    "Texto de encodeMask -> mascara booleana com a forma dada"
+    size = int(numpy.prod(shape))
+    packed = numpy.frombuffer(zlib.decompress(base64.b64decode(text)), dtype=numpy.uint8)
+    return numpy.unpackbits(packed)[:size].reshape(shape).astype(bool)
+
+class LabelStore(object):
+    """Mascaras compactadas de todos os exames de uma tabela do TOFVol.
+
+    Cada entrada (atributo TOFLabels.<ID do exame> da tabela) guarda a forma
+    e a matriz IJK->RAS do recorte, o valor do label, o nome do label map e
+    a mascara. materialize() cria (uma vez) o label map de um exame, ligado
+    ao exame no indice da cena como antes.
+    """
+
+    def __init__(self, tableNode):
+        self.tableNode = tableNode
+        # ID do exame -> mascara ja decodificada
+        self.masks = {}
+
+    def add(self, sourceVolume, mask, ijkToRAS, labelValue, name, transformNodeID=None):
+        entry = {'shape': list(mask.shape), 'ijkToRAS': [ijkToRAS.GetElement(i, j) for i in range(4) for j in range(4)],
+            'label': int(labelValue), 'name': name, 'transformNodeID': transformNodeID, 'mask': encodeMask(mask)}
+        self.tableNode.SetAttribute(ATTRIBUTE_PREFIX + sourceVolume.GetID(), json.dumps(entry))
+        self.masks[sourceVolume.GetID()] = mask
+
+    def sourceIDs(self):
+        "IDs dos exames com mascara guardada"
+        return [name[len(ATTRIBUTE_PREFIX):] for name in self.tableNode.GetAttributeNames() if name.startswith(ATTRIBUTE_PREFIX)]
+
+    def entry(self, sourceID):
+        text = self.tableNode.GetAttribute(ATTRIBUTE_PREFIX + sourceID)
+        return json.loads(text) if text else None
+
+    def mask(self, sourceID):
+        if sourceID not in self.masks:
+            entry = self.entry(sourceID)
+            self.masks[sourceID] = decodeMask(entry['mask'], tuple(entry['shape']))
+        return self.masks[sourceID]
+
+    def ijkToRAS(self, sourceID):
+        matrix = vtk.vtkMatrix4x4()
+        elements = self.entry(sourceID)['ijkToRAS']
+        for i in range(4):
+            for j in range(4):
+                matrix.SetElement(i, j, elements[4 * i + j])
+        return matrix
+
+    def labelArray(self, sourceID):
+        "Array (k, j, i) int16 com o valor do label nos voxels da mascara"
+        labelArray = numpy.zeros(self.mask(sourceID).shape, dtype=numpy.int16)
+        labelArray[self.mask(sourceID)] = self.entry(sourceID)['label']
+        return labelArray
+
+    def imageData(self, sourceID):
+        "vtkImageData (IJK) do label de um exame, sem criar o no'"
+        labelArray = self.labelArray(sourceID)
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(labelArray.shape[2], labelArray.shape[1], labelArray.shape[0])
+        imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(labelArray.reshape(-1), deep=True))
+        return imageData
+
+    def labelMap(self, sourceID):
+        "Label map ja criado para o exame, ou None"
+        sourceVolume = slicer.mrmlScene.GetNodeByID(sourceID)
+        if not sourceVolume:
+            return None
+        for labelMap in sceneIndex().derived(sourceVolume, 'labelMap'):
+            if labelMap and labelMap.GetAttribute('TOFVol.TableID') == self.tableNode.GetID():
+                return labelMap
+        return None
+
+    def materialize(self, sourceID):
+        "Label map do exame, criado a partir da mascara na primeira chamada"
+        labelMap = self.labelMap(sourceID)
+        if labelMap:
+            return labelMap
+        entry = self.entry(sourceID)
+        if not entry:
+            return None
+        labelMap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', entry['name'])
+        labelMap.SetIJKToRASMatrix(self.ijkToRAS(sourceID))
+        slicer.util.updateVolumeFromArray(labelMap, self.labelArray(sourceID))
+        labelMap.CreateDefaultDisplayNodes()
+        labelMap.SetAndObserveTransformNodeID(entry['transformNodeID'])
+        labelMap.SetAttribute('TOFVol.TableID', self.tableNode.GetID())
+        sourceVolume = slicer.mrmlScene.GetNodeByID(sourceID)
+        if sourceVolume:
+            sceneIndex().link(sourceVolume, labelMap, 'labelMap')
+        logging.info('Label map criado: ' + entry['name'])
+        return labelMap
+
+def labelStores():
+    "LabelStore de cada tabela da cena que tem mascaras guardadas"
+    stores = []
+    for tableNode in slicer.util.getNodesByClass('vtkMRMLTableNode'):
+        if any(name.startswith(ATTRIBUTE_PREFIX) for name in tableNode.GetAttributeNames()):
+            stores.append(LabelStore(tableNode))
+    return stores
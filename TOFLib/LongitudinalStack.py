@@ -0,0 +1,144 @@
+import numpy
+
+from TOFLib import Kernels
+
+# LongitudinalStack
+#
+# Os exames registrados de um paciente em um unico array contiguo
+# (tempo, k, j, i), opcionalmente recortado por uma caixa (ROI). As
+# estatisticas por exame e os mapas de variacao voxel a voxel sao reducoes
+# ao longo do eixo do tempo, em vez de contas no' a no' contra o primeiro
+# exame. A parte numerica nao depende do Slicer.
+
+class LongitudinalStack(object):
+    """Pilha 4D dos exames registrados.
+
+    stack[t] e' o exame t (0 = base) no sub-bloco bounds da grade comum;
+    times sao os instantes dos exames (por padrao 0, 1, 2, ...), usados na
+    inclinacao. Os mapas voxel a voxel sao calculados por slabs em k, entao
+    os temporarios tem o tamanho de um slab vezes o numero de exames.
+    """
+
+    def __init__(self, stack, names, bounds=None, times=None, slabVoxels=Kernels.SLAB_VOXELS):
+        self.stack = stack
+        self.names = list(names)
+        self.bounds = bounds
+        self.times = numpy.arange(len(stack), dtype=numpy.float64) if times is None else numpy.asarray(times, dtype=numpy.float64)
+        self.slabVoxels = slabVoxels
+
+    @classmethod
+    def fromArrays(cls, arrays, names, bounds=None, dtype=numpy.float32, times=None):
+        "Copia os arrays (k, j, i) de mesma grade, ou apenas o sub-bloco bounds deles, para uma pilha contigua"
+        region = tuple(slice(lo, hi) for lo, hi in bounds) if bounds else (slice(None),) * 3
+        shape = arrays[0][region].shape
+        stack = numpy.empty((len(arrays),) + shape, dtype=dtype)
+        for t, array in enumerate(arrays):
+            stack[t] = array[region]
+        return cls(stack, names, bounds, times)
+
+    def flat(self):
+        return self.stack.reshape(len(self.stack), -1)
+
+    def means(self, mask=None):
+        "Media de cada exame (na mascara (k, j, i) booleana, se dada)"
+        if mask is None:
+            return self.flat().mean(axis=1, dtype=numpy.float64)
+        return self.stack[:, mask].mean(axis=1, dtype=numpy.float64)
+
+    def thresholds(self, perc):
+        "min, max e o limiar max - (max-min)*perc de cada exame, como em Kernels.thresholdLabel"
+        flat = self.flat()
+        minimum = flat.min(axis=1).astype(numpy.float64)
+        maximum = flat.max(axis=1).astype(numpy.float64)
+        return minimum, maximum, maximum - (maximum - minimum) * perc
+
+    def counts(self, thresholds):
+        "Quantidade de voxels >= limiar de cada exame"
+        thresholds = numpy.asarray(thresholds).reshape(-1, 1, 1, 1)
+        counts = numpy.zeros(len(self.stack), dtype=numpy.int64)
+        for k0, k1 in self.slabRanges():
+            counts += numpy.count_nonzero(self.stack[:, k0:k1] >= thresholds, axis=(1, 2, 3))
+        return counts
+
+    def slabRanges(self):
+        return Kernels.slabRanges(self.stack.shape[1], Kernels.slabSize(self.stack.shape[1:], self.slabVoxels // max(1, len(self.stack))))
+
+    def differences(self, consecutive=False):
+        "Diferencas com sinal: exame t - base (t >= 1), ou exame t - exame t-1"
+        if consecutive:
+            return numpy.diff(self.stack, axis=0)
+        return self.stack[1:] - self.stack[:1]
+
+    def maximum(self):
+        "Maximo ao longo do tempo de cada voxel"
+        return self.stack.max(axis=0)
+
+    def maximumChange(self):
+        "Maior variacao absoluta entre exames consecutivos de cada voxel"
+        change = numpy.zeros(self.stack.shape[1:], dtype=self.stack.dtype)
+        if len(self.stack) < 2:
+            return change
+        for k0, k1 in self.slabRanges():
+            numpy.abs(numpy.diff(self.stack[:, k0:k1], axis=0)).max(axis=0, out=change[k0:k1])
+        return change
+
+    def slope(self):
+        """Inclinacao da reta de minimos quadrados de cada voxel (intensidade por unidade de times).
+
+        Com pesos w = (t - media(t)) / soma((t - media(t))^2) a inclinacao e'
+        soma(w * x), um unico tensordot ao longo do tempo por slab.
+        """
+        centered = self.times - self.times.mean()
+        denominator = (centered * centered).sum()
+        slope = numpy.zeros(self.stack.shape[1:], dtype=numpy.float32)
+        if not denominator:
+            return slope
+        weights = (centered / denominator).astype(numpy.float32)
+        for k0, k1 in self.slabRanges():
+            slope[k0:k1] = numpy.tensordot(weights, self.stack[:, k0:k1], axes=(0, 0))
+        return slope
+
+    def ijkToRAS(self, referenceVolume):
+        "Geometria do sub-bloco da pilha na grade de referenceVolume"
+        import vtk
+        matrix = vtk.vtkMatrix4x4()
+        referenceVolume.GetIJKToRASMatrix(matrix)
+        if self.bounds:
+            (k0, k1), (j0, j1), (i0, i1) = self.bounds
+            origin = matrix.MultiplyPoint([i0, j0, k0, 1.0])
+            for row in range(3):
+                matrix.SetElement(row, 3, origin[row])
+        return matrix
+
+    def toVolume(self, array, name, referenceVolume):
+        "Volume escalar da cena com um mapa (k, j, i) da pilha"
+        import slicer
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+        volumeNode.SetIJKToRASMatrix(self.ijkToRAS(referenceVolume))
+        slicer.util.updateVolumeFromArray(volumeNode, numpy.ascontiguousarray(array))
+        volumeNode.SetAndObserveTransformNodeID(referenceVolume.GetTransformNodeID())
+        volumeNode.CreateDefaultDisplayNodes()
+        return volumeNode
+
+    def toTable(self, name, perc, mask=None):
+        "Tabela da cena com media, min-max, limiar e quantidade de cada exame"
+        import slicer
+        means = self.means(mask)
+        minimum, maximum, thresholds = self.thresholds(perc)
+        counts = self.counts(thresholds)
+        table = slicer.vtkMRMLTableNode()
+        tableWasModified = table.StartModify()
+        table.SetName(name)
+        table.SetUseColumnNameAsColumnHeader(True)
+        for columnName in ["Volume", "Media", "Min-Max", "Limiar", "Qtde"]:
+            col = table.AddColumn(); col.SetName(columnName)
+        for t, volumeName in enumerate(self.names):
+            rowIndex = table.AddEmptyRow()
+            table.SetCellText(rowIndex, 0, volumeName)
+            table.SetCellText(rowIndex, 1, '%.2f' % means[t])
+            table.SetCellText(rowIndex, 2, str(int(minimum[t])) + " - " + str(int(maximum[t])))
+            table.SetCellText(rowIndex, 3, '%.1f' % thresholds[t])
+            table.SetCellText(rowIndex, 4, str(counts[t]))
+        slicer.mrmlScene.AddNode(table)
+        table.EndModify(tableWasModified)
+        return table
@@ -0,0 +1,292 @@
+import itertools
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+from TOFLib.Kernels import popcount
+from TOFLib.Projections import labelBounds
+
+# Overlap
+#
+# Sobreposicao entre label maps (ex.: o mesmo vaso em dois exames). Cada
+# label vira uma mascara na caixa comum que contem os voxels nao nulos dos
+# labels comparados, empacotada com um bit por voxel (numpy.packbits); as
+# contagens do par sao um AND dos bytes e uma tabela de popcount, sem
+# voltar aos arrays inteiros. Label maps na mesma grade (a menos de um
+# deslocamento inteiro) sao copiados por fatias; os demais sao reamostrados
+# (vizinho mais proximo) na grade do label de menor ID.
+
+def worldIJKToRAS(labelNode):
+    "Matriz numpy 4x4 IJK -> mundo do label map (com a transformacao pai linear)"
+    ijkToRAS = vtk.vtkMatrix4x4()
+    labelNode.GetIJKToRASMatrix(ijkToRAS)
+    toWorld = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(labelNode.GetParentTransformNode(), None, toWorld)
+    vtk.vtkMatrix4x4.Multiply4x4(toWorld, ijkToRAS, ijkToRAS)
+    return numpy.array([[ijkToRAS.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+def integerOffset(matrix, tolerance=1e-3):
+    "Deslocamento (i, j, k) inteiro se matrix (IJK -> IJK) for apenas uma translacao inteira, senao None"
+    if not numpy.allclose(matrix[:3, :3], numpy.eye(3), atol=tolerance):
+        return None
+    offset = numpy.round(matrix[:3, 3])
+    if not numpy.allclose(matrix[:3, 3], offset, atol=tolerance):
+        return None
+    return offset.astype(int)
+
+class Grid(object):
+    "Caixa (k, j, i) com a geometria ijkToWorld (numpy 4x4) em que as mascaras sao comparadas"
+
+    def __init__(self, ijkToWorld, shape):
+        self.ijkToWorld = ijkToWorld
+        self.shape = tuple(int(size) for size in shape)
+        self.key = (tuple(numpy.round(ijkToWorld, 6).reshape(-1)), self.shape)
+
+    def voxelVolume(self):
+        "Volume de um voxel em mm3"
+        return abs(numpy.linalg.det(self.ijkToWorld[:3, :3]))
+
+    def vtkIJKToRAS(self):
+        matrix = vtk.vtkMatrix4x4()
+        for i in range(4):
+            for j in range(4):
+                matrix.SetElement(i, j, self.ijkToWorld[i, j])
+        return matrix
+
+class OverlapMetrics(object):
+    "Contagens, volumes (mm3), Dice, Jaccard e deslocamento do centroide (mm) de um par de labels"
+
+    def __init__(self, count1, count2, both, voxelVolume, centroid1, centroid2):
+        self.voxelVolume = voxelVolume
+        self.centroid1 = centroid1
+        self.centroid2 = centroid2
+        self.count1 = count1
+        self.count2 = count2
+        self.both = both
+        self.only1 = count1 - both
+        self.only2 = count2 - both
+        self.union = count1 + count2 - both
+        self.volume1 = count1 * voxelVolume
+        self.volume2 = count2 * voxelVolume
+        self.bothVolume = both * voxelVolume
+        self.dice = 2.0 * both / (count1 + count2) if count1 + count2 else 0.0
+        self.jaccard = float(both) / self.union if self.union else 0.0
+        if centroid1 is None or centroid2 is None:
+            self.centroidShift = None
+        else:
+            self.centroidShift = float(numpy.linalg.norm(numpy.asarray(centroid2) - numpy.asarray(centroid1)))
+
+    def swapped(self):
+        "As mesmas metricas com os labels 1 e 2 trocados"
+        return OverlapMetrics(self.count2, self.count1, self.both, self.voxelVolume, self.centroid2, self.centroid1)
+
+    def summary(self):
+        shift = '-' if self.centroidShift is None else '%.2f mm' % self.centroidShift
+        return ("Dice %.3f  Jaccard %.3f\nVolumes %.1f / %.1f mm3 (ambos %.1f mm3)\n"
+            "Voxels: so' 1 %d, so' 2 %d, ambos %d\nDeslocamento do centroide: %s") % (self.dice, self.jaccard,
+            self.volume1, self.volume2, self.bothVolume, self.only1, self.only2, self.both, shift)
+
+class OverlapCache(object):
+    """Mascaras empacotadas e metricas de sobreposicao calculadas uma unica vez.
+
+    As mascaras sao guardadas por (label map, grade) e as metricas por (par,
+    grade), entao trocar a selecao entre pares ja vistos e' imediato. O par
+    nao tem ordem: (A, B) e (B, A) usam a mesma grade e a mesma entrada, e
+    as grades sao calculadas com os labels ordenados por ID, entao o
+    resultado nao depende da ordem em que foram escolhidos. As entradas de
+    um label map sao descartadas quando a imagem ou a transformacao dele
+    mudam, ou quando ele sai da cena.
+    """
+
+    def __init__(self):
+        # nodeID -> (caixa dos voxels nao nulos, centroide no mundo)
+        self.labels = {}
+        # (nodeID, grid.key) -> bits
+        self.masks = {}
+        # (menor nodeID, maior nodeID, grid.key) -> OverlapMetrics na ordem dos IDs
+        self.pairs = {}
+        # nodeID -> (no', tags dos observadores)
+        self.observedNodes = {}
+        self.sceneObserverTags = [
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, lambda caller, event: self.clear()),
+            ]
+
+    def label(self, labelNode):
+        "Caixa ((k0, k1), (j0, j1), (i0, i1)) dos voxels nao nulos e centroide (mundo) do label, ou (None, None)"
+        nodeID = labelNode.GetID()
+        if nodeID not in self.labels:
+            self.observe(labelNode)
+            array = slicer.util.arrayFromVolume(labelNode)
+            bounds = labelBounds(array)
+            centroid = None
+            if bounds:
+                region = array[tuple(slice(lo, hi) for lo, hi in bounds)] != 0
+                count = float(numpy.count_nonzero(region))
+                kji = []
+                for axis in range(3):
+                    others = tuple(a for a in range(3) if a != axis)
+                    profile = region.sum(axis=others, dtype=numpy.int64)
+                    kji.append(bounds[axis][0] + (profile * numpy.arange(len(profile))).sum() / count)
+                centroid = worldIJKToRAS(labelNode).dot([kji[2], kji[1], kji[0], 1.0])[:3]
+            self.labels[nodeID] = (bounds, centroid)
+        return self.labels[nodeID]
+
+    def grid(self, labelNodes):
+        "Grade do label de menor ID que contem os voxels nao nulos de todos, ou None se todos estiverem vazios"
+        labelNodes = sorted(labelNodes, key=lambda labelNode: labelNode.GetID())
+        reference = worldIJKToRAS(labelNodes[0])
+        worldToReference = numpy.linalg.inv(reference)
+        corners = []
+        for labelNode in labelNodes:
+            bounds = self.label(labelNode)[0]
+            if not bounds:
+                continue
+            toReference = worldToReference.dot(worldIJKToRAS(labelNode))
+            (k0, k1), (j0, j1), (i0, i1) = bounds
+            for corner in itertools.product((i0, i1 - 1), (j0, j1 - 1), (k0, k1 - 1)):
+                corners.append(toReference.dot(list(corner) + [1.0])[:3])
+        if not corners:
+            return None
+        corners = numpy.array(corners)
+        lo = numpy.floor(corners.min(axis=0) + 1e-3).astype(int)
+        hi = numpy.ceil(corners.max(axis=0) - 1e-3).astype(int) + 1
+        ijkToWorld = reference.copy()
+        ijkToWorld[:3, 3] = reference.dot(list(lo) + [1.0])[:3]
+        return Grid(ijkToWorld, tuple(reversed(hi - lo)))
+
+    def bits(self, labelNode, grid):
+        "Mascara (label != 0) do label na grade, empacotada"
+        key = (labelNode.GetID(), grid.key)
+        if key not in self.masks:
+            self.observe(labelNode)
+            self.masks[key] = numpy.packbits(self.gridMask(labelNode, grid).reshape(-1))
+        return self.masks[key]
+
+    def gridMask(self, labelNode, grid):
+        "Mascara booleana (k, j, i) do label na grade"
+        mask = numpy.zeros(grid.shape, dtype=bool)
+        bounds = self.label(labelNode)[0]
+        if not bounds:
+            return mask
+        gridToLabel = numpy.linalg.inv(worldIJKToRAS(labelNode)).dot(grid.ijkToWorld)
+        offset = integerOffset(gridToLabel)
+        if offset is None:
+            return self.reslice(labelNode, gridToLabel, grid.shape)
+        # Voxel n do label fica no voxel n - offset da grade; so' a caixa dos nao nulos e' copiada
+        source = []
+        target = []
+        for (lo, hi), shift, size in zip(bounds, reversed(offset), grid.shape):
+            lo, hi = max(lo, shift), min(hi, shift + size)
+            if lo >= hi:
+                return mask
+            source.append(slice(lo, hi))
+            target.append(slice(lo - shift, hi - shift))
+        mask[tuple(target)] = slicer.util.arrayFromVolume(labelNode)[tuple(source)] != 0
+        return mask
+
+    def reslice(self, labelNode, gridToLabel, shape):
+        "Label reamostrado (vizinho mais proximo) na grade, como mascara"
+        resliceAxes = vtk.vtkMatrix4x4()
+        for i in range(4):
+            for j in range(4):
+                resliceAxes.SetElement(i, j, gridToLabel[i, j])
+        reslice = vtk.vtkImageReslice()
+        reslice.SetInputData(labelNode.GetImageData())
+        reslice.SetResliceAxes(resliceAxes)
+        reslice.SetInterpolationModeToNearestNeighbor()
+        reslice.SetOutputOrigin(0, 0, 0)
+        reslice.SetOutputSpacing(1, 1, 1)
+        reslice.SetOutputExtent(0, shape[2] - 1, 0, shape[1] - 1, 0, shape[0] - 1)
+        reslice.Update()
+        return numpy_support.vtk_to_numpy(reslice.GetOutput().GetPointData().GetScalars()).reshape(shape) != 0
+
+    def metrics(self, labelNode1, labelNode2, grid=None):
+        "OverlapMetrics do par (na grade dada ou na do proprio par); None se os dois labels estiverem vazios"
+        grid = grid or self.grid([labelNode1, labelNode2])
+        if not grid:
+            return None
+        reversedPair = labelNode2.GetID() < labelNode1.GetID()
+        if reversedPair:
+            labelNode1, labelNode2 = labelNode2, labelNode1
+        key = (labelNode1.GetID(), labelNode2.GetID(), grid.key)
+        if key not in self.pairs:
+            bits1 = self.bits(labelNode1, grid)
+            bits2 = self.bits(labelNode2, grid)
+            self.pairs[key] = OverlapMetrics(popcount(bits1), popcount(bits2), popcount(bits1 & bits2), grid.voxelVolume(),
+                self.label(labelNode1)[1], self.label(labelNode2)[1])
+        return self.pairs[key].swapped() if reversedPair else self.pairs[key]
+
+    def allPairs(self, labelNodes):
+        "[(label 1, label 2, OverlapMetrics)] de todos os pares, com as mascaras em uma unica grade"
+        grid = self.grid(labelNodes) if labelNodes else None
+        if not grid:
+            return []
+        return [(labelNode1, labelNode2, self.metrics(labelNode1, labelNode2, grid))
+            for labelNode1, labelNode2 in itertools.combinations(labelNodes, 2)]
+
+    def overlapArray(self, labelNode1, labelNode2):
+        "(grade, array int16) com 1 = so' no label 1, 2 = so' no label 2, 3 = nos dois"
+        grid = self.grid([labelNode1, labelNode2])
+        if not grid:
+            return None, None
+        size = int(numpy.prod(grid.shape))
+        overlap = numpy.unpackbits(self.bits(labelNode1, grid))[:size].astype(numpy.int16)
+        overlap += 2 * numpy.unpackbits(self.bits(labelNode2, grid))[:size]
+        return grid, overlap.reshape(grid.shape)
+
+    def overlapVolume(self, labelNode1, labelNode2, name=None):
+        "Label map da cena com o mapa de sobreposicao do par, ou None"
+        grid, overlap = self.overlapArray(labelNode1, labelNode2)
+        if grid is None:
+            return None
+        labelMap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode',
+            name or 'Sobreposicao ' + labelNode1.GetName() + ' x ' + labelNode2.GetName())
+        labelMap.SetIJKToRASMatrix(grid.vtkIJKToRAS())
+        slicer.util.updateVolumeFromArray(labelMap, overlap)
+        labelMap.CreateDefaultDisplayNodes()
+        return labelMap
+
+    def observe(self, node):
+        if node.GetID() in self.observedNodes:
+            return
+        tags = [node.AddObserver(event, lambda caller, event: self.invalidate(caller.GetID()))
+            for event in (slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, slicer.vtkMRMLTransformableNode.TransformModifiedEvent)]
+        self.observedNodes[node.GetID()] = (node, tags)
+
+    def invalidate(self, nodeID):
+        "Descarta as mascaras e os pares que dependem do label map"
+        self.labels.pop(nodeID, None)
+        for key in list(self.masks.keys()):
+            if key[0] == nodeID:
+                del self.masks[key]
+        for key in list(self.pairs.keys()):
+            if nodeID in key[:2]:
+                del self.pairs[key]
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        if node.GetID() not in self.observedNodes:
+            return
+        self.invalidate(node.GetID())
+        observedNode, tags = self.observedNodes.pop(node.GetID())
+        for tag in tags:
+            observedNode.RemoveObserver(tag)
+
+    def clear(self):
+        self.labels = {}
+        self.masks = {}
+        self.pairs = {}
+        for node, tags in self.observedNodes.values():
+            for tag in tags:
+                node.RemoveObserver(tag)
+        self.observedNodes = {}
+
+_overlapCache = None
+
+def overlapCache():
+    "Cache unico de sobreposicao, compartilhado pelos modulos TOF"
+    global _overlapCache
+    if _overlapCache is None:
+        _overlapCache = OverlapCache()
+    return _overlapCache
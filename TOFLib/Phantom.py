@@ -0,0 +1,84 @@
+import math
+import numpy
+
+# Phantom
+#
+# Volumes sinteticos parecidos com uma angio TOF (nao precisam do Slicer):
+# cabeca elipsoidal de tecido, vasos tubulares brilhantes seguindo caminhos
+# senoidais e um aneurisma esferico encostado no vaso principal, com ruido
+# Rician. Arrays em ordem (k, j, i), como os de slicer.util.arrayFromVolume.
+
+TISSUE = 90.0
+VESSEL = 420.0
+ANEURYSM = 380.0
+NOISE = 12.0
+
+def vessels(shape):
+    "Caminhos dos vasos: lista de (funcao k -> (j, i), raio em voxels)"
+    depth, rows, columns = shape
+    scale = min(rows, columns) / 512.0
+    def path(j0, i0, amplitude, period, phase):
+        return lambda k: (j0 * rows + amplitude * rows * math.sin(2 * math.pi * k / (period * depth) + phase),
+                          i0 * columns + amplitude * columns * math.cos(2 * math.pi * k / (period * depth) + phase))
+    return [
+        (path(0.50, 0.42, 0.04, 1.5, 0.0), max(1.5, 6.0 * scale)),
+        (path(0.45, 0.62, 0.03, 1.0, 1.0), max(1.2, 4.0 * scale)),
+        (path(0.60, 0.55, 0.05, 2.0, 2.0), max(1.0, 2.5 * scale)),
+        ]
+
+def aneurysm(shape, growth=1.0):
+    "Centro (k, j, i) e raio do aneurisma, ao lado do vaso principal na metade do volume"
+    depth, rows, columns = shape
+    center, radius = vessels(shape)[0]
+    k = depth // 2
+    j, i = center(k)
+    aneurysmRadius = max(2.0, 2.2 * radius) * growth
+    return (k, j, i + radius + 0.6 * aneurysmRadius), aneurysmRadius
+
+def aneurysmBounds(shape, margin=10):
+    "Limites ((k0, k1), (j0, j1), (i0, i1)) de uma caixa em volta do aneurisma"
+    (k, j, i), radius = aneurysm(shape)
+    extent = int(math.ceil(radius)) + margin
+    return tuple((max(0, int(c) - extent), min(size, int(c) + extent + 1)) for c, size in zip((k, j, i), shape))
+
+def tofPhantom(shape=(200, 512, 512), growth=1.0, gain=1.0, noise=NOISE, seed=0, dtype=numpy.int16):
+    """Volume TOF sintetico.
+
+    growth multiplica o raio do aneurisma (exames de seguimento) e gain a
+    intensidade do sinal (diferencas de aquisicao que a normalizacao corrige).
+    Gerado fatia por fatia, sem temporarios do tamanho do volume.
+    """
+    depth, rows, columns = shape
+    random = numpy.random.RandomState(seed)
+    volume = numpy.empty(shape, dtype=dtype)
+    j, i = numpy.ogrid[:rows, :columns]
+    j = j.astype(numpy.float32)
+    i = i.astype(numpy.float32)
+    paths = vessels(shape)
+    (ak, aj, ai), aneurysmRadius = aneurysm(shape, growth)
+    # Semi-eixos da cabeca
+    hk, hj, hi = depth * 0.6, rows * 0.45, columns * 0.4
+
+    for k in range(depth):
+        head = ((k - depth / 2.0) / hk) ** 2 + ((j - rows / 2.0) / hj) ** 2 + ((i - columns / 2.0) / hi) ** 2 <= 1.0
+        signal = numpy.where(head, numpy.float32(TISSUE), numpy.float32(0.0))
+        for center, radius in paths:
+            cj, ci = center(k)
+            distance = numpy.sqrt((j - cj) ** 2 + (i - ci) ** 2)
+            # Borda suave de um voxel (efeito de volume parcial)
+            signal = numpy.maximum(signal, VESSEL * numpy.clip(radius + 0.5 - distance, 0.0, 1.0))
+        if abs(k - ak) < aneurysmRadius + 1:
+            distance = numpy.sqrt((k - ak) ** 2 + (j - aj) ** 2 + (i - ai) ** 2)
+            signal = numpy.maximum(signal, ANEURYSM * numpy.clip(aneurysmRadius + 0.5 - distance, 0.0, 1.0))
+        signal *= gain
+        # Ruido Rician: modulo de um sinal complexo com ruido gaussiano nas duas componentes
+        real = signal + random.normal(0.0, noise, signal.shape).astype(numpy.float32)
+        imaginary = random.normal(0.0, noise, signal.shape).astype(numpy.float32)
+        volume[k] = numpy.around(numpy.sqrt(real * real + imaginary * imaginary))
+    return volume
+
+def tofSeries(timepoints=3, shape=(200, 512, 512), growthPerExam=0.1, seed=0):
+    "Exames longitudinais: o aneurisma cresce e o ganho varia de um exame para outro"
+    gains = [1.0, 1.08, 0.93, 1.04, 0.97]
+    return [tofPhantom(shape, 1.0 + growthPerExam * index, gains[index % len(gains)], seed=seed + index)
+        for index in range(timepoints)]
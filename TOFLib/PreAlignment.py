@@ -0,0 +1,134 @@
+import time
+import math
+import logging
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+# PreAlignment
+#
+# Pre-alinhamento grosseiro por correlacao de fase (FFT) em copias
+# reduzidas dos volumes. A translacao estimada e' passada ao BRAINSFit como
+# initialTransform, para que o registro nao comece do zero quando a cabeca
+# foi posicionada de forma muito diferente no exame de seguimento.
+
+def hannWindow(shape):
+    "Janela de Hann separavel, reduz as bordas antes da FFT"
+    window = numpy.ones(shape, dtype=numpy.float32)
+    for axis, size in enumerate(shape):
+        profile = numpy.hanning(size).astype(numpy.float32) if size > 1 else numpy.ones(1, dtype=numpy.float32)
+        window *= profile.reshape([size if a == axis else 1 for a in range(len(shape))])
+    return window
+
+def phaseCorrelation(fixed, moving):
+    """Deslocamento (k, j, i) em voxels tal que fixed(x) ~ moving(x - deslocamento).
+
+    Retorna tambem a nitidez do pico (altura do pico dividida pelo desvio
+    padrao da superficie de correlacao), usada para descartar estimativas
+    sem um pico claro. O pico e' refinado com uma parabola em cada eixo.
+    """
+    window = hannWindow(fixed.shape)
+    fixedSpectrum = numpy.fft.rfftn((fixed - fixed.mean()) * window)
+    movingSpectrum = numpy.fft.rfftn((moving - moving.mean()) * window)
+    crossPower = fixedSpectrum * numpy.conj(movingSpectrum)
+    crossPower /= numpy.abs(crossPower) + 1e-12
+    correlation = numpy.fft.irfftn(crossPower, fixed.shape)
+
+    peak = numpy.unravel_index(numpy.argmax(correlation), correlation.shape)
+    sharpness = correlation[peak] / (correlation.std() or 1.0)
+    shift = []
+    for axis, size in enumerate(correlation.shape):
+        before = list(peak); before[axis] = (peak[axis] - 1) % size
+        after = list(peak); after[axis] = (peak[axis] + 1) % size
+        y0, y1, y2 = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+        denominator = y0 - 2 * y1 + y2
+        offset = 0.5 * (y0 - y2) / denominator if size > 2 and denominator < 0 else 0.0
+        position = peak[axis] + offset
+        # Deslocamentos acima da metade do tamanho sao negativos (periodicidade da FFT)
+        if position > size / 2.0:
+            position -= size
+        shift.append(position)
+    return tuple(shift), sharpness
+
+def coarseArray(volumeNode, referenceNode, factor):
+    """Volume reamostrado (float32, k, j, i) na grade de referenceNode reduzida por factor.
+
+    Os dois volumes de um par sao reamostrados na mesma grade, entao
+    geometrias diferentes (origem, orientacao, resolucao) nao atrapalham a
+    correlacao.
+    """
+    referenceIJKToRAS = vtk.vtkMatrix4x4()
+    referenceNode.GetIJKToRASMatrix(referenceIJKToRAS)
+    rasToIJK = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIJK)
+    resliceAxes = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(rasToIJK, referenceIJKToRAS, resliceAxes)
+
+    dimensions = referenceNode.GetImageData().GetDimensions()
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(volumeNode.GetImageData())
+    reslice.SetResliceAxes(resliceAxes)
+    reslice.SetInterpolationModeToLinear()
+    reslice.SetOutputScalarType(vtk.VTK_FLOAT)
+    reslice.SetOutputOrigin(0, 0, 0)
+    reslice.SetOutputSpacing(factor, factor, factor)
+    reslice.SetOutputExtent(0, max(1, dimensions[0] // factor) - 1, 0, max(1, dimensions[1] // factor) - 1,
+        0, max(1, dimensions[2] // factor) - 1)
+    reslice.Update()
+    output = reslice.GetOutput()
+    i, j, k = output.GetDimensions()
+    return numpy_support.vtk_to_numpy(output.GetPointData().GetScalars()).reshape(k, j, i)
+
+class PreAligner(object):
+    """Estima a translacao entre o volume fixo e cada volume movel.
+
+    A copia reduzida do volume fixo e' reaproveitada entre os registros
+    enquanto a imagem nao mudar. initialTransform() cria o no' de
+    transformacao a ser passado ao BRAINSFit, ou retorna None se a
+    correlacao nao tiver um pico claro.
+    """
+
+    # Tamanho aproximado da maior dimensao das copias reduzidas
+    coarseSize = 64
+    # Nitidez minima do pico de correlacao
+    minimumSharpness = 5.0
+
+    def __init__(self):
+        self.fixedArrays = {}
+
+    def factor(self, volumeNode):
+        return max(1, int(math.ceil(max(volumeNode.GetImageData().GetDimensions()) / float(self.coarseSize))))
+
+    def fixedArray(self, fixedVolume, factor):
+        key = (fixedVolume.GetID(), fixedVolume.GetImageData().GetMTime(), factor)
+        if key not in self.fixedArrays:
+            self.fixedArrays = {key: coarseArray(fixedVolume, fixedVolume, factor)}
+        return self.fixedArrays[key]
+
+    def translation(self, fixedVolume, movingVolume):
+        "Translacao RAS (do movel para o fixo) e nitidez do pico"
+        factor = self.factor(fixedVolume)
+        fixed = self.fixedArray(fixedVolume, factor)
+        moving = coarseArray(movingVolume, fixedVolume, factor)
+        (sk, sj, si), sharpness = phaseCorrelation(fixed, moving)
+        # Voxels da grade reduzida -> IJK do volume fixo -> RAS (apenas a parte linear)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        fixedVolume.GetIJKToRASMatrix(ijkToRAS)
+        shift = [si * factor, sj * factor, sk * factor]
+        translation = [sum(ijkToRAS.GetElement(row, column) * shift[column] for column in range(3)) for row in range(3)]
+        return translation, sharpness
+
+    def initialTransform(self, fixedVolume, movingVolume, name):
+        "No' de transformacao linear com a translacao estimada, ou None"
+        start = time.time()
+        translation, sharpness = self.translation(fixedVolume, movingVolume)
+        logging.info('Pre-alinhamento %s: translacao %s mm, nitidez %.1f, %.2f s' % (name,
+            ', '.join('%.1f' % value for value in translation), sharpness, time.time() - start))
+        if sharpness < self.minimumSharpness:
+            logging.warning('Pre-alinhamento sem pico claro, ignorado: ' + name)
+            return None
+        transform = vtk.vtkTransform()
+        transform.Translate(translation)
+        transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', name + ' Pre-alinhamento')
+        transformNode.SetMatrixTransformToParent(transform.GetMatrix())
+        return transformNode
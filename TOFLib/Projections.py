@@ -0,0 +1,109 @@
+import os
+import logging
+import collections
+import multiprocessing.pool
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+from TOFLib import Kernels
+
+# Projections
+#
+# MIPs calculadas na CPU (numpy), gravadas em PNG para revisar rapidamente
+# todos os volumes de subtracao, sem volume rendering. As vistas supoem
+# exames adquiridos em axial (k = inferior -> superior).
+
+VIEWS = ['axial', 'coronal', 'sagittal']
+
+def defaultDirectory():
+    return os.path.join(slicer.app.temporaryPath, 'TOFUtils', 'MIP')
+
+def labelBounds(labelArray, margin=0):
+    "Caixa ((k0, k1), (j0, j1), (i0, i1)) dos voxels nao nulos de um label, ou None se vazio"
+    bounds = []
+    for axis, size in enumerate(labelArray.shape):
+        others = tuple(a for a in range(labelArray.ndim) if a != axis)
+        indexes = numpy.flatnonzero(labelArray.any(axis=others))
+        if not len(indexes):
+            return None
+        bounds.append((max(0, int(indexes[0]) - margin), min(size, int(indexes[-1]) + 1 + margin)))
+    return tuple(bounds)
+
+def projections(array, bounds=None):
+    "MIPs axial, coronal e sagital de um array (k, j, i)"
+    return dict(zip(VIEWS, Kernels.maximumProjections(array, bounds)))
+
+def aspectRatios(spacing):
+    "Altura/largura fisica de um pixel de cada vista, a partir do espacamento (i, j, k)"
+    si, sj, sk = spacing
+    return {'axial': sj / si, 'coronal': sk / si, 'sagittal': sk / sj}
+
+def toImage(projection, upper):
+    "Projecao em uint8, janela 0..upper"
+    return numpy.clip(projection.astype(numpy.float32) * (255.0 / upper), 0, 255).astype(numpy.uint8)
+
+def writePNG(image, path, flip=False):
+    "Grava uma imagem uint8 (linhas, colunas); o vtkPNGWriter poe a linha 0 embaixo"
+    if flip:
+        image = image[::-1]
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(image.shape[1], image.shape[0], 1)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(image).ravel(), deep=True))
+    writer = vtk.vtkPNGWriter()
+    writer.SetInputData(imageData)
+    writer.SetFileName(path)
+    writer.Write()
+
+class ProjectionCache(object):
+    """MIPs dos volumes de subtracao em arquivos PNG.
+
+    compute() calcula as tres vistas de todos os volumes em um pool de
+    threads (as reducoes do numpy liberam o GIL) e grava os PNGs com a
+    mesma janela por vista, para que exames diferentes sejam comparaveis.
+    entries guarda, por id do volume, o nome, os arquivos e a proporcao
+    dos pixels de cada vista.
+    """
+
+    percentile = 99.5
+
+    def __init__(self, directory=None, threads=None):
+        self.directory = directory
+        self.threads = threads
+        self.entries = collections.OrderedDict()
+
+    def compute(self, volumeNodes, bounds=None):
+        "Calcula e grava as MIPs dos volumes; bounds limita as projecoes a uma caixa (ROI ou slab)"
+        volumeNodes = [node for node in volumeNodes if node]
+        if not volumeNodes:
+            return self.entries
+        directory = self.directory or defaultDirectory()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        arrays = [slicer.util.arrayFromVolume(node) for node in volumeNodes]
+        pool = multiprocessing.pool.ThreadPool(min(len(arrays), self.threads or Kernels.defaultThreads()))
+        try:
+            results = pool.map(lambda array: projections(array, bounds), arrays)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Janela comum por vista: o maior percentil entre os volumes
+        upper = {}
+        for view in VIEWS:
+            upper[view] = max(numpy.percentile(result[view], self.percentile) for result in results) or 1.0
+
+        for node, result in zip(volumeNodes, results):
+            paths = {}
+            for view in VIEWS:
+                # Coronal e sagital: k cresce para cima (superior no topo); axial: anterior (j = 0) no topo
+                path = os.path.join(directory, '%s-%s.png' % (node.GetID(), view))
+                writePNG(toImage(result[view], upper[view]), path, flip=(view == 'axial'))
+                paths[view] = path
+            self.entries[node.GetID()] = {'name': node.GetName(), 'paths': paths, 'aspect': aspectRatios(node.GetSpacing())}
+            logging.info('MIP gravada: ' + node.GetName())
+        return self.entries
+
+    def path(self, volumeID, view):
+        return self.entries[volumeID]['paths'][view]
@@ -0,0 +1,236 @@
+import math
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+from TOFLib.Projections import labelBounds
+
+# ROIUtils
+
+def roiCornersRAS(roiNode, padding=0.0):
+    "Os 8 cantos da ROI, aumentada de padding mm em cada lado, em coordenadas do mundo (RAS)"
+    center = [0.0, 0.0, 0.0]
+    radius = [0.0, 0.0, 0.0]
+    roiNode.GetXYZ(center)
+    roiNode.GetRadiusXYZ(radius)
+    radius = [r + padding for r in radius]
+    roiToWorld = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(roiNode.GetParentTransformNode(), None, roiToWorld)
+    corners = []
+    for sr in (-1, 1):
+        for sa in (-1, 1):
+            for ss in (-1, 1):
+                point = [center[0] + sr*radius[0], center[1] + sa*radius[1], center[2] + ss*radius[2], 1.0]
+                corners.append(roiToWorld.MultiplyPoint(point)[:3])
+    return corners
+
+def worldToIJKMatrix(volumeNode):
+    "Matriz mundo (RAS) -> IJK do volume, com a transformacao pai"
+    worldToRAS = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(None, volumeNode.GetParentTransformNode(), worldToRAS)
+    rasToIJK = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIJK)
+    worldToIJK = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(rasToIJK, worldToRAS, worldToIJK)
+    return worldToIJK
+
+def roiIJKCorners(roiNode, volumeNode, padding=0.0):
+    "Os 8 cantos da ROI em coordenadas IJK (continuas) do volume"
+    worldToIJK = worldToIJKMatrix(volumeNode)
+    return [worldToIJK.MultiplyPoint(list(corner) + [1.0])[:3] for corner in roiCornersRAS(roiNode, padding)]
+
+def roiIJKBounds(roiNode, volumeNode, margin=1, padding=0.0):
+    """Sub-bloco do volume que contem a ROI, em indices do array NumPy.
+
+    Retorna ((k0, k1), (j0, j1), (i0, i1)) ja limitado as dimensoes do volume,
+    com margin voxels extras em cada lado para a interpolacao do crop, ou
+    None se a ROI nao intercepta o volume. padding aumenta a ROI em mm.
+    """
+    ijkCorners = roiIJKCorners(roiNode, volumeNode, padding)
+    dims = volumeNode.GetImageData().GetDimensions()
+    bounds = []
+    for axis in range(3):
+        values = [corner[axis] for corner in ijkCorners]
+        lo = max(0, int(math.floor(min(values))) - margin)
+        hi = min(dims[axis], int(math.ceil(max(values))) + margin + 1)
+        if lo >= hi:
+            return None
+        bounds.append((lo, hi))
+    # IJK -> ordem do array (k, j, i)
+    return tuple(reversed(bounds))
+
+class CropView(object):
+    """Recorte sem copia de um volume por uma ROI alinhada com a grade.
+
+    array e' uma view do array do volume (alterar array altera o volume) e
+    ijkToRAS a geometria do recorte, com a origem no primeiro voxel.
+    """
+
+    def __init__(self, volumeNode, bounds):
+        (k0, k1), (j0, j1), (i0, i1) = bounds
+        self.volumeNode = volumeNode
+        self.bounds = bounds
+        self.array = slicer.util.arrayFromVolume(volumeNode)[k0:k1, j0:j1, i0:i1]
+        self.ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(self.ijkToRAS)
+        origin = self.ijkToRAS.MultiplyPoint([i0, j0, k0, 1.0])
+        for row in range(3):
+            self.ijkToRAS.SetElement(row, 3, origin[row])
+
+    def createLabelVolume(self, name):
+        "Label map vazio com a grade do recorte (no lugar do CreateAndAddLabelVolume)"
+        labelMap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', name)
+        labelMap.SetIJKToRASMatrix(self.ijkToRAS)
+        slicer.util.updateVolumeFromArray(labelMap, numpy.zeros(self.array.shape, dtype=numpy.int16))
+        labelMap.CreateDefaultDisplayNodes()
+        labelMap.SetAndObserveTransformNodeID(self.volumeNode.GetTransformNodeID())
+        return labelMap
+
+def cropView(roiNode, volumeNode, tolerance=1e-3):
+    """CropView dos voxels cujos centros estao dentro da ROI, ou None.
+
+    So' e' possivel quando as faces da ROI sao paralelas aos eixos IJK do
+    volume (cada coordenada IJK dos cantos assume apenas dois valores);
+    caso contrario o chamador deve usar o CropInterpolated.
+    """
+    ijkCorners = roiIJKCorners(roiNode, volumeNode)
+    dims = volumeNode.GetImageData().GetDimensions()
+    bounds = []
+    for axis in range(3):
+        values = [corner[axis] for corner in ijkCorners]
+        lo, hi = min(values), max(values)
+        if any(min(abs(value - lo), abs(value - hi)) > tolerance for value in values):
+            return None
+        lo = max(0, int(math.ceil(lo - tolerance)))
+        hi = min(dims[axis], int(math.floor(hi + tolerance)) + 1)
+        if lo >= hi:
+            return None
+        bounds.append((lo, hi))
+    return CropView(volumeNode, tuple(reversed(bounds)))
+
+def subVolume(volumeNode, bounds, name):
+    """Novo volume escalar com uma copia do sub-bloco bounds ((k0, k1), (j0, j1), (i0, i1)).
+
+    A geometria (espacamento, direcoes e transformacao pai) e' a do volume
+    original, com a origem movida para o primeiro voxel do sub-bloco.
+    """
+    view = CropView(volumeNode, bounds)
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    outputVolume.SetIJKToRASMatrix(view.ijkToRAS)
+    slicer.util.updateVolumeFromArray(outputVolume, numpy.ascontiguousarray(view.array))
+    outputVolume.SetAndObserveTransformNodeID(volumeNode.GetTransformNodeID())
+    return outputVolume
+
+def resampledMean(volumeNode, referenceNode, transformNode=None, slabSize=16):
+    """Media de volumeNode reamostrado (linear) na grade inteira de referenceNode, sem criar o volume.
+
+    transformNode e' a transformacao do registro (ex.: a saida linearTransform
+    do BRAINSFit): a inversa dela leva a grade de referencia ao volume.
+    Voxels da grade fora de volumeNode contam como 0, como no volume que a
+    CLI reamostraria. O reslice e' feito em fatias de slabSize cortes, entao
+    a memoria extra e' pequena.
+    """
+    referenceIJKToRAS = vtk.vtkMatrix4x4()
+    referenceNode.GetIJKToRASMatrix(referenceIJKToRAS)
+    fromParent = vtk.vtkMatrix4x4()
+    if transformNode:
+        transformNode.GetMatrixTransformFromParent(fromParent)
+    rasToIJK = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIJK)
+    referenceIJKToMovingRAS = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(fromParent, referenceIJKToRAS, referenceIJKToMovingRAS)
+    resliceAxes = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(rasToIJK, referenceIJKToMovingRAS, resliceAxes)
+
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(volumeNode.GetImageData())
+    reslice.SetResliceAxes(resliceAxes)
+    reslice.SetInterpolationModeToLinear()
+    reslice.SetOutputScalarType(vtk.VTK_FLOAT)
+    reslice.SetBackgroundLevel(0)
+    reslice.SetOutputOrigin(0, 0, 0)
+    reslice.SetOutputSpacing(1, 1, 1)
+    dimensions = referenceNode.GetImageData().GetDimensions()
+    total = 0.0
+    for k in range(0, dimensions[2], slabSize):
+        reslice.SetOutputExtent(0, dimensions[0] - 1, 0, dimensions[1] - 1, k, min(k + slabSize, dimensions[2]) - 1)
+        reslice.Update()
+        total += numpy_support.vtk_to_numpy(reslice.GetOutput().GetPointData().GetScalars()).sum(dtype=numpy.float64)
+    return total / (dimensions[0] * dimensions[1] * dimensions[2])
+
+def connectedBounds(array, seed, threshold):
+    """Caixa ((k0, k1), (j0, j1), (i0, i1)) da regiao de voxels >= threshold conectada ao seed (k, j, i).
+
+    Crescimento de regiao (6-vizinhos) do vtkImageThresholdConnectivity em
+    uma copia do array; retorna None se o seed estiver abaixo do limiar.
+    """
+    if array[seed] < threshold:
+        return None
+    block = numpy.ascontiguousarray(array)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(block.shape[2], block.shape[1], block.shape[0])
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(block.reshape(-1), deep=False))
+    seeds = vtk.vtkPoints()
+    seeds.InsertNextPoint(seed[2], seed[1], seed[0])
+    connectivity = vtk.vtkImageThresholdConnectivity()
+    connectivity.SetInputData(imageData)
+    connectivity.SetSeedPoints(seeds)
+    connectivity.ThresholdByUpper(float(threshold))
+    connectivity.ReplaceInOn()
+    connectivity.SetInValue(1)
+    connectivity.ReplaceOutOn()
+    connectivity.SetOutValue(0)
+    connectivity.Update()
+    region = numpy_support.vtk_to_numpy(connectivity.GetOutput().GetPointData().GetScalars()).reshape(block.shape)
+    return labelBounds(region)
+
+def tightROIBox(volumeNode, seedRAS, searchRadius, perc, seedRadius=3.0, padding=5.0):
+    """Centro e raios (mundo, mm) da menor caixa em volta da estrutura brilhante do ponto seedRAS.
+
+    Procura apenas a ate' searchRadius mm do ponto: o seed e' o voxel mais
+    intenso a ate' seedRadius mm dele, o limiar e' max - (max-min)*perc da
+    regiao de busca (como em Kernels.thresholdLabel) e a regiao conectada
+    ao seed, aumentada de padding mm, define a caixa. Retorna None se o
+    ponto estiver fora do volume ou nao houver estrutura acima do limiar.
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    spacing = [math.sqrt(sum(ijkToRAS.GetElement(row, axis) ** 2 for row in range(3))) for axis in range(3)]
+    seedIJK = worldToIJKMatrix(volumeNode).MultiplyPoint(list(seedRAS) + [1.0])[:3]
+    dims = volumeNode.GetImageData().GetDimensions()
+
+    def box(radius):
+        "Sub-bloco (k, j, i) a ate' radius mm do ponto, limitado ao volume"
+        bounds = []
+        for axis in range(3):
+            voxels = int(math.ceil(radius / spacing[axis]))
+            center = int(round(seedIJK[axis]))
+            lo, hi = max(0, center - voxels), min(dims[axis], center + voxels + 1)
+            if lo >= hi:
+                return None
+            bounds.append((lo, hi))
+        return tuple(reversed(bounds))
+
+    searchBounds = box(searchRadius)
+    seedBounds = box(seedRadius)
+    if not searchBounds or not seedBounds:
+        return None
+    array = slicer.util.arrayFromVolume(volumeNode)
+    search = array[tuple(slice(lo, hi) for lo, hi in searchBounds)]
+    seedBlock = array[tuple(slice(lo, hi) for lo, hi in seedBounds)]
+    seed = numpy.unravel_index(numpy.argmax(seedBlock), seedBlock.shape)
+    seed = tuple(int(index + seedLo - searchLo) for index, (seedLo, _), (searchLo, _) in zip(seed, seedBounds, searchBounds))
+    minimum, maximum = float(search.min()), float(search.max())
+    bounds = connectedBounds(search, seed, maximum - (maximum - minimum) * perc)
+    if not bounds:
+        return None
+
+    # Cantos da caixa (bordas dos voxels) no mundo
+    toWorld = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(volumeNode.GetParentTransformNode(), None, toWorld)
+    vtk.vtkMatrix4x4.Multiply4x4(toWorld, ijkToRAS, toWorld)
+    (k0, k1), (j0, j1), (i0, i1) = [(lo + offset - 0.5, hi + offset - 0.5) for (lo, hi), (offset, _) in zip(bounds, searchBounds)]
+    corners = numpy.array([toWorld.MultiplyPoint([i, j, k, 1.0])[:3] for i in (i0, i1) for j in (j0, j1) for k in (k0, k1)])
+    lo = corners.min(axis=0) - padding
+    hi = corners.max(axis=0) + padding
+    return ((lo + hi) / 2.0).tolist(), ((hi - lo) / 2.0).tolist()
@@ -0,0 +1,217 @@
+import time
+import logging
+import multiprocessing
+import qt, slicer
+
+from TOFLib.Worker import Cancelled
+
+# RegistrationScheduler
+
+def defaultMaxConcurrent():
+    "Numero padrao de registros simultaneos para a maquina atual"
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return max(1, min(4, cpus // 2))
+
+class RegistrationJob(object):
+    "Um registro BRAINSFit pendente, em execucao ou terminado"
+
+    def __init__(self, fixedVolume, movingVolume, outputVolume, onCompleted, parameters, preAlignVolume=None, keepTransform=False):
+        self.fixedVolume = fixedVolume
+        # Volume fixo usado no pre-alinhamento (o volume inteiro quando fixedVolume e' um recorte)
+        self.preAlignVolume = preAlignVolume or fixedVolume
+        self.movingVolume = movingVolume
+        self.outputVolume = outputVolume
+        self.onCompleted = onCompleted
+        self.parameters = parameters
+        self.cliNode = None
+        self.observerTag = None
+        self.succeeded = False
+        self.cacheKey = None
+        self.cacheHit = False
+        # Com keepTransform a transformacao do registro fica em transformNode ate o fim do callback
+        self.keepTransform = keepTransform
+        self.transformNode = None
+        self.initialTransformNode = None
+        self.preAlignTime = None
+        self.startTime = None
+        self.endTime = None
+
+    def stageName(self):
+        "Nome da etapa para a instrumentacao"
+        return 'reamostragem (cache)' if self.cacheHit else 'registro'
+
+    def elapsed(self):
+        "Duracao da CLI em segundos (0 se nao terminou)"
+        if self.startTime is None or self.endTime is None:
+            return 0.0
+        return self.endTime - self.startTime
+
+class RegistrationScheduler(object):
+    """Executa ate maxConcurrent registros BRAINSFit ao mesmo tempo.
+
+    O termino de cada CLI e' detectado pelo StatusModifiedEvent do no' da CLI
+    (sem laco de processEvents) e o volume registrado e' repassado ao
+    callback onCompleted(job) assim que fica pronto. Os callbacks sao
+    executados um de cada vez, na thread principal.
+
+    Com um TransformCache, registros ja calculados sao substituidos apenas
+    pelo BRAINSResample com a transformacao salva.
+
+    Com um PreAligner, a translacao estimada por correlacao de fase e'
+    passada ao BRAINSFit como initialTransform.
+
+    cancel() (ou um callback que levante Cancelled, ou o cancelamento do
+    Progress dado) descarta os registros pendentes, cancela as CLIs em
+    execucao e faz wait() retornar sem chamar os callbacks restantes.
+
+    Com keepTransform=True em addRegistration, a transformacao rigida
+    (fixo -> movel) fica disponivel em job.transformNode durante o callback
+    e e' removida da cena logo depois.
+    """
+
+    def __init__(self, maxConcurrent=None, transformCache=None, preAligner=None, progress=None):
+        self.maxConcurrent = maxConcurrent or defaultMaxConcurrent()
+        self.transformCache = transformCache
+        self.preAligner = preAligner
+        self.cancelled = False
+        if progress:
+            progress.cancelListeners.append(self.cancel)
+        self.pending = []
+        self.running = []
+        self.completed = []
+        self.dispatching = False
+        self.eventLoop = None
+
+    def addRegistration(self, fixedVolume, movingVolume, outputVolume, onCompleted=None, parameters=None, preAlignVolume=None,
+        keepTransform=False):
+        """Agenda o registro rigido de movingVolume em fixedVolume, resultado em outputVolume.
+
+        outputVolume tem a grade de fixedVolume: com um recorte do volume fixo
+        apenas a vizinhanca dele e' registrada e reamostrada.
+        """
+        brainsfitParameters = {'fixedVolume': fixedVolume.GetID(), 'movingVolume': movingVolume.GetID(), 'outputVolume': outputVolume.GetID(), 'useRigid': True}
+        # Divide os nucleos entre os registros simultaneos
+        try:
+            brainsfitParameters['numberOfThreads'] = max(1, multiprocessing.cpu_count() // self.maxConcurrent)
+        except NotImplementedError:
+            pass
+        if parameters:
+            brainsfitParameters.update(parameters)
+        job = RegistrationJob(fixedVolume, movingVolume, outputVolume, onCompleted, brainsfitParameters, preAlignVolume, keepTransform)
+        self.pending.append(job)
+        return job
+
+    def isFinished(self):
+        return not self.pending and not self.running and not self.completed and not self.dispatching
+
+    def start(self):
+        "Inicia os registros pendentes respeitando o limite de concorrencia"
+        while not self.cancelled and self.pending and len(self.running) < self.maxConcurrent:
+            self.launch(self.pending.pop(0))
+        self.quitIfFinished()
+
+    def wait(self):
+        "Bloqueia (mantendo a interface ativa) ate todos os registros e callbacks terminarem"
+        self.start()
+        if self.isFinished():
+            return
+        self.eventLoop = qt.QEventLoop()
+        self.eventLoop.exec_()
+        self.eventLoop = None
+
+    def cancel(self):
+        "Descarta os registros pendentes e cancela as CLIs em execucao"
+        if self.cancelled:
+            return
+        logging.info('Cancelando os registros')
+        self.cancelled = True
+        self.pending = []
+        for job in list(self.running):
+            job.cliNode.Cancel()
+        self.quitIfFinished()
+
+    def launch(self, job):
+        if self.transformCache:
+            job.cacheKey = self.transformCache.key(job.fixedVolume, job.movingVolume, job.parameters)
+            job.transformNode = self.transformCache.load(job.cacheKey)
+            job.cacheHit = job.transformNode is not None
+
+        if self.preAligner and not job.cacheHit:
+            start = time.time()
+            try:
+                job.initialTransformNode = self.preAligner.initialTransform(job.preAlignVolume, job.movingVolume, job.outputVolume.GetName())
+            except Exception:
+                logging.exception('Falha no pre-alinhamento: ' + job.outputVolume.GetName())
+            job.preAlignTime = time.time() - start
+            if job.initialTransformNode:
+                job.parameters['initialTransform'] = job.initialTransformNode.GetID()
+
+        job.startTime = time.time()
+        if job.cacheHit:
+            logging.info('Registro em cache, reamostrando: ' + job.outputVolume.GetName())
+            resampleParameters = {'inputVolume': job.movingVolume.GetID(), 'referenceVolume': job.fixedVolume.GetID(),
+                'outputVolume': job.outputVolume.GetID(), 'warpTransform': job.transformNode.GetID(), 'interpolationMode': 'Linear'}
+            job.cliNode = slicer.cli.run(slicer.modules.brainsresample, None, resampleParameters)
+        else:
+            logging.info('Registrando: ' + job.outputVolume.GetName())
+            if self.transformCache or job.keepTransform:
+                job.transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', job.outputVolume.GetName() + ' Transform')
+                job.parameters['linearTransform'] = job.transformNode.GetID()
+            job.cliNode = slicer.cli.run(slicer.modules.brainsfit, None, job.parameters)
+        job.observerTag = job.cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent,
+            lambda caller, event, job=job: self.onStatusModified(job))
+        self.running.append(job)
+        # A CLI pode ter terminado antes do observador ser adicionado
+        self.onStatusModified(job)
+
+    def onStatusModified(self, job):
+        if job not in self.running or job.cliNode.IsBusy():
+            return
+        job.cliNode.RemoveObserver(job.observerTag)
+        job.endTime = time.time()
+        job.succeeded = job.cliNode.GetStatus() == job.cliNode.Completed
+        if not job.succeeded:
+            logging.error('Registro falhou: ' + job.outputVolume.GetName() + ' (' + job.cliNode.GetStatusString() + ')')
+        elif self.transformCache and not job.cacheHit:
+            self.transformCache.store(job.cacheKey, job.transformNode)
+        if job.transformNode and not (job.succeeded and job.keepTransform):
+            slicer.mrmlScene.RemoveNode(job.transformNode)
+            job.transformNode = None
+        if job.initialTransformNode:
+            slicer.mrmlScene.RemoveNode(job.initialTransformNode)
+            job.initialTransformNode = None
+        self.running.remove(job)
+        self.completed.append(job)
+        # Libera a vaga antes de processar o resultado
+        self.start()
+        self.dispatch()
+
+    def dispatch(self):
+        # Evita reentrada: etapas seguintes podem chamar processEvents
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.completed:
+                job = self.completed.pop(0)
+                try:
+                    if job.onCompleted and not self.cancelled:
+                        job.onCompleted(job)
+                except Cancelled:
+                    self.cancel()
+                except Exception:
+                    logging.exception('Falha ao processar: ' + job.outputVolume.GetName())
+                finally:
+                    if job.transformNode:
+                        slicer.mrmlScene.RemoveNode(job.transformNode)
+                        job.transformNode = None
+        finally:
+            self.dispatching = False
+            self.quitIfFinished()
+
+    def quitIfFinished(self):
+        if self.eventLoop and self.isFinished():
+            self.eventLoop.quit()
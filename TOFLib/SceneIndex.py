@@ -0,0 +1,138 @@
+import collections
+import vtk, slicer
+
+# SceneIndex
+
+class SceneIndex(object):
+    """Indice da cena por ID de no', mantido pelos eventos NodeAdded/NodeRemoved.
+
+    Guarda, na ordem da cena, os volumes escalares e os modelos, e a relacao
+    entre cada no' derivado e o no' de origem (volume -> volume registrado,
+    label map, subtracao; label map -> modelo). A relacao tambem e' gravada
+    como atributos do no' derivado (TOF.SourceID, TOF.Role), entao ela e'
+    refeita quando uma cena salva e' carregada.
+    """
+
+    sourceAttribute = 'TOF.SourceID'
+    roleAttribute = 'TOF.Role'
+
+    def __init__(self):
+        self.volumes = collections.OrderedDict()
+        self.models = collections.OrderedDict()
+        # ID de origem -> {papel: [IDs derivados]}
+        self.derivedIDs = {}
+        # ID derivado -> (ID de origem, papel)
+        self.sourceIDs = {}
+        self.sceneObserverTags = [
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded),
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, lambda caller, event: self.rebuild()),
+            # IDs podem ser renomeados na importacao
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndImportEvent, lambda caller, event: self.rebuild()),
+            ]
+        self.rebuild()
+
+    def rebuild(self):
+        "Refaz o indice a partir da cena"
+        self.volumes.clear()
+        self.models.clear()
+        self.derivedIDs = {}
+        self.sourceIDs = {}
+        for index in range(slicer.mrmlScene.GetNumberOfNodes()):
+            self.add(slicer.mrmlScene.GetNthNode(index))
+
+    def add(self, node):
+        if node.IsA('vtkMRMLScalarVolumeNode'):
+            self.volumes[node.GetID()] = node
+        elif node.IsA('vtkMRMLModelNode'):
+            self.models[node.GetID()] = node
+        sourceID = node.GetAttribute(self.sourceAttribute)
+        if sourceID:
+            self.addLink(sourceID, node.GetID(), node.GetAttribute(self.roleAttribute))
+
+    def addLink(self, sourceID, derivedID, role):
+        self.sourceIDs[derivedID] = (sourceID, role)
+        self.derivedIDs.setdefault(sourceID, {}).setdefault(role, []).append(derivedID)
+
+    def removeLink(self, derivedID):
+        if derivedID not in self.sourceIDs:
+            return
+        sourceID, role = self.sourceIDs.pop(derivedID)
+        roles = self.derivedIDs.get(sourceID, {})
+        if derivedID in roles.get(role, []):
+            roles[role].remove(derivedID)
+
+    def remove(self, nodeID):
+        self.volumes.pop(nodeID, None)
+        self.models.pop(nodeID, None)
+        self.removeLink(nodeID)
+        for derivedIDs in self.derivedIDs.pop(nodeID, {}).values():
+            for derivedID in derivedIDs:
+                self.sourceIDs.pop(derivedID, None)
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeAdded(self, caller, event, node):
+        self.add(node)
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        self.remove(node.GetID())
+
+    def link(self, sourceNode, derivedNode, role):
+        "Registra derivedNode (ja na cena) como resultado de sourceNode com o papel dado"
+        self.removeLink(derivedNode.GetID())
+        derivedNode.SetAttribute(self.sourceAttribute, sourceNode.GetID())
+        derivedNode.SetAttribute(self.roleAttribute, role)
+        self.addLink(sourceNode.GetID(), derivedNode.GetID(), role)
+
+    def node(self, nodeID):
+        return slicer.mrmlScene.GetNodeByID(nodeID) if nodeID else None
+
+    def source(self, node):
+        "No' de origem de um no' derivado, ou None"
+        sourceID, role = self.sourceIDs.get(node.GetID(), (None, None))
+        return self.node(sourceID)
+
+    def role(self, node):
+        return self.sourceIDs.get(node.GetID(), (None, None))[1]
+
+    def derived(self, node, role=None):
+        "Nos derivados de node (de um papel ou de todos), na ordem em que foram registrados"
+        roles = self.derivedIDs.get(node.GetID(), {})
+        derivedIDs = roles.get(role, []) if role else [derivedID for ids in roles.values() for derivedID in ids]
+        return [self.node(derivedID) for derivedID in derivedIDs]
+
+    def scalarVolumes(self):
+        "Volumes escalares (incluindo label maps) na ordem da cena"
+        return list(self.volumes.values())
+
+    def modelNodes(self):
+        return list(self.models.values())
+
+    def modelForLabelMap(self, labelMap):
+        """Modelo gerado a partir do label map.
+
+        Label maps criados sob demanda (LabelStore) usam o modelo ligado ao
+        exame de origem. Modelos sem o vinculo (cenas antigas, ModelMaker) sao
+        procurados pelo nome, como antes: o primeiro modelo cujo nome contem o
+        do label map.
+        """
+        models = self.derived(labelMap, 'model')
+        source = self.source(labelMap)
+        if not models and source:
+            models = self.derived(source, 'model')
+        if models:
+            return models[-1]
+        for model in self.models.values():
+            if labelMap.GetName() in model.GetName():
+                return model
+        return None
+
+_sceneIndex = None
+
+def sceneIndex():
+    "Indice unico, compartilhado pelos modulos TOF"
+    global _sceneIndex
+    if _sceneIndex is None:
+        _sceneIndex = SceneIndex()
+    return _sceneIndex
@@ -0,0 +1,155 @@
+import time
+import logging
+import threading
+import multiprocessing.pool
+import vtk, slicer
+
+from TOFLib import Kernels
+from TOFLib.SceneIndex import sceneIndex
+from TOFLib.Worker import Notifier
+
+# SurfaceBuilder
+
+def surfaceFromLabel(imageData, ijkToRAS, labelValue, smoothing=10, decimation=0.25):
+    """Superficie (vtkPolyData em RAS) de um valor de label de uma imagem em IJK.
+
+    Usa discrete flying edges (ou discrete marching cubes nas versoes do VTK
+    que nao o tem), suavizacao windowed sinc e decimacao opcionais, como o
+    ModelMaker, mas dentro do processo e sem gravar o label em disco.
+    """
+    surfaceClass = getattr(vtk, 'vtkDiscreteFlyingEdges3D', None) or vtk.vtkDiscreteMarchingCubes
+    surface = surfaceClass()
+    surface.SetInputData(imageData)
+    surface.SetValue(0, labelValue)
+    surface.ComputeNormalsOff()
+    surface.ComputeGradientsOff()
+    output = surface.GetOutputPort()
+
+    if smoothing > 0:
+        smoother = vtk.vtkWindowedSincPolyDataFilter()
+        smoother.SetInputConnection(output)
+        smoother.SetNumberOfIterations(smoothing)
+        smoother.SetPassBand(0.1)
+        smoother.BoundarySmoothingOff()
+        smoother.FeatureEdgeSmoothingOff()
+        smoother.NonManifoldSmoothingOn()
+        smoother.NormalizeCoordinatesOn()
+        output = smoother.GetOutputPort()
+
+    if decimation > 0:
+        decimator = vtk.vtkDecimatePro()
+        decimator.SetInputConnection(output)
+        decimator.SetTargetReduction(decimation)
+        decimator.PreserveTopologyOn()
+        decimator.SplittingOff()
+        output = decimator.GetOutputPort()
+
+    # IJK -> RAS; com determinante negativo as normais precisam ser invertidas
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(ijkToRAS)
+    transformer = vtk.vtkTransformPolyDataFilter()
+    transformer.SetInputConnection(output)
+    transformer.SetTransform(transform)
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformer.GetOutputPort())
+    normals.SplittingOff()
+    normals.ConsistencyOn()
+    normals.SetFlipNormals(ijkToRAS.Determinant() < 0)
+    normals.Update()
+
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(normals.GetOutput())
+    return polyData
+
+def timedSurfaceFromLabel(*args):
+    "surfaceFromLabel e a duracao do calculo (na thread do pool)"
+    start = time.time()
+    polyData = surfaceFromLabel(*args)
+    return polyData, time.time() - start
+
+class SurfaceJob(object):
+    "Um modelo pedido ao SurfaceBuilder; source e' o no' ao qual o modelo fica ligado no indice da cena"
+
+    def __init__(self, source, labelValue, name, colorNode=None):
+        self.source = source
+        self.labelValue = labelValue
+        self.name = name
+        self.finished = threading.Event()
+        self.result = None
+        self.colorNode = colorNode
+        self.modelNode = None
+
+class SurfaceBuilder(object):
+    """Gera modelos 3D de label maps em um pool de threads, no lugar da CLI ModelMaker.
+
+    addLabelMap retorna imediatamente; a superficie e' calculada em uma
+    thread do pool e o no' do modelo e' criado na thread principal (quando
+    o Notifier avisa o termino, enquanto o processamento continua, ou em
+    wait()) e colocado sob o no' de hierarquia dado.
+    """
+
+    def __init__(self, hierarchyNode, smoothing=10, decimation=0.25, threads=None, profiler=None):
+        self.hierarchyNode = hierarchyNode
+        self.profiler = profiler
+        self.smoothing = smoothing
+        self.decimation = decimation
+        self.pool = multiprocessing.pool.ThreadPool(threads or Kernels.defaultThreads())
+        self.pending = []
+        self.notifier = Notifier(self.attachFinished)
+
+    def addLabelMap(self, labelMap, labelValue, name=None):
+        "Agenda o modelo do valor labelValue de labelMap"
+        # Copia da imagem: a thread nao deve ler um no' que a cena pode alterar
+        imageData = vtk.vtkImageData()
+        imageData.DeepCopy(labelMap.GetImageData())
+        ijkToRAS = vtk.vtkMatrix4x4()
+        labelMap.GetIJKToRASMatrix(ijkToRAS)
+        colorNode = labelMap.GetDisplayNode().GetColorNode() if labelMap.GetDisplayNode() else None
+        return self.addImage(imageData, ijkToRAS, labelValue, name or labelMap.GetName() + '-model', labelMap, colorNode)
+
+    def addImage(self, imageData, ijkToRAS, labelValue, name, source, colorNode=None):
+        "Agenda o modelo de uma imagem de labels sem no' (ex.: LabelStore); imageData nao deve mais ser alterada"
+        job = SurfaceJob(source, labelValue, name, colorNode)
+        job.result = self.pool.apply_async(self.notifier.wrap(timedSurfaceFromLabel, job.finished),
+            (imageData, ijkToRAS, labelValue, self.smoothing, self.decimation))
+        self.pending.append(job)
+        return job
+
+    def attachFinished(self):
+        "Cria os nos dos modelos ja calculados (thread principal)"
+        for job in [job for job in self.pending if job.finished.is_set()]:
+            self.pending.remove(job)
+            try:
+                polyData, elapsed = job.result.get()
+                if self.profiler:
+                    self.profiler.record('modelo 3D', job.source.GetName(), elapsed)
+                self.attach(job, polyData)
+            except Exception:
+                logging.exception('Falha ao gerar o modelo ' + job.name)
+
+    def attach(self, job, polyData):
+        modelNode = slicer.modules.models.logic().AddModel(polyData)
+        modelNode.SetName(job.name)
+        sceneIndex().link(job.source, modelNode, 'model')
+        displayNode = modelNode.GetDisplayNode()
+        if job.colorNode:
+            color = [0.0, 0.0, 0.0, 0.0]
+            job.colorNode.GetColor(job.labelValue, color)
+            displayNode.SetColor(color[:3])
+        displayNode.SetSliceIntersectionVisibility(True)
+
+        modelHierarchyNode = slicer.vtkMRMLModelHierarchyNode()
+        modelHierarchyNode.SetName(slicer.mrmlScene.GetUniqueNameByString(job.name + ' Hierarchy'))
+        slicer.mrmlScene.AddNode(modelHierarchyNode)
+        modelHierarchyNode.SetParentNodeID(self.hierarchyNode.GetID())
+        modelHierarchyNode.SetModelNodeID(modelNode.GetID())
+        job.modelNode = modelNode
+        logging.info('Modelo criado: ' + job.name)
+
+    def wait(self):
+        "Espera os modelos pendentes e encerra o pool"
+        self.pool.close()
+        self.pool.join()
+        self.attachFinished()
+        self.notifier.close()
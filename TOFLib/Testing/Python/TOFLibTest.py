@@ -0,0 +1,329 @@
+import unittest
+import numpy
+
+from TOFLib import Kernels
+from TOFLib.Benchmark import croppedBlock, legacyThresholdLabel, legacyNormalize, legacyIntegerNormalize, legacySubtraction
+from TOFLib.LongitudinalStack import LongitudinalStack
+
+try:
+  import vtk
+except ImportError:
+  vtk = None
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+#
+# Testes dos kernels NumPy do TOFLib contra as implementacoes originais
+# (TOFLib.Benchmark) em blocos pequenos. Os testes que usam nos MRML so'
+# rodam dentro do Slicer.
+#
+
+class KernelsTest(unittest.TestCase):
+
+  def test_thresholdLabel(self):
+    " Mesma quantidade, media e limiar da sequencia original; label nos voxels >= limiar "
+    block = croppedBlock((12, 40, 36))
+    legacyLabel = numpy.zeros(block.shape, dtype=numpy.int16)
+    legacy = legacyThresholdLabel(block, 0.75, legacyLabel, 3)
+    for slabVoxels in (Kernels.SLAB_VOXELS, 500):
+      label = numpy.zeros(block.shape, dtype=numpy.int16)
+      fused = Kernels.thresholdLabel(block, 0.75, label, 3, slabVoxels)
+      self.assertEqual(fused[0], legacy[0])
+      self.assertEqual(fused[1], legacy[1])
+      self.assertAlmostEqual(fused[2], legacy[2])
+      self.assertEqual(fused[3], legacy[3])
+      self.assertAlmostEqual(fused[4], legacy[4], places=6)
+      self.assertTrue(numpy.array_equal(label == 3, block >= legacy[2]))
+
+  def test_thresholdLabelFloat(self):
+    block = croppedBlock((10, 30, 30)).astype(numpy.float32) / 3.0
+    mask = numpy.zeros(block.shape, dtype=bool)
+    minimum, maximum, minValue, count, mean = Kernels.thresholdLabel(block, 0.5, mask, True, 700)
+    self.assertTrue(numpy.array_equal(mask, block >= minValue))
+    self.assertEqual(count, numpy.count_nonzero(block >= minValue))
+    self.assertAlmostEqual(mean, block[block >= minValue].mean(dtype=numpy.float64), places=4)
+
+  def test_normalizeInteger(self):
+    " Bit a bit igual a a[:] = a / factor; valores fora do tipo saturam em vez de dar a volta "
+    for dtype in (numpy.int16, numpy.uint8, numpy.uint16, numpy.int32):
+      info = numpy.iinfo(dtype)
+      block = croppedBlock((8, 24, 20)).clip(0, info.max).astype(dtype)
+      for factor in (1.07, 0.93, 0.4):
+        legacy = block.copy()
+        legacyIntegerNormalize(legacy, factor)
+        table = block.copy()
+        self.assertTrue(Kernels.normalizeInteger(table, factor))
+        inRange = numpy.divide(block, factor) <= info.max
+        self.assertTrue(numpy.array_equal(legacy[inRange], table[inRange]), '%s / %s' % (numpy.dtype(dtype).name, factor))
+        self.assertTrue((table[~inRange] == info.max).all())
+
+  def test_normalizeBlock(self):
+    " Igual a normalizacao original no volume todo e apenas no sub-bloco com bounds "
+    volume = croppedBlock((12, 30, 28)).astype(numpy.float32)
+    legacy = volume.copy()
+    legacyNormalize(legacy, 1.13)
+    normalized = volume.copy()
+    Kernels.normalizeBlock(normalized, 1.13, slabVoxels=1000)
+    self.assertTrue(numpy.array_equal(legacy, normalized))
+
+    bounds = ((2, 9), (5, 20), (3, 11))
+    region = tuple(slice(lo, hi) for lo, hi in bounds)
+    partial = volume.copy()
+    Kernels.normalizeBlock(partial, 1.13, bounds)
+    self.assertTrue(numpy.array_equal(partial[region], legacy[region]))
+    outside = numpy.ones(volume.shape, dtype=bool)
+    outside[region] = False
+    self.assertTrue(numpy.array_equal(partial[outside], volume[outside]))
+
+    integer = croppedBlock((12, 30, 28))
+    legacyInteger = integer.copy()
+    legacyIntegerNormalize(legacyInteger, 1.13)
+    Kernels.normalizeBlock(integer, 1.13)
+    self.assertTrue(numpy.array_equal(legacyInteger, integer))
+
+  def test_absoluteDifference(self):
+    a = croppedBlock((10, 24, 24))
+    a[0, :5] = 0
+    b = croppedBlock((10, 24, 24), seed=1).astype(numpy.float32)
+    b[3, :, :4] = 0
+    legacy = numpy.empty_like(b)
+    legacySubtraction(a, b, legacy)
+    for threads in (1, 3):
+      out = numpy.empty_like(b)
+      Kernels.absoluteDifference(a, b, out, 1000, threads)
+      self.assertTrue(numpy.array_equal(legacy, out))
+
+  def test_maskedMean(self):
+    " Media pelo indice plano igual a da mascara booleana e a do stencil VTK original "
+    volume = croppedBlock((10, 30, 26))
+    label = numpy.zeros(volume.shape, dtype=numpy.int16)
+    label[2:8, 5:20, 4:15] = 2
+    label[0, 0, :3] = 1
+    index = Kernels.labelIndex(label, 2, slabVoxels=700)
+    self.assertEqual(index.dtype, numpy.int32)
+    self.assertTrue(numpy.array_equal(index, numpy.flatnonzero(label == 2)))
+    reference = volume[label == 2].mean(dtype=numpy.float64)
+    self.assertAlmostEqual(Kernels.maskedMean(volume, index, slabVoxels=100), reference, places=9)
+    self.assertTrue(numpy.isnan(Kernels.maskedMean(volume, Kernels.labelIndex(label, 5))))
+    if vtk:
+      from TOFLib.Benchmark import legacyStencilMean, vtkImage
+      self.assertAlmostEqual(legacyStencilMean(vtkImage(volume), vtkImage(label), 2), reference, places=6)
+
+  def test_integerHistogram(self):
+    volume = croppedBlock((10, 20, 22))
+    histogram = Kernels.integerHistogram(volume, slabVoxels=500)
+    self.assertEqual(histogram.min(), volume.min())
+    self.assertEqual(histogram.max(), volume.max())
+    self.assertAlmostEqual(histogram.mean(), volume.mean(dtype=numpy.float64), places=9)
+    # Posto mais proximo inferior
+    ordered = numpy.sort(volume.reshape(-1))
+    for q in (5, 50, 99):
+      self.assertEqual(histogram.percentile(q), ordered[int(numpy.ceil(q / 100.0 * ordered.size)) - 1])
+    index = numpy.flatnonzero(volume > 300)
+    masked = Kernels.integerHistogram(volume, index, slabVoxels=100)
+    self.assertEqual(masked.count, len(index))
+    self.assertEqual(masked.min(), volume[volume > 300].min())
+    self.assertEqual(masked.max(), volume[volume > 300].max())
+    self.assertAlmostEqual(masked.mean(), volume[volume > 300].mean(dtype=numpy.float64), places=9)
+
+  def test_integerHistogramWideRange(self):
+    " Faixa de valores maior que o volume: sem histograma (o cache usa as contas diretas) "
+    volume = numpy.zeros((4, 8, 8), dtype=numpy.int32)
+    volume[0, 0, 0] = -2000000000
+    volume[1, 2, 3] = 2000000000
+    self.assertIsNone(Kernels.integerHistogram(volume))
+    self.assertIsNone(Kernels.integerHistogram(volume, numpy.arange(10)))
+    # Faixa de 16 bits e' sempre aceita
+    volume[:] = 0
+    volume[0, 0, 0] = 60000
+    self.assertEqual(Kernels.integerHistogram(volume).max(), 60000)
+
+  def test_maximumProjections(self):
+    volume = croppedBlock((9, 16, 14))
+    alongK, alongJ, alongI = Kernels.maximumProjections(volume, slabVoxels=300)
+    self.assertTrue(numpy.array_equal(alongK, volume.max(axis=0)))
+    self.assertTrue(numpy.array_equal(alongJ, volume.max(axis=1)))
+    self.assertTrue(numpy.array_equal(alongI, volume.max(axis=2)))
+
+  def test_popcount(self):
+    mask = numpy.random.RandomState(2).rand(7, 11, 13) > 0.6
+    other = numpy.random.RandomState(3).rand(7, 11, 13) > 0.3
+    bits, otherBits = numpy.packbits(mask.reshape(-1)), numpy.packbits(other.reshape(-1))
+    self.assertEqual(Kernels.popcount(bits), numpy.count_nonzero(mask))
+    self.assertEqual(Kernels.popcount(bits & otherBits), numpy.count_nonzero(mask & other))
+
+class LongitudinalStackTest(unittest.TestCase):
+
+  def setUp(self):
+    self.arrays = [croppedBlock((8, 20, 18), seed).astype(numpy.float32) for seed in range(4)]
+    self.stack = LongitudinalStack.fromArrays(self.arrays, ['e%d' % t for t in range(4)], times=[0.0, 1.0, 3.0, 7.0])
+    self.stack.slabVoxels = 2000
+
+  def test_slope(self):
+    " Inclinacao por voxel igual a de numpy.polyfit "
+    reference = numpy.polyfit(self.stack.times, self.stack.flat(), 1)[0].reshape(self.arrays[0].shape)
+    self.assertTrue(numpy.allclose(self.stack.slope(), reference, rtol=1e-4, atol=1e-3))
+
+  def test_statistics(self):
+    " Limiar e quantidade de cada exame iguais aos do Kernels.thresholdLabel "
+    minimum, maximum, thresholds = self.stack.thresholds(0.75)
+    counts = self.stack.counts(thresholds)
+    for t, array in enumerate(self.arrays):
+      statistics = Kernels.thresholdLabel(array, 0.75)
+      self.assertAlmostEqual(thresholds[t], statistics[2], places=3)
+      self.assertEqual(counts[t], statistics[3])
+    mask = self.arrays[0] > 300
+    self.assertTrue(numpy.allclose(self.stack.means(mask), [array[mask].mean(dtype=numpy.float64) for array in self.arrays]))
+
+  def test_changes(self):
+    stacked = numpy.array(self.arrays)
+    self.assertTrue(numpy.array_equal(self.stack.maximum(), stacked.max(axis=0)))
+    self.assertTrue(numpy.array_equal(self.stack.maximumChange(), numpy.abs(numpy.diff(stacked, axis=0)).max(axis=0)))
+    self.assertTrue(numpy.array_equal(self.stack.differences(), stacked[1:] - stacked[:1]))
+
+    bounds = ((1, 6), (2, 15), (3, 9))
+    region = tuple(slice(lo, hi) for lo, hi in bounds)
+    cropped = LongitudinalStack.fromArrays(self.arrays, self.stack.names, bounds)
+    self.assertTrue(numpy.array_equal(cropped.maximum(), stacked.max(axis=0)[region]))
+
+@unittest.skipIf(slicer is None, 'precisa do Slicer')
+class SceneTest(unittest.TestCase):
+  " Funcoes que usam nos MRML (correlacao de fase, sobreposicao e ROI automatica) "
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+
+  def volume(self, array, name, origin=(0.0, 0.0, 0.0), spacing=(1.0, 1.0, 1.0), nodeClassName='vtkMRMLScalarVolumeNode'):
+    node = slicer.util.addVolumeFromArray(array, name=name, nodeClassName=nodeClassName)
+    node.SetOrigin(origin)
+    node.SetSpacing(spacing)
+    return node
+
+  def test_phaseCorrelation(self):
+    " fixed(x) ~ moving(x - deslocamento): mover o exame de +s da' deslocamento -s "
+    from TOFLib.PreAlignment import phaseCorrelation
+    fixed = croppedBlock((24, 32, 32)).astype(numpy.float32)
+    fixed[8:14, 10:20, 5:9] += 600
+    moving = numpy.roll(fixed, (3, -4, 2), axis=(0, 1, 2))
+    shift, sharpness = phaseCorrelation(fixed, moving)
+    self.assertTrue(numpy.allclose(shift, (-3, 4, -2), atol=0.25), str(shift))
+    self.assertGreater(sharpness, 5)
+
+  def test_overlap(self):
+    " Contagens, Dice e centroides contra a sobreposicao calculada na grade completa "
+    from TOFLib.Overlap import OverlapCache
+    random = numpy.random.RandomState(0)
+    full1 = random.rand(30, 40, 50) > 0.7
+    full2 = numpy.roll(full1, 3, axis=2) & (random.rand(30, 40, 50) > 0.2)
+    spacing = (0.5, 0.5, 1.0)
+    crop1 = ((2, 25), (5, 35), (10, 45))
+    crop2 = ((4, 28), (0, 30), (8, 48))
+    grids = []
+    nodes = []
+    for full, crop, value in ((full1, crop1, 2), (full2, crop2, 5)):
+      region = tuple(slice(lo, hi) for lo, hi in crop)
+      grid = numpy.zeros(full.shape, dtype=bool)
+      grid[region] = full[region]
+      grids.append(grid)
+      origin = [crop[2][0] * spacing[0], crop[1][0] * spacing[1], crop[0][0] * spacing[2]]
+      nodes.append(self.volume(full[region].astype(numpy.int16) * value, 'label%d' % value, origin, spacing,
+        'vtkMRMLLabelMapVolumeNode'))
+
+    metrics = OverlapCache().metrics(nodes[0], nodes[1])
+    both = numpy.count_nonzero(grids[0] & grids[1])
+    self.assertEqual(metrics.count1, numpy.count_nonzero(grids[0]))
+    self.assertEqual(metrics.count2, numpy.count_nonzero(grids[1]))
+    self.assertEqual(metrics.both, both)
+    self.assertAlmostEqual(metrics.dice, 2.0 * both / (metrics.count1 + metrics.count2))
+    self.assertAlmostEqual(metrics.volume1, metrics.count1 * 0.25)
+    def centroid(grid):
+      k, j, i = numpy.nonzero(grid)
+      return numpy.array([i.mean() * spacing[0], j.mean() * spacing[1], k.mean() * spacing[2]])
+    self.assertAlmostEqual(metrics.centroidShift, numpy.linalg.norm(centroid(grids[1]) - centroid(grids[0])), places=6)
+
+  def test_overlapPairOrder(self):
+    " Pares sem ordem e grades canonicas: o resultado nao depende da ordem de selecao "
+    from TOFLib.Overlap import OverlapCache
+    random = numpy.random.RandomState(3)
+    nodes = []
+    for index, spacing in enumerate(((1.0, 1.0, 1.0), (0.5, 0.5, 1.0), (1.0, 1.0, 2.0))):
+      array = (random.rand(20, 30, 30) > 0.6).astype(numpy.int16)
+      nodes.append(self.volume(array, 'label%d' % index, (0.3 * index, 0.0, 0.0), spacing, 'vtkMRMLLabelMapVolumeNode'))
+    a, b, c = nodes
+
+    cache = OverlapCache()
+    forward = cache.metrics(a, b)
+    backward = cache.metrics(b, a)
+    self.assertEqual((backward.count1, backward.count2, backward.both), (forward.count2, forward.count1, forward.both))
+    self.assertAlmostEqual(backward.dice, forward.dice)
+
+    def byPair(pairs):
+      return dict((frozenset((node1.GetID(), node2.GetID())), metrics.dice) for node1, node2, metrics in pairs)
+    # O par ja calculado na grade dele nao substitui o calculo na grade comum
+    selected = byPair(cache.allPairs([c, b, a]))
+    fresh = byPair(OverlapCache().allPairs([a, b, c]))
+    self.assertEqual(set(selected), set(fresh))
+    for pair in fresh:
+      self.assertAlmostEqual(selected[pair], fresh[pair])
+
+  def test_tightROIBox(self):
+    " Caixa justa em volta do aneurisma e do trecho do vaso dentro do raio de busca "
+    from TOFLib import ROIUtils
+    array = (numpy.random.RandomState(1).rand(80, 200, 200) * 100).astype(numpy.int16)
+    k, j, i = numpy.ogrid[:80, :200, :200]
+    array[((k - 40) ** 2 + ((j - 100) * 0.5) ** 2 + ((i - 120) * 0.5) ** 2) < 36] = 600
+    array[(abs(k - 40) < 2) & (abs(j - 100) < 3) & (i > 60) & (i < 120)] = 550
+    # Outro vaso, fora da regiao conectada ao fiducial
+    array[(abs(k - 10) < 3) & (abs(j - 30) < 3) & (i >= 0)] = 580
+    volumeNode = self.volume(array, 'base', spacing=(0.5, 0.5, 1.0))
+    center, radius = ROIUtils.tightROIBox(volumeNode, (59.0, 50.0, 40.0), 25.0, 0.5, 3.0, 5.0)
+    self.assertTrue(numpy.allclose(center, [49.75, 50.0, 40.0]), str(center))
+    self.assertTrue(numpy.allclose(radius, [21.0, 10.75, 10.5]), str(radius))
+
+  def test_resampledMean(self):
+    " Media na grade do volume base igual a do volume reamostrado (zeros fora do volume movel) "
+    from TOFLib import ROIUtils
+    array = (numpy.random.RandomState(2).rand(20, 24, 28) * 100).astype(numpy.int16)
+    movingVolume = self.volume(array, 'moving')
+    referenceVolume = self.volume(numpy.zeros((20, 24, 28), dtype=numpy.int16), 'reference')
+    self.assertAlmostEqual(ROIUtils.resampledMean(movingVolume, referenceVolume, slabSize=7), array.mean(), places=3)
+    # Movel deslocado 3 mm em R em relacao ao base: as 3 primeiras colunas do base ficam fora do volume movel
+    transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+    matrix = vtk.vtkMatrix4x4()
+    matrix.SetElement(0, 3, 3.0)
+    transformNode.SetMatrixTransformToParent(matrix)
+    expected = array[:, :, :-3].sum(dtype=numpy.float64) / array.size
+    self.assertAlmostEqual(ROIUtils.resampledMean(movingVolume, referenceVolume, transformNode), expected, places=3)
+
+  def test_volumeStoreSameFileName(self):
+    " Exames em pastas diferentes com o mesmo nome de arquivo tem copias raw diferentes "
+    import os, shutil, tempfile
+    from TOFLib.VolumeStore import VolumeStore
+    directory = tempfile.mkdtemp()
+    try:
+      arrays = []
+      paths = []
+      for index, folder in enumerate(('01-base', '02-seg')):
+        os.makedirs(os.path.join(directory, folder))
+        array = numpy.full((4, 5, 6), index + 1, dtype=numpy.int16)
+        path = os.path.join(directory, folder, 'TOF.nrrd')
+        self.assertTrue(slicer.util.saveNode(self.volume(array, folder), path))
+        arrays.append(array)
+        paths.append(path)
+      store = VolumeStore(os.path.join(directory, 'memmap'))
+      # Conversao e depois a copia raw
+      for load in range(2):
+        for array, path in zip(arrays, paths):
+          loaded = slicer.util.arrayFromVolume(store.loadVolume(path))
+          self.assertTrue(numpy.array_equal(loaded, array), path)
+          # Copy-on-write: a alteracao nao chega ao arquivo
+          loaded[:] = 0
+      self.assertEqual(len([name for name in os.listdir(store.directory) if name.endswith('.nhdr')]), 2)
+    finally:
+      slicer.mrmlScene.Clear(0)
+      shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+import logging
+import vtk, slicer
+
+# TransformCache
+
+# Incrementar quando mudar o formato da chave ou do arquivo
+CACHE_VERSION = 1
+
+# Parametros que apenas referenciam nos da cena e nao alteram o resultado
+IGNORED_PARAMETERS = ['fixedVolume', 'movingVolume', 'outputVolume', 'linearTransform', 'initialTransform', 'numberOfThreads']
+
+def defaultCacheDirectory():
+    return os.path.join(slicer.app.temporaryPath, 'TOFUtils', 'TransformCache')
+
+class TransformCache(object):
+    """Cache em disco das transformacoes rigidas do BRAINSFit.
+
+    A chave e' o hash do conteudo dos voxels e da geometria dos volumes fixo
+    e movel mais os parametros do registro, entao o cache e' valido entre
+    sessoes e entre os modulos TOFVol e TOFDiff.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or defaultCacheDirectory()
+        # nodeID -> (MTime da imagem, hash)
+        self.volumeDigests = {}
+
+    def volumeDigest(self, volumeNode):
+        "Hash SHA1 dos voxels e da geometria do volume, reaproveitado enquanto a imagem nao mudar"
+        imageData = volumeNode.GetImageData()
+        mtime = imageData.GetMTime()
+        cached = self.volumeDigests.get(volumeNode.GetID())
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        hasher = hashlib.sha1()
+        array = slicer.util.arrayFromVolume(volumeNode)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        geometry = [str(array.dtype), list(array.shape)] + [ijkToRAS.GetElement(i, j) for i in range(3) for j in range(4)]
+        hasher.update(json.dumps(geometry).encode('utf-8'))
+        # Uma fatia por vez para nao duplicar o volume na memoria
+        for k in range(array.shape[0]):
+            hasher.update(array[k].tobytes())
+        digest = hasher.hexdigest()
+        self.volumeDigests[volumeNode.GetID()] = (mtime, digest)
+        return digest
+
+    def key(self, fixedVolume, movingVolume, parameters):
+        parameters = dict((name, value) for name, value in parameters.items() if name not in IGNORED_PARAMETERS)
+        description = json.dumps([CACHE_VERSION, self.volumeDigest(fixedVolume), self.volumeDigest(movingVolume), sorted(parameters.items())])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key):
+        "Retorna um vtkMRMLLinearTransformNode com a transformacao salva ou None"
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                elements = json.load(f)['MatrixTransformToParent']
+        except (IOError, ValueError, KeyError):
+            logging.warning('Cache de registro invalido: ' + path)
+            return None
+        matrix = vtk.vtkMatrix4x4()
+        for i in range(4):
+            for j in range(4):
+                matrix.SetElement(i, j, elements[i][j])
+        transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'TransformCache ' + key[:8])
+        transformNode.SetMatrixTransformToParent(matrix)
+        return transformNode
+
+    def store(self, key, transformNode):
+        matrix = vtk.vtkMatrix4x4()
+        transformNode.GetMatrixTransformToParent(matrix)
+        elements = [[matrix.GetElement(i, j) for j in range(4)] for i in range(4)]
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Grava em arquivo temporario e renomeia para nao deixar entradas pela metade
+        path = self.path(key)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'MatrixTransformToParent': elements}, f)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def clear(self):
+        if not os.path.exists(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(self.directory, filename))
@@ -0,0 +1,138 @@
+import numpy
+import vtk, slicer
+
+from TOFLib import Kernels
+
+# VolumeStatistics
+
+class VolumeStatisticsCache(object):
+    """Estatisticas de volumes (media, min, max, percentis) calculadas uma unica vez.
+
+    Para volumes inteiros guarda um histograma (Kernels.Histogram) por volume
+    e, opcionalmente, por (volume, label map, valor do label); as estatisticas
+    sao derivadas dele. Volumes de ponto flutuante, e inteiros com uma faixa
+    de valores grande demais para o histograma, guardam apenas os valores ja
+    calculados. As entradas de um no' sao descartadas quando a imagem dele
+    dispara Modified (quem altera o array deve chamar GetImageData().Modified())
+    ou quando o no' sai da cena.
+
+    runner, se definido (ex.: Worker.call), executa os calculos: as funcoes
+    recebem apenas arrays, entao podem rodar fora da thread principal.
+    """
+
+    def __init__(self):
+        # (volumeID, labelID, labelValue, nome) -> valor
+        self.entries = {}
+        self.runner = None
+        # nodeID -> (no', tag do observador)
+        self.observedNodes = {}
+        self.sceneObserverTags = [
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+            # IDs sao reaproveitados depois de fechar a cena
+            slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, lambda caller, event: self.clear()),
+            ]
+
+    def histogram(self, volumeNode, labelNode=None, labelValue=None):
+        "Histograma inteiro do volume (ou da regiao do label) ou None se o volume nao for inteiro ou a faixa for grande demais"
+        array = slicer.util.arrayFromVolume(volumeNode)
+        if not numpy.issubdtype(array.dtype, numpy.integer):
+            return None
+        index = self.labelIndex(labelNode, labelValue, volumeNode)
+        return self.cached(volumeNode, labelNode, labelValue, 'histogram',
+            lambda: Kernels.integerHistogram(array, index))
+
+    def mean(self, volumeNode, labelNode=None, labelValue=None):
+        histogram = self.histogram(volumeNode, labelNode, labelValue)
+        if histogram:
+            return histogram.mean()
+        array = slicer.util.arrayFromVolume(volumeNode)
+        if labelNode:
+            index = self.labelIndex(labelNode, labelValue, volumeNode)
+            return self.cached(volumeNode, labelNode, labelValue, 'mean', lambda: Kernels.maskedMean(array, index))
+        return self.cached(volumeNode, labelNode, labelValue, 'mean', lambda: float(array.mean(dtype=numpy.float64)))
+
+    def minimum(self, volumeNode, labelNode=None, labelValue=None):
+        histogram = self.histogram(volumeNode, labelNode, labelValue)
+        if histogram:
+            return histogram.min()
+        values = self.values(volumeNode, labelNode, labelValue)
+        return self.cached(volumeNode, labelNode, labelValue, 'minimum', lambda: values().min())
+
+    def maximum(self, volumeNode, labelNode=None, labelValue=None):
+        histogram = self.histogram(volumeNode, labelNode, labelValue)
+        if histogram:
+            return histogram.max()
+        values = self.values(volumeNode, labelNode, labelValue)
+        return self.cached(volumeNode, labelNode, labelValue, 'maximum', lambda: values().max())
+
+    def percentile(self, volumeNode, q, labelNode=None, labelValue=None):
+        histogram = self.histogram(volumeNode, labelNode, labelValue)
+        if histogram:
+            return histogram.percentile(q)
+        values = self.values(volumeNode, labelNode, labelValue)
+        return self.cached(volumeNode, labelNode, labelValue, ('percentile', q),
+            lambda: numpy.percentile(values(), q))
+
+    def labelIndex(self, labelNode, labelValue=None, volumeNode=None):
+        """Indices planos dos voxels do label (Kernels.labelIndex), calculados uma vez por label map.
+
+        Se volumeNode for dado, verifica se ele tem a mesma grade do label map.
+        """
+        if not labelNode:
+            return None
+        labelArray = slicer.util.arrayFromVolume(labelNode)
+        if volumeNode and labelArray.shape != slicer.util.arrayFromVolume(volumeNode).shape:
+            raise ValueError('Label map ' + labelNode.GetName() + ' nao tem as dimensoes de ' + volumeNode.GetName())
+        return self.cached(labelNode, None, labelValue, 'index', lambda: Kernels.labelIndex(labelArray, labelValue))
+
+    def values(self, volumeNode, labelNode, labelValue):
+        "Funcao que retorna os valores do volume (ou da regiao do label), sem acessar os nos"
+        array = slicer.util.arrayFromVolume(volumeNode)
+        index = self.labelIndex(labelNode, labelValue, volumeNode)
+        return lambda: array if index is None else numpy.take(array.reshape(-1), index)
+
+    def cached(self, volumeNode, labelNode, labelValue, name, compute):
+        labelID = labelNode.GetID() if labelNode else None
+        key = (volumeNode.GetID(), labelID, labelValue, name)
+        if key not in self.entries:
+            self.observe(volumeNode)
+            if labelNode:
+                self.observe(labelNode)
+            self.entries[key] = self.runner(compute) if self.runner else compute()
+        return self.entries[key]
+
+    def observe(self, node):
+        if node.GetID() in self.observedNodes:
+            return
+        tag = node.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent,
+            lambda caller, event: self.invalidate(caller.GetID()))
+        self.observedNodes[node.GetID()] = (node, tag)
+
+    def invalidate(self, nodeID):
+        "Descarta as estatisticas que dependem do no'"
+        for key in list(self.entries.keys()):
+            if nodeID in (key[0], key[1]):
+                del self.entries[key]
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        if node.GetID() not in self.observedNodes:
+            return
+        self.invalidate(node.GetID())
+        observedNode, tag = self.observedNodes.pop(node.GetID())
+        observedNode.RemoveObserver(tag)
+
+    def clear(self):
+        self.entries = {}
+        for node, tag in self.observedNodes.values():
+            node.RemoveObserver(tag)
+        self.observedNodes = {}
+
+_statisticsCache = None
+
+def statisticsCache():
+    "Cache unico, compartilhado pelos modulos TOF"
+    global _statisticsCache
+    if _statisticsCache is None:
+        _statisticsCache = VolumeStatisticsCache()
+    return _statisticsCache
@@ -0,0 +1,197 @@
+import os
+import re
+import hashlib
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+# VolumeStore
+
+NRRD_TYPES = {
+    'int8': 'signed char', 'uint8': 'unsigned char',
+    'int16': 'short', 'uint16': 'unsigned short',
+    'int32': 'int', 'uint32': 'unsigned int',
+    'float32': 'float', 'float64': 'double',
+    }
+
+def writeHeader(headerPath, dtype, shape, ijkToRAS, keyValues=None):
+    """Cabecalho NRRD destacado (.nhdr) para um arquivo raw sem compressao, array em ordem (k, j, i).
+
+    keyValues sao gravados como pares chave:=valor do NRRD.
+    """
+    directions = ' '.join('(%r,%r,%r)' % tuple(ijkToRAS.GetElement(row, axis) for row in range(3)) for axis in range(3))
+    origin = '(%r,%r,%r)' % tuple(ijkToRAS.GetElement(row, 3) for row in range(3))
+    lines = [
+        'NRRD0004',
+        'type: ' + NRRD_TYPES[numpy.dtype(dtype).name],
+        'dimension: 3',
+        'space: right-anterior-superior',
+        'sizes: %d %d %d' % (shape[2], shape[1], shape[0]),
+        'space directions: ' + directions,
+        'kinds: domain domain domain',
+        'endian: ' + ('little' if numpy.little_endian else 'big'),
+        'encoding: raw',
+        'space origin: ' + origin,
+        'data file: ' + os.path.basename(rawPath(headerPath)),
+        ]
+    for key, value in sorted((keyValues or {}).items()):
+        lines.append(key + ':=' + value)
+    with open(headerPath, 'w') as f:
+        f.write('\n'.join(lines) + '\n\n')
+
+def readHeader(headerPath):
+    "Le um cabecalho escrito por writeHeader; retorna (dtype, shape, ijkToRAS)"
+    fields = {}
+    with open(headerPath) as f:
+        for line in f:
+            if ':' in line and ':=' not in line:
+                key, value = line.split(':', 1)
+                fields[key.strip()] = value.strip()
+    dtype = numpy.dtype([name for name, nrrdType in NRRD_TYPES.items() if nrrdType == fields['type']][0])
+    if fields.get('endian') == 'big':
+        dtype = dtype.newbyteorder('>')
+    sizes = [int(size) for size in fields['sizes'].split()]
+    vectors = [[float(v) for v in vector.strip('()').split(',')] for vector in re.findall(r'\([^)]*\)', fields['space directions'])]
+    origin = [float(v) for v in fields['space origin'].strip('()').split(',')]
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for axis in range(3):
+        for row in range(3):
+            ijkToRAS.SetElement(row, axis, vectors[axis][row])
+        ijkToRAS.SetElement(axis, 3, origin[axis])
+    return dtype, (sizes[2], sizes[1], sizes[0]), ijkToRAS
+
+def readKeyValues(headerPath):
+    "Pares chave:=valor de um cabecalho NRRD"
+    keyValues = {}
+    with open(headerPath) as f:
+        for line in f:
+            if ':=' in line:
+                key, value = line.rstrip('\n').split(':=', 1)
+                keyValues[key] = value
+    return keyValues
+
+def sourceKeyValues(path):
+    "Caminho, tamanho e data de modificacao do arquivo de origem, gravados no cabecalho da copia raw"
+    return {'TOFLib.SourcePath': os.path.abspath(path), 'TOFLib.SourceSize': str(os.path.getsize(path)),
+        'TOFLib.SourceMTime': repr(os.path.getmtime(path))}
+
+def rawPath(headerPath):
+    return os.path.splitext(headerPath)[0] + '.raw'
+
+def volumeName(path):
+    "Nome do arquivo sem a extensao de volume"
+    name = os.path.basename(path)
+    for extension in ('.nii.gz', '.nrrd', '.nhdr', '.nii', '.mha', '.mhd'):
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+class VolumeStore(object):
+    """Volumes em arquivos raw sem compressao acessados por numpy.memmap.
+
+    Os nos guardados tem a vtkImageData apontando para o mapeamento do
+    arquivo (sem copia), entao slicer.util.arrayFromVolume e as etapas
+    numericas trabalham direto sobre o memmap e o sistema operacional so'
+    carrega as paginas realmente lidas (ROI, slabs). Como a memoria e' do
+    cache de paginas, ela pode ser devolvida sob pressao, o que permite
+    processar mais pacientes ao mesmo tempo.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # nodeID -> memmap (mantem o mapeamento vivo enquanto o no' o usa)
+        self.memmaps = {}
+
+    def headerPath(self, name):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.nhdr')
+
+    def attach(self, volumeNode, memmap, ijkToRAS):
+        "Faz a imagem do no' usar o memmap, sem copiar os dados"
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(memmap.shape[2], memmap.shape[1], memmap.shape[0])
+        scalars = numpy_support.numpy_to_vtk(memmap.reshape(-1), deep=False)
+        scalars.SetName('ImageScalars')
+        imageData.GetPointData().SetScalars(scalars)
+        volumeNode.SetIJKToRASMatrix(ijkToRAS)
+        volumeNode.SetAndObserveImageData(imageData)
+        self.memmaps[volumeNode.GetID()] = memmap
+
+    def open(self, name, mode='r+'):
+        "memmap (k, j, i) e matriz IJKToRAS de um volume ja guardado"
+        headerPath = self.headerPath(name)
+        dtype, shape, ijkToRAS = readHeader(headerPath)
+        return numpy.memmap(rawPath(headerPath), dtype=dtype, mode=mode, shape=shape), ijkToRAS
+
+    def store(self, volumeNode, name=None, keyValues=None):
+        "Copia a imagem do no' para o armazenamento e passa a usa-la por memmap"
+        name = name or volumeNode.GetName() + '-' + volumeNode.GetID()
+        array = slicer.util.arrayFromVolume(volumeNode)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        headerPath = self.headerPath(name)
+        memmap = numpy.memmap(rawPath(headerPath), dtype=array.dtype, mode='w+', shape=array.shape)
+        # Uma fatia por vez para nao duplicar o volume na memoria
+        for k in range(array.shape[0]):
+            memmap[k] = array[k]
+        memmap.flush()
+        writeHeader(headerPath, array.dtype, array.shape, ijkToRAS, keyValues)
+        self.attach(volumeNode, memmap, ijkToRAS)
+        return memmap
+
+    def createVolume(self, name, referenceNode, dtype=None):
+        "Novo volume zerado com a geometria de referenceNode, ja no armazenamento"
+        ijkToRAS = vtk.vtkMatrix4x4()
+        referenceNode.GetIJKToRASMatrix(ijkToRAS)
+        dims = referenceNode.GetImageData().GetDimensions()
+        shape = (dims[2], dims[1], dims[0])
+        dtype = dtype or slicer.util.arrayFromVolume(referenceNode).dtype
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+        headerPath = self.headerPath(name + '-' + volumeNode.GetID())
+        # Arquivo esparso: nada e' alocado ate ser escrito
+        memmap = numpy.memmap(rawPath(headerPath), dtype=dtype, mode='w+', shape=shape)
+        writeHeader(headerPath, dtype, shape, ijkToRAS)
+        self.attach(volumeNode, memmap, ijkToRAS)
+        volumeNode.CreateDefaultDisplayNodes()
+        return volumeNode
+
+    def sourceName(self, path):
+        """Nome da copia raw de um arquivo de volume: o nome do arquivo e um hash do caminho absoluto.
+
+        Exames em pastas diferentes com o mesmo nome de arquivo (01-base/TOF.nrrd,
+        02-seg/TOF.nrrd) tem copias diferentes.
+        """
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+        return volumeName(path) + '-' + digest
+
+    def isCurrent(self, name, path):
+        "A copia raw existe e foi feita deste arquivo, com o mesmo tamanho e data de modificacao"
+        headerPath = self.headerPath(name)
+        if not os.path.exists(headerPath) or not os.path.exists(rawPath(headerPath)):
+            return False
+        return readKeyValues(headerPath) == sourceKeyValues(path)
+
+    def loadVolume(self, path):
+        """Carrega um arquivo de volume como no' apoiado em memmap.
+
+        Na primeira vez o arquivo e' lido pelo Slicer e convertido para raw; as
+        proximas cargas abrem a copia raw direto, sem ler o volume para a memoria.
+        A copia e' aberta em copy-on-write: alteracoes no no' nao voltam para o
+        arquivo.
+        """
+        name = self.sourceName(path)
+        if self.isCurrent(name, path):
+            memmap, ijkToRAS = self.open(name, mode='c')
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', volumeName(path))
+            self.attach(volumeNode, memmap, ijkToRAS)
+            volumeNode.CreateDefaultDisplayNodes()
+            return volumeNode
+        success, volumeNode = slicer.util.loadVolume(path, {}, returnNode=True)
+        if not success:
+            raise IOError('Falha ao carregar ' + path)
+        self.store(volumeNode, name, sourceKeyValues(path))
+        # O no' carregado agora tambem nao deve alterar a copia guardada
+        memmap, ijkToRAS = self.open(name, mode='c')
+        self.attach(volumeNode, memmap, ijkToRAS)
+        return volumeNode
@@ -0,0 +1,206 @@
+import socket
+import logging
+import threading
+import multiprocessing.pool
+
+# Worker
+#
+# As etapas numericas (NumPy) rodam em uma thread de trabalho; a thread
+# principal so' mexe nos nos MRML e continua processando os eventos do Qt,
+# entao a interface responde (inclusive ao botao Cancelar) durante as contas.
+# O termino e' avisado a thread principal por um Notifier, sem polling.
+
+class Cancelled(Exception):
+    "Execucao interrompida pelo usuario"
+
+class Progress(object):
+    """Progresso determinado de uma execucao e pedido de cancelamento.
+
+    Quem agenda trabalho chama addSteps(n); cada etapa concluida chama
+    step(texto). callback(feitas, total, texto) e' chamado na thread
+    principal. cancel() avisa os cancelListeners (por exemplo o
+    RegistrationScheduler) e faz check() levantar Cancelled na proxima
+    fronteira entre etapas.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.cancelListeners = []
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.done = 0
+        self.cancelled = False
+        self.cancelListeners = []
+
+    def addSteps(self, steps):
+        self.total += steps
+        self.notify('')
+
+    def step(self, text='', steps=1):
+        self.done += steps
+        self.notify(text)
+
+    def notify(self, text):
+        if self.callback:
+            self.callback(self.done, max(self.total, self.done), text)
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        logging.info('Cancelamento pedido')
+        self.cancelled = True
+        for listener in self.cancelListeners:
+            listener()
+
+    def check(self):
+        "Levanta Cancelled se o cancelamento foi pedido"
+        if self.cancelled:
+            raise Cancelled()
+
+def socketPair():
+    "Par de sockets conectados (socket.socketpair nao existe no Windows com Python 2)"
+    try:
+        return socket.socketpair()
+    except (AttributeError, OSError):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader = listener.accept()[0]
+        listener.close()
+        return reader, writer
+
+class Notifier(object):
+    """Avisa a thread principal que um trabalho de outra thread terminou.
+
+    notify() pode ser chamado de qualquer thread: escreve um byte em um par
+    de sockets cuja leitura e' observada por um QSocketNotifier, e o laco de
+    eventos do Qt chama callback() na thread principal. Nao ha timer nem
+    espera com timeout.
+    """
+
+    def __init__(self, callback):
+        import qt
+        self.callback = callback
+        self.reader, self.writer = socketPair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.socketNotifier = qt.QSocketNotifier(self.reader.fileno(), qt.QSocketNotifier.Read)
+        self.socketNotifier.connect('activated(int)', self.onActivated)
+
+    def notify(self):
+        try:
+            self.writer.send(b'.')
+        except socket.error:
+            # Buffer cheio: ja ha um aviso pendente
+            pass
+
+    def wrap(self, function, finished):
+        """function que, ao terminar (com ou sem excecao), marca finished (threading.Event) e chama notify().
+
+        O AsyncResult do pool so' fica ready() um pouco depois; quem recebe o
+        aviso deve olhar finished.
+        """
+        def notifying(*args, **kwargs):
+            try:
+                return function(*args, **kwargs)
+            finally:
+                finished.set()
+                self.notify()
+        return notifying
+
+    def onActivated(self, socketDescriptor):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        self.callback()
+
+    def close(self):
+        self.socketNotifier.setEnabled(False)
+        self.reader.close()
+        self.writer.close()
+
+class Worker(object):
+    """Executa funcoes numericas em uma thread de trabalho.
+
+    call() espera o resultado em um laco de eventos do Qt, encerrado pelo
+    Notifier quando a funcao termina: a interface continua sendo atendida e
+    nada acorda a thread principal enquanto a conta roda. Chamadas aninhadas
+    (feitas por eventos atendidos durante a espera) terminam na ordem da
+    pilha. As funcoes recebem arrays, nunca nos MRML.
+    """
+
+    def __init__(self, threads=1):
+        self.threads = threads
+        self.pool = None
+        self.notifier = None
+        # (termino, laco de eventos) das chamadas esperando
+        self.waiting = []
+
+    def call(self, function, *args, **kwargs):
+        import qt
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(self.threads)
+            self.notifier = Notifier(self.onFinished)
+        finished = threading.Event()
+        result = self.pool.apply_async(self.notifier.wrap(function, finished), args, kwargs)
+        if not finished.is_set():
+            eventLoop = qt.QEventLoop()
+            self.waiting.append((finished, eventLoop))
+            try:
+                eventLoop.exec_()
+            finally:
+                self.waiting.remove((finished, eventLoop))
+        return result.get()
+
+    def onFinished(self):
+        for finished, eventLoop in self.waiting:
+            if finished.is_set():
+                eventLoop.quit()
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        self.notifier.close()
+        self.notifier = None
+
+class InterfaceLock(object):
+    """Trava os parametros do modulo durante uma execucao (with InterfaceLock(...)).
+
+    Os lacos de eventos de Worker.call e RegistrationScheduler.wait atendem
+    a interface no meio da execucao. Para que ela nao mude as entradas nem
+    inicie outra execucao, os widgets dados ficam desabilitados e fechar a
+    cena cancela o progress (Progress.cancel).
+    """
+
+    def __init__(self, widgets, progress):
+        self.widgets = widgets
+        self.progress = progress
+        self.states = []
+        self.observerTag = None
+
+    def __enter__(self):
+        import slicer
+        self.states = [(widget, widget.enabled) for widget in self.widgets]
+        for widget in self.widgets:
+            widget.enabled = False
+        self.observerTag = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.StartCloseEvent, self.onSceneClose)
+        return self
+
+    def onSceneClose(self, caller, event):
+        logging.warning('Cena fechada durante a execucao, cancelando')
+        self.progress.cancel()
+
+    def __exit__(self, exceptionType, exception, traceback):
+        import slicer
+        slicer.mrmlScene.RemoveObserver(self.observerTag)
+        for widget, enabled in self.states:
+            widget.enabled = enabled
+        return False
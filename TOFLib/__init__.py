@@ -0,0 +1,6 @@
+# TOFLib
+#
+# Codigo compartilhado entre os modulos TOFVol, TOFDiff e TOFView.
+# Os submodulos sao importados explicitamente (ex.: from TOFLib.RegistrationScheduler
+# import RegistrationScheduler) para que as partes puramente numericas possam ser
+# usadas fora do Slicer.
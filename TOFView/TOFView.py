@@ -1,8 +1,12 @@
 import os
+import time
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+from TOFLib.SceneIndex import sceneIndex
+from TOFLib.LabelStore import labelStores
+from TOFLib.Overlap import overlapCache
 
 #
 # TOFView
@@ -21,6 +25,11 @@ class TOFView(ScriptedLoadableModule):
 
 # TOFViewWidget
 class TOFViewWidget(ScriptedLoadableModuleWidget):
+    # Intervalo minimo entre atualizacoes do blend (ms), ~60 Hz
+    blendInterval = 16
+    # Pausa (s) que encerra uma medicao de quadros por segundo
+    blendIdle = 0.5
+
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
@@ -46,6 +55,20 @@ class TOFViewWidget(ScriptedLoadableModuleWidget):
         self.baseSelector.setToolTip( "Volume base para comparacao" )
         parametersFormLayout.addRow("Volume Base: ", self.baseSelector)
 
+        # Segmentacoes guardadas pelo TOFVol (labels compactos): o label map e' criado ao ser escolhido
+        self.resultsComboBox = qt.QComboBox()
+        self.resultsComboBox.setToolTip( "Exames segmentados pelo TOFVol cujo label map ainda pode nao existir na cena" )
+        parametersFormLayout.addRow("Resultados TOFVol: ", self.resultsComboBox)
+        resultsLayout = qt.QHBoxLayout()
+        self.resultsToLabel1Button = qt.QPushButton("Usar como Label Map 1")
+        self.resultsToLabel2Button = qt.QPushButton("Usar como Label Map 2")
+        self.refreshResultsButton = qt.QPushButton("Atualizar")
+        resultsLayout.addWidget(self.resultsToLabel1Button)
+        resultsLayout.addWidget(self.resultsToLabel2Button)
+        resultsLayout.addWidget(self.refreshResultsButton)
+        parametersFormLayout.addRow(resultsLayout)
+        self.resultsStores = []
+
         # label 1 volume selector
         self.label1Selector = slicer.qMRMLNodeComboBox()
         self.label1Selector.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
@@ -87,6 +110,53 @@ class TOFViewWidget(ScriptedLoadableModuleWidget):
         self.sliderWidget.enabled = False
         parametersFormLayout.addRow("label 2 <-> Label 1", self.sliderWidget)
 
+        # Quadros renderizados por segundo durante o arraste do slider
+        self.fpsLabel = qt.QLabel()
+        self.fpsLabel.enabled = False
+        parametersFormLayout.addRow("Renderizacao: ", self.fpsLabel)
+
+        # Sobreposicao entre label maps
+        overlapCollapsibleButton = ctk.ctkCollapsibleButton()
+        overlapCollapsibleButton.text = "Sobreposicao"
+        self.layout.addWidget(overlapCollapsibleButton)
+        overlapFormLayout = qt.QFormLayout(overlapCollapsibleButton)
+
+        self.overlapLabel = qt.QLabel()
+        self.overlapLabel.setToolTip( "Sobreposicao entre Label Map 1 e Label Map 2 (voxels nao nulos)" )
+        overlapFormLayout.addRow("Label 1 x Label 2: ", self.overlapLabel)
+
+        self.overlapMapButton = qt.QPushButton("Criar mapa de sobreposicao")
+        self.overlapMapButton.toolTip = "Label map com 1 = so' no label 1, 2 = so' no label 2, 3 = nos dois"
+        self.overlapMapButton.enabled = False
+        overlapFormLayout.addRow(self.overlapMapButton)
+
+        self.pairsSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.pairsSelector.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
+        self.pairsSelector.addEnabled = False
+        self.pairsSelector.removeEnabled = False
+        self.pairsSelector.showHidden = False
+        self.pairsSelector.showChildNodeTypes = False
+        self.pairsSelector.setMRMLScene( slicer.mrmlScene )
+        self.pairsSelector.setToolTip( "Label maps comparados dois a dois em Todos os pares" )
+        overlapFormLayout.addRow("Label maps: ", self.pairsSelector)
+
+        self.allPairsButton = qt.QPushButton("Todos os pares")
+        self.allPairsButton.toolTip = "Tabela com as metricas de todos os pares dos label maps marcados"
+        overlapFormLayout.addRow(self.allPairsButton)
+
+        # Atualizacoes do slider agrupadas: so' o ultimo valor e' aplicado a cada intervalo
+        self.blendTimer = qt.QTimer()
+        self.blendTimer.setSingleShot(True)
+        self.blendTimer.setInterval(self.blendInterval)
+        self.blendTimer.connect('timeout()', self.applyBlend)
+        self.lastBlend = None
+        self.dragStart = None
+
+        # Renderizacoes das vistas (observadores StartEvent/EndEvent das render windows)
+        self.renderObservers = []
+        self.renderStarts = {}
+        self.renderFrames = {}
+
         # Add vertical spacer
         self.layout.addStretch(1)
 
@@ -99,12 +169,75 @@ class TOFViewWidget(ScriptedLoadableModuleWidget):
         self.label1Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.setLabel1)
         self.label2Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.transparencyOnSelect)
         self.label2Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.setLabel2)
+        self.resultsToLabel1Button.connect('clicked(bool)', lambda: self.useResult(self.label1Selector))
+        self.resultsToLabel2Button.connect('clicked(bool)', lambda: self.useResult(self.label2Selector))
+        self.refreshResultsButton.connect('clicked(bool)', self.refreshResults)
+        self.label1Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateOverlap)
+        self.label2Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateOverlap)
+        self.overlapMapButton.connect('clicked(bool)', self.onOverlapMapButton)
+        self.allPairsButton.connect('clicked(bool)', self.onAllPairsButton)
 
         # Refresh Apply button state
         self.onSelect()
 
     def cleanup(self):
-        pass
+        self.blendTimer.stop()
+        self.removeRenderObservers()
+
+    def enter(self):
+        self.refreshResults()
+        self.observeRenders()
+
+    def exit(self):
+        self.removeRenderObservers()
+
+    def observeRenders(self):
+        "Observa o inicio e o fim de cada renderizacao das vistas 3D e de corte"
+        self.removeRenderObservers()
+        layoutManager = slicer.app.layoutManager()
+        views = []
+        threeDWidget = layoutManager.threeDWidget(0)
+        if threeDWidget:
+            views.append(('3D', threeDWidget.threeDView()))
+        for color in ['Red', 'Yellow', 'Green']:
+            sliceWidget = layoutManager.sliceWidget(color)
+            if sliceWidget:
+                views.append((color, sliceWidget.sliceView()))
+        for name, view in views:
+            renderWindow = view.renderWindow()
+            tags = [renderWindow.AddObserver(vtk.vtkCommand.StartEvent, lambda caller, event, name=name: self.onRenderStart(name)),
+                renderWindow.AddObserver(vtk.vtkCommand.EndEvent, lambda caller, event, name=name: self.onRenderEnd(name))]
+            self.renderObservers.append((renderWindow, tags))
+
+    def removeRenderObservers(self):
+        for renderWindow, tags in self.renderObservers:
+            for tag in tags:
+                renderWindow.RemoveObserver(tag)
+        self.renderObservers = []
+
+    def refreshResults(self):
+        "Lista os exames com mascara guardada em alguma tabela do TOFVol"
+        self.resultsComboBox.clear()
+        self.resultsStores = []
+        for store in labelStores():
+            for sourceID in store.sourceIDs():
+                sourceVolume = slicer.mrmlScene.GetNodeByID(sourceID)
+                name = sourceVolume.GetName() if sourceVolume else store.entry(sourceID)['name']
+                self.resultsComboBox.addItem(store.tableNode.GetName() + ': ' + name)
+                self.resultsStores.append((store, sourceID))
+        enabled = len(self.resultsStores) > 0
+        self.resultsToLabel1Button.enabled = enabled
+        self.resultsToLabel2Button.enabled = enabled
+
+    def useResult(self, selector):
+        "Cria (se preciso) o label map do resultado escolhido e o seleciona"
+        index = self.resultsComboBox.currentIndex
+        if index < 0 or index >= len(self.resultsStores):
+            return
+        store, sourceID = self.resultsStores[index]
+        labelMap = store.materialize(sourceID)
+        if labelMap:
+            selector.setCurrentNode(labelMap)
 
     def onSelect(self):
         self.sliderWidget.enabled = True
@@ -115,26 +248,26 @@ class TOFViewWidget(ScriptedLoadableModuleWidget):
             slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(self.baseSelector.currentNode().GetID())
 
     def setLabel1(self):
-        for node in slicer.util.getNodesByClass('vtkMRMLModelNode'):
-            if self.label1Selector.currentNode().GetName() in node.GetName():
-                self.label1Model.text = node.GetName()
-                self.label1DisplayNode = node.GetModelDisplayNode()
-                self.label1DisplayNode.SetOpacity(0.5)
-                for color in ['Red', 'Yellow', 'Green']:
-                    slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetForegroundVolumeID(self.label1Selector.currentNode().GetID())
-                    slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetForegroundOpacity(0.5)
-                return
+        labelNode = self.label1Selector.currentNode()
+        node = sceneIndex().modelForLabelMap(labelNode) if labelNode else None
+        if node:
+            self.label1Model.text = node.GetName()
+            self.label1DisplayNode = node.GetModelDisplayNode()
+            self.label1DisplayNode.SetOpacity(0.5)
+            for color in ['Red', 'Yellow', 'Green']:
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetForegroundVolumeID(labelNode.GetID())
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetForegroundOpacity(0.5)
 
     def setLabel2(self):
-        for node in slicer.util.getNodesByClass('vtkMRMLModelNode'):
-            if self.label2Selector.currentNode().GetName() in node.GetName():
-                self.label2Model.text = node.GetName()
-                self.label2DisplayNode = node.GetModelDisplayNode()
-                self.label2DisplayNode.SetOpacity(0.5)
-                for color in ['Red', 'Yellow', 'Green']:
-                    slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(self.label2Selector.currentNode().GetID())
-                    slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelOpacity(0.5)
-                return
+        labelNode = self.label2Selector.currentNode()
+        node = sceneIndex().modelForLabelMap(labelNode) if labelNode else None
+        if node:
+            self.label2Model.text = node.GetName()
+            self.label2DisplayNode = node.GetModelDisplayNode()
+            self.label2DisplayNode.SetOpacity(0.5)
+            for color in ['Red', 'Yellow', 'Green']:
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(labelNode.GetID())
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelOpacity(0.5)
 
     def transparencyOnSelect(self):
         self.sliderWidget.enabled = self.baseSelector.currentNode() and self.label1Selector.currentNode() and self.label2Selector.currentNode()
@@ -143,29 +276,131 @@ class TOFViewWidget(ScriptedLoadableModuleWidget):
                 logging.debug('isValidInputOutputData failed: input and output volume is the same. Create a new volume for output to avoid this error.')
                 slicer.util.errorDisplay('Label Maps iguais. Por favor escolha outro.')
 
-        for node in slicer.util.getNodesByClass('vtkMRMLModelNode'):
-            if node.GetName()!=self.label1Selector.currentNode().GetName() or node.GetName()!=self.label2Selector.currentNode().GetName():
-                node.GetModelDisplayNode().SetOpacity(0)
-            else:
-                node.GetModelDisplayNode().SetOpacity(0.5)
+        # Apenas os modelos dos label maps selecionados ficam visiveis
+        selectedIDs = set()
+        for labelNode in [self.label1Selector.currentNode(), self.label2Selector.currentNode()]:
+            model = sceneIndex().modelForLabelMap(labelNode) if labelNode else None
+            if model:
+                selectedIDs.add(model.GetID())
+        for node in sceneIndex().modelNodes():
+            if node.GetModelDisplayNode():
+                node.GetModelDisplayNode().SetOpacity(0.5 if node.GetID() in selectedIDs else 0)
+
+    def updateOverlap(self):
+        "Metricas do par selecionado (do cache, se o par ja foi calculado)"
+        label1 = self.label1Selector.currentNode()
+        label2 = self.label2Selector.currentNode()
+        valid = self.isValidInputOutputData(label1, label2) and self.hasImageData(label1) and self.hasImageData(label2)
+        self.overlapMapButton.enabled = valid
+        if not valid:
+            self.overlapLabel.text = ''
+            return
+        metrics = overlapCache().metrics(label1, label2)
+        self.overlapLabel.text = metrics.summary() if metrics else 'Labels vazios'
+
+    def onOverlapMapButton(self):
+        labelMap = overlapCache().overlapVolume(self.label1Selector.currentNode(), self.label2Selector.currentNode())
+        if not labelMap:
+            return
+        for color in ['Red', 'Yellow', 'Green']:
+            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(labelMap.GetID())
+
+    def onAllPairsButton(self):
+        "Tabela com as metricas de todos os pares dos label maps marcados"
+        labelNodes = [node for node in self.pairsSelector.checkedNodes() if self.hasImageData(node)]
+        if len(labelNodes) < 2:
+            slicer.util.errorDisplay('Marque pelo menos dois label maps.')
+            return
+        table = slicer.vtkMRMLTableNode()
+        tableWasModified = table.StartModify()
+        table.SetName("TOFView Sobreposicao")
+        table.SetUseColumnNameAsColumnHeader(True)
+        for name in ["Label 1", "Label 2", "Dice", "Jaccard", "Volume 1 (mm3)", "Volume 2 (mm3)", "Ambos (mm3)",
+            "So' 1", "So' 2", "Ambos", "Centroide (mm)"]:
+            col = table.AddColumn(); col.SetName(name)
+        for label1, label2, metrics in overlapCache().allPairs(labelNodes):
+            rowIndex = table.AddEmptyRow()
+            shift = '-' if metrics.centroidShift is None else '%.2f' % metrics.centroidShift
+            for column, text in enumerate([label1.GetName(), label2.GetName(), '%.3f' % metrics.dice, '%.3f' % metrics.jaccard,
+                '%.1f' % metrics.volume1, '%.1f' % metrics.volume2, '%.1f' % metrics.bothVolume,
+                str(metrics.only1), str(metrics.only2), str(metrics.both), shift]):
+                table.SetCellText(rowIndex, column, text)
+        slicer.mrmlScene.AddNode(table)
+        table.EndModify(tableWasModified)
+
+        slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
+        slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(table.GetID())
+        slicer.app.applicationLogic().PropagateTableSelection()
 
     def onValueChanged(self):
+        # O valor e' lido do slider quando o timer dispara (o ultimo valor vence)
+        if not self.blendTimer.isActive():
+            self.blendTimer.start()
+
+    def applyBlend(self):
         if not self.isValidInputOutputData(self.label1Selector.currentNode(), self.label2Selector.currentNode()):
             slicer.util.errorDisplay('Label Maps iguais. Por favor mude um dos labels.')
             return False
 
+        # Uma pausa maior que blendIdle comeca uma nova medicao
+        now = time.time()
+        if self.lastBlend is None or now - self.lastBlend > self.blendIdle:
+            self.dragStart = now
+            self.renderFrames = {}
+        self.lastBlend = now
+
         #codigo para transparencia
         highValue = self.sliderWidget.value
         lowValue = 1 - self.sliderWidget.value
-        for color in ['Red', 'Yellow', 'Green']:
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetForegroundOpacity(highValue)
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelOpacity(lowValue)
 
-        self.label1DisplayNode.SetOpacity(highValue)
-        self.label2DisplayNode.SetOpacity(lowValue)
+        # Todas as alteracoes em um unico ciclo de renderizacao
+        pauseRender = hasattr(slicer.app, 'pauseRender')
+        if pauseRender:
+            slicer.app.pauseRender()
+        try:
+            for color in ['Red', 'Yellow', 'Green']:
+                compositeNode = slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode()
+                wasModified = compositeNode.StartModify()
+                compositeNode.SetForegroundOpacity(highValue)
+                compositeNode.SetLabelOpacity(lowValue)
+                compositeNode.EndModify(wasModified)
+
+            for displayNode, opacity in [(getattr(self, 'label1DisplayNode', None), highValue), (getattr(self, 'label2DisplayNode', None), lowValue)]:
+                if displayNode:
+                    wasModified = displayNode.StartModify()
+                    displayNode.SetOpacity(opacity)
+                    displayNode.EndModify(wasModified)
+        finally:
+            if pauseRender:
+                slicer.app.resumeRender()
 
         return
 
+    def onRenderStart(self, name):
+        self.renderStarts[name] = time.time()
+
+    def onRenderEnd(self, name):
+        "Guarda a renderizacao se ela aconteceu durante o arraste atual do slider"
+        start = self.renderStarts.pop(name, None)
+        if start is None or self.lastBlend is None or start < self.dragStart or start - self.lastBlend > self.blendIdle:
+            return
+        self.renderFrames.setdefault(name, []).append((start, time.time()))
+        self.updateRenderRate()
+
+    def updateRenderRate(self):
+        "Quadros por segundo (da vista 3D, ou da vermelha) e tempo medio de renderizacao de cada vista no arraste atual"
+        frames = self.renderFrames.get('3D') or self.renderFrames.get('Red') or []
+        if len(frames) < 2:
+            return
+        elapsed = frames[-1][1] - frames[0][0]
+        if elapsed <= 0:
+            return
+        def renderTime(names):
+            times = [end - start for name in names for start, end in self.renderFrames.get(name, [])]
+            return sum(times) / len(times) * 1000.0 if times else 0.0
+        self.fpsLabel.text = '%.1f quadros por segundo (3D %.1f ms, cortes %.1f ms)' % ((len(frames) - 1) / elapsed,
+            renderTime(['3D']), renderTime(['Red', 'Yellow', 'Green']))
+
     def hasImageData(self,volumeNode):
         if not volumeNode:
             logging.debug('hasImageData failed: no volume node')
@@ -1,8 +1,19 @@
 import os
 import unittest
+import functools
 import vtk, qt, ctk, slicer, numpy
 from slicer.ScriptedLoadableModule import *
 import logging
+from TOFLib.RegistrationScheduler import RegistrationScheduler, defaultMaxConcurrent
+from TOFLib.TransformCache import TransformCache
+from TOFLib.PreAlignment import PreAligner
+from TOFLib.Worker import Cancelled, InterfaceLock, Progress, Worker
+from TOFLib import Kernels, ROIUtils
+from TOFLib.VolumeStatistics import statisticsCache
+from TOFLib.SurfaceBuilder import SurfaceBuilder
+from TOFLib.SceneIndex import sceneIndex
+from TOFLib.LabelStore import LabelStore
+from TOFLib.Instrumentation import Profiler
 
 # TOFVol
 
@@ -25,6 +36,7 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
         # Instantiate and connect widgets ...
         # Parameters Area
         parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.parametersCollapsibleButton = parametersCollapsibleButton
         parametersCollapsibleButton.text = "Parametros"
         self.layout.addWidget(parametersCollapsibleButton)
 
@@ -57,6 +69,83 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
         self.fiducialSelector.setToolTip( "Ponto fiducial base para criacao da ROI" )
         parametersFormLayout.addRow("Ponto Fiducial: ", self.fiducialSelector)
 
+        # Numero de registros simultaneos
+        self.concurrentSpinBox = qt.QSpinBox()
+        self.concurrentSpinBox.setMinimum(1)
+        self.concurrentSpinBox.setMaximum(16)
+        self.concurrentSpinBox.setValue(defaultMaxConcurrent())
+        self.concurrentSpinBox.setToolTip( "Quantidade de registros BRAINSFit executados ao mesmo tempo" )
+        parametersFormLayout.addRow("Registros simultaneos: ", self.concurrentSpinBox)
+
+        # Reaproveitar registros ja calculados
+        self.transformCacheCheckBox = qt.QCheckBox()
+        self.transformCacheCheckBox.checked = True
+        self.transformCacheCheckBox.setToolTip( "Reutiliza transformacoes salvas quando os volumes e parametros nao mudaram" )
+        parametersFormLayout.addRow("Cache de registro: ", self.transformCacheCheckBox)
+
+        # Pre-alinhamento por correlacao de fase
+        self.preAlignCheckBox = qt.QCheckBox()
+        self.preAlignCheckBox.checked = True
+        self.preAlignCheckBox.setToolTip( "Estima a translacao entre os exames por FFT em volumes reduzidos e a usa como transformacao inicial do BRAINSFit" )
+        parametersFormLayout.addRow("Pre-alinhamento (FFT): ", self.preAlignCheckBox)
+
+        # Registrar apenas a vizinhanca da ROI
+        self.localRegistrationCheckBox = qt.QCheckBox()
+        self.localRegistrationCheckBox.checked = False
+        self.localRegistrationCheckBox.setToolTip( "Registra e reamostra apenas a ROI com a margem abaixo, em vez da cabeca inteira (volumes Reg menores)" )
+        parametersFormLayout.addRow("Registro local (ROI): ", self.localRegistrationCheckBox)
+
+        self.registrationMarginSpinBox = qt.QDoubleSpinBox()
+        self.registrationMarginSpinBox.setMinimum(0.0)
+        self.registrationMarginSpinBox.setMaximum(100.0)
+        self.registrationMarginSpinBox.setSingleStep(5.0)
+        self.registrationMarginSpinBox.setSuffix(" mm")
+        self.registrationMarginSpinBox.setValue(TOFVolLogic.registrationMargin)
+        self.registrationMarginSpinBox.setToolTip( "Margem em volta da ROI usada no registro local" )
+        parametersFormLayout.addRow("Margem do registro: ", self.registrationMarginSpinBox)
+
+        # Normalizar apenas a regiao usada pelo crop
+        self.normalizeROICheckBox = qt.QCheckBox()
+        self.normalizeROICheckBox.checked = True
+        self.normalizeROICheckBox.setToolTip( "Normaliza apenas a regiao da ROI no volume registrado (o restante do volume Reg nao e' normalizado)" )
+        parametersFormLayout.addRow("Normalizar apenas a ROI: ", self.normalizeROICheckBox)
+
+        # Processar apenas volumes novos
+        self.incrementalCheckBox = qt.QCheckBox()
+        self.incrementalCheckBox.checked = True
+        self.incrementalCheckBox.setToolTip( "Continua a Export Table da execucao anterior (mesmo volume base e ROI), processando apenas os volumes ainda sem resultado" )
+        parametersFormLayout.addRow("Apenas volumes novos: ", self.incrementalCheckBox)
+
+        # Mascaras compactadas
+        self.compactLabelsCheckBox = qt.QCheckBox()
+        self.compactLabelsCheckBox.checked = TOFVolLogic.compactLabels
+        self.compactLabelsCheckBox.setToolTip( "Guarda as segmentacoes compactadas na Export Table; o label map de um exame so' e' criado quando for exibido" )
+        parametersFormLayout.addRow("Labels compactos: ", self.compactLabelsCheckBox)
+
+        # Decimacao dos modelos 3D
+        self.decimationSpinBox = qt.QDoubleSpinBox()
+        self.decimationSpinBox.setMinimum(0.0)
+        self.decimationSpinBox.setMaximum(0.95)
+        self.decimationSpinBox.setSingleStep(0.05)
+        self.decimationSpinBox.setValue(TOFVolLogic.modelDecimation)
+        self.decimationSpinBox.setToolTip( "Fracao de triangulos removidos dos modelos 3D (0 = sem decimacao)" )
+        parametersFormLayout.addRow("Decimacao dos modelos: ", self.decimationSpinBox)
+
+        # ROI automatica a partir do fiducial
+        self.automaticROICheckBox = qt.QCheckBox()
+        self.automaticROICheckBox.checked = TOFVolLogic.automaticROI
+        self.automaticROICheckBox.setToolTip( "Cria a menor ROI em volta da estrutura brilhante conectada ao fiducial no volume base, em vez da caixa fixa" )
+        parametersFormLayout.addRow("ROI automatica: ", self.automaticROICheckBox)
+
+        self.roiSearchRadiusSpinBox = qt.QDoubleSpinBox()
+        self.roiSearchRadiusSpinBox.setMinimum(5.0)
+        self.roiSearchRadiusSpinBox.setMaximum(100.0)
+        self.roiSearchRadiusSpinBox.setSingleStep(5.0)
+        self.roiSearchRadiusSpinBox.setSuffix(" mm")
+        self.roiSearchRadiusSpinBox.setValue(TOFVolLogic.roiSearchRadius)
+        self.roiSearchRadiusSpinBox.setToolTip( "Distancia maxima do fiducial ate' onde a ROI automatica cresce" )
+        parametersFormLayout.addRow("Raio de busca da ROI: ", self.roiSearchRadiusSpinBox)
+
         # Buttons
         self.setROIButton = qt.QPushButton("Criar ROI")
         self.setROIButton.toolTip = ""
@@ -68,6 +157,11 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
         self.applyButton.enabled = False
         parametersFormLayout.addRow(self.applyButton)
 
+        self.cancelButton = qt.QPushButton("Cancelar")
+        self.cancelButton.toolTip = "Interrompe a execucao ao fim da etapa atual."
+        self.cancelButton.setVisible(False)
+        parametersFormLayout.addRow(self.cancelButton)
+
         # Progress Bar
         self.progressBar = qt.QProgressBar()
         self.progressBar.setMinimum(0)
@@ -77,9 +171,11 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
 
         # Add vertical spacer
         self.layout.addStretch(1)
+        self.logic = None
 
         # connections
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
         self.setROIButton.connect('clicked(bool)', self.createROI)
         self.fiducialSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.baseSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.setBackground)
@@ -98,6 +194,22 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
         for node in slicer.util.getNodesByClass('vtkMRMLAnnotationROINode'):
             self.setROIButton.enabled = False
 
+    def inputWidgets(self):
+        "Widgets dos parametros travados durante a execucao (todos menos Cancelar e a barra de progresso)"
+        return [child for child in self.parametersCollapsibleButton.children()
+            if isinstance(child, qt.QWidget) and child not in (self.cancelButton, self.progressBar)]
+
+    def onCancelButton(self):
+        if self.logic:
+            self.cancelButton.setEnabled(False)
+            self.logic.progress.cancel()
+
+    def onProgress(self, done, total, text):
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+        if text:
+            self.progressBar.setFormat(text + ' (%v/%m)')
+
     def setBackground(self):
         for color in ['Red', 'Yellow', 'Green']:
             slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(self.baseSelector.currentNode().GetID())
@@ -128,34 +240,17 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
         # Verificar se ha apenas um fiducial
         fiducialNode = self.fiducialSelector.currentNode()
         numFiducials = fiducialNode.GetNumberOfFiducials()
-        if numFiducials > 1:
+        if numFiducials < 1:
             slicer.util.messageBox("Nao ha' fiducial definido para criar a ROI.")
             return
         if numFiducials > 1:
             slicer.util.messageBox("Encontrado mais de 1 fiducial.\nSo' pode haver um.")
             return
 
-        # Localizando o Fiducial e criando a ROI
-        L = 50.0
-        P = 35.0
-        A = 12.5
-
-        ras = [0.0, 0.0, 0.0]
-        pos = [0.0, 0.0, 0.0]
-        fiducialNode.GetNthFiducialPosition(0, ras)
-
-        pos[0] = ras[0] - 10
-        pos[1] = ras[1] - 25
-        pos[2] = ras[2] + 7.5
-
-        min=0; max=0; minvalue=0
-
-        ROI = slicer.vtkMRMLAnnotationROINode()
-        ROI.SetName('RoiNode')
-        slicer.mrmlScene.AddNode(ROI)
-        ROI.SetXYZ(pos)
-        ROI.SetRadiusXYZ(L, P, A)
-        ROI.SetDisplayVisibility(True)
+        logic = TOFVolLogic()
+        logic.automaticROI = self.automaticROICheckBox.checked
+        logic.roiSearchRadius = self.roiSearchRadiusSpinBox.value
+        ROI = logic.createROI(fiducialNode, self.baseSelector.currentNode())
 
         self.setROIButton.enabled = False
 
@@ -167,31 +262,21 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
         self.applyButton.setText("Aguarde...")
         self.applyButton.setEnabled(False)
         self.progressBar.setVisible(True)
+        try:
+            self.apply()
+        finally:
+            # Tambem depois de uma excecao
+            self.logic = None
+            self.applyButton.setText("Iniciar")
+            self.applyButton.setEnabled(True)
+            self.progressBar.setVisible(False)
+            self.cancelButton.setVisible(False)
+
+    def apply(self):
+        "Cria a ROI se preciso, executa a logica e exibe o resultado"
         inputVolume = self.baseSelector.currentNode()
-        cropLogic = slicer.modules.cropvolume.logic()
-        volumesLogic = slicer.modules.volumes.logic()
-        label=1
-        perc=0.75
         hasROI = False
 
-        logging.info('Processing started')
-
-        # Criar tabela para os dados
-        logging.info('Criando a tabela')
-        table = slicer.vtkMRMLTableNode()
-        tableWasModified = table.StartModify()
-        table.SetName("Export Table")
-        table.SetUseColumnNameAsColumnHeader(True)
-        col = table.AddColumn(); col.SetName("Volume")
-        col = table.AddColumn(); col.SetName("Qtde")
-        col = table.AddColumn(); col.SetName("Min-Max")
-        col = table.AddColumn(); col.SetName("Range")
-
-        # Hierarquia para modelos 3D
-        modelHNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelHierarchyNode')
-        modelHNode.SetName('Models')
-        modelHNode = slicer.mrmlScene.AddNode(modelHNode)
-
         # Atualiza tela
         slicer.app.processEvents()
 
@@ -203,165 +288,470 @@ class TOFVolWidget(ScriptedLoadableModuleWidget):
 
         if not hasROI:
             ROI = self.createROI()
+        if not ROI:
+            return
+
+        logic = TOFVolLogic()
+        logic.modelDecimation = self.decimationSpinBox.value
+        logic.registrationMargin = self.registrationMarginSpinBox.value
+        logic.compactLabels = self.compactLabelsCheckBox.checked
+        logic.progress.callback = self.onProgress
+        self.logic = logic
+        self.progressBar.setMaximum(0)
+        self.cancelButton.setEnabled(True)
+        self.cancelButton.setVisible(True)
+        with InterfaceLock(self.inputWidgets(), logic.progress):
+            table = logic.run(inputVolume, ROI, self.concurrentSpinBox.value, self.transformCacheCheckBox.checked,
+                self.normalizeROICheckBox.checked, self.incrementalCheckBox.checked, self.preAlignCheckBox.checked,
+                self.localRegistrationCheckBox.checked)
+        self.logic = None
+        self.cancelButton.setVisible(False)
+        if not table:
+            return
 
-        # Calculando media do volume inicial
-        logging.info('Calcular media volume inicial: ' + inputVolume.GetName())
-        arrayInputVolume = slicer.util.array(inputVolume.GetName())
-        meanInputVolume = arrayInputVolume.mean()
-
-        # Realizar o crop no primeiro volume
-        logging.info('Crop do volume inicial')
-        outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + ' cropped')
-        cropLogic.CropInterpolated(ROI, inputVolume, outputVolume, False, 1.0, 2, 0)
-
-        # Calculo dos pontos mais intensos do primeiro volume
-        logging.info("Calculando pontos mais intensos do volume inicial")
-        arrayNode = slicer.util.array(outputVolume.GetName())
-        min = arrayNode.min()
-        max = arrayNode.max()
-        minValue = max - ((max-min)*perc)
-        arrayValue = arrayNode[arrayNode>=minValue]
-        meanValue = arrayValue.mean()
-        countValue = len(arrayValue)
+        # Exibir o resultado
+        with logic.profiler.stage('exibir resultado'):
+            logging.info('Exibir resultado')
+            # Com labels compactos apenas o label map do volume base e' criado
+            baseLabelMap = logic.baseLabelMap(table, inputVolume)
+            for color in ['Red', 'Yellow', 'Green']:
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(inputVolume.GetID())
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(
+                    baseLabelMap.GetID() if baseLabelMap else None)
+
+            # Exibir a tabela
+            logging.info('Exibir tabela')
+            slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
+            slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(table.GetID())
+            slicer.app.applicationLogic().PropagateTableSelection()
+        logic.profiler.publish()
 
         # Atualiza tela
         slicer.app.processEvents()
 
-        #segmentando o primeiro volume
-        logging.info('Segmentando volume inicial')
-        labelMap = volumesLogic.CreateAndAddLabelVolume(slicer.mrmlScene, outputVolume, outputVolume.GetName() + '-label' )
-        labelArray = slicer.util.array(labelMap.GetName())
-        labelArray[arrayNode>minValue] = label
-        labelMap.GetImageData().Modified()
-        inputLabelMap = labelMap
+# TOFVolLogic
+class TOFVolLogic(ScriptedLoadableModuleLogic):
+    # Colunas da "Export Table"
+    tableColumns = ["Volume", "Qtde", "Min-Max", "Range"]
+    # Modelos 3D: iteracoes de suavizacao e fracao de triangulos removidos (0 = sem decimacao)
+    modelSmoothing = 10
+    modelDecimation = 0.25
+    # Registro local: margem em mm em volta da ROI
+    registrationMargin = 20.0
+    # Recorte sem copia quando a ROI esta alinhada com a grade do volume
+    zeroCopyCrop = True
+    # Mascaras guardadas compactadas na tabela (LabelStore) em vez de um label map por exame
+    compactLabels = True
+    # ROI automatica: crescimento a partir do fiducial sobre os voxels brilhantes do volume base
+    # (limiar max - (max-min)*roiPerc na regiao de busca), com margem de roiPadding mm
+    automaticROI = False
+    roiSearchRadius = 25.0
+    roiSeedRadius = 3.0
+    roiPerc = 0.5
+    roiPadding = 5.0
+
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        # Label maps criados na ultima execucao, o primeiro e' o do volume base
+        self.labelMaps = []
+        # Mascaras compactadas da ultima execucao (com compactLabels)
+        self.labelStore = None
+        # VolumeStore opcional: volumes registrados passam a usar arquivos em memmap
+        self.volumeStore = None
+        # Tempo e memoria por etapa da ultima execucao
+        self.profiler = Profiler('TOFVol')
+        # Progresso e cancelamento; as contas do NumPy rodam na thread do worker
+        self.progress = Progress()
+        self.worker = Worker()
+
+    def createROI(self, fiducialNode, volumeNode=None):
+        """Cria a ROI a partir do primeiro fiducial.
+
+        Com automaticROI e o volume base a ROI e' a caixa justa em volta da
+        estrutura conectada ao fiducial (ROIUtils.tightROIBox); se ela nao
+        for encontrada, usa a caixa fixa.
+        """
+        # Localizando o Fiducial e criando a ROI
+        L = 50.0
+        P = 35.0
+        A = 12.5
 
-        # Apagando o volume cropped
-        slicer.mrmlScene.RemoveNode(outputVolume)
+        ras = [0.0, 0.0, 0.0]
+        pos = [0.0, 0.0, 0.0]
+        fiducialNode.GetNthFiducialPosition(0, ras)
 
-        # Criar modelo 3D
-        logging.info('Criar modelo 3D do volume inicial')
-        parameters = {}
-        parameters["InputVolume"] = labelMap.GetID()
-        parameters["Name"] = labelMap.GetName() + '-model'
-        parameters['ModelSceneFile'] = modelHNode.GetID()
-        modelMaker = slicer.modules.modelmaker
-        slicer.cli.run(modelMaker, None, parameters, True)
+        pos[0] = ras[0] - 10
+        pos[1] = ras[1] - 25
+        pos[2] = ras[2] + 7.5
+        radius = [L, P, A]
 
-        # Atualiza tela
-        slicer.app.processEvents()
+        if self.automaticROI and volumeNode:
+            with self.profiler.stage('ROI automatica', volumeNode.GetName()):
+                box = ROIUtils.tightROIBox(volumeNode, ras, self.roiSearchRadius, self.roiPerc, self.roiSeedRadius, self.roiPadding)
+            if box:
+                pos, radius = box
+                logging.info('ROI automatica: raios %.1f x %.1f x %.1f mm' % tuple(radius))
+            else:
+                logging.warning('ROI automatica nao encontrada, usando a caixa fixa')
 
-        # Popular tabela com os dados do primeiro volume
-        logging.info('Popular tabela')
-        rowIndex = table.AddEmptyRow()
-        table.SetCellText(rowIndex, 0, inputVolume.GetName())
-        table.SetCellText(rowIndex, 1, str(countValue))
-        table.SetCellText(rowIndex, 2, str(int(min)) + " - " + str(int(max)))
-        table.SetCellText(rowIndex, 3, str(int(minValue)) + " - " + str(int(max)))
+        ROI = slicer.vtkMRMLAnnotationROINode()
+        ROI.SetName('RoiNode')
+        slicer.mrmlScene.AddNode(ROI)
+        ROI.SetXYZ(pos)
+        ROI.SetRadiusXYZ(radius)
+        ROI.SetDisplayVisibility(True)
 
-        # Atualiza tela
-        slicer.app.processEvents()
+        return ROI
 
-        # Identificar todos os volumes e processar
-        for node in slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode'):
-            logging.info('\nProcessando ' + node.GetName())
-            if node.GetName() == inputVolume.GetName():
-                logging.info('Ignorando volume: ' + node.GetName())
+    def tableRows(self, table):
+        "Linhas da tabela como listas de texto, na ordem de tableColumns"
+        return [[table.GetCellText(row, column) for column in range(len(self.tableColumns))]
+            for row in range(table.GetNumberOfRows())]
+
+    def findTable(self, inputVolume, ROI):
+        "Export Table de uma execucao anterior com o mesmo volume base e ROI, ou None"
+        for table in slicer.util.getNodesByClass('vtkMRMLTableNode'):
+            if (table.GetAttribute('TOFVol.BaseVolumeID') == inputVolume.GetID() and
+                    table.GetAttribute('TOFVol.ROIID') == ROI.GetID() and
+                    slicer.mrmlScene.GetNodeByID(table.GetAttribute('TOFVol.ModelsID') or '')):
+                return table
+        return None
+
+    def resultLabelMaps(self, table):
+        """Label maps ja calculados para a tabela: {ID do volume de origem: label map}
+
+        Label maps cujo exame foi apagado da cena sao ignorados (a linha do
+        exame continua na tabela).
+        """
+        labelMaps = {}
+        for labelMap in slicer.util.getNodesByClass('vtkMRMLLabelMapVolumeNode'):
+            if labelMap.GetAttribute('TOFVol.TableID') != table.GetID():
                 continue
-            if node.GetClassName() == "vtkMRMLLabelMapVolumeNode":
-                logging.info('Ignorando label: ' + node.GetName())
+            sourceVolume = sceneIndex().source(labelMap)
+            if not sourceVolume:
+                logging.info('Ignorando label map sem exame de origem: ' + labelMap.GetName())
                 continue
+            labelMaps[sourceVolume.GetID()] = labelMap
+        return labelMaps
+
+    def baseLabelMap(self, table, inputVolume):
+        """Label map do volume base para exibir, ou None.
+
+        Numa tabela continuada o volume base pode ter sido segmentado com a
+        outra opcao de labels compactos: procura o label map ja existente e
+        depois a mascara guardada na tabela.
+        """
+        labelMap = self.resultLabelMaps(table).get(inputVolume.GetID())
+        if labelMap:
+            return labelMap
+        return LabelStore(table).materialize(inputVolume.GetID())
+
+    def markLabelMap(self, labelMap, sourceVolume, table, rowIndex):
+        "Registra no label map (se houver) de qual volume e linha da tabela ele e' o resultado"
+        if labelMap:
+            sceneIndex().link(sourceVolume, labelMap, 'labelMap')
+            labelMap.SetAttribute('TOFVol.TableID', table.GetID())
+        table.SetAttribute('TOFVol.Row.' + sourceVolume.GetID(), str(rowIndex))
+
+    def run(self, inputVolume, ROI, maxConcurrentRegistrations=None, useTransformCache=True, normalizeROIOnly=True, incremental=False, preAlign=True,
+        localRegistration=False):
+        """Calcula o volume dos pontos mais intensos na ROI para todos os volumes da cena. Retorna a tabela.
+
+        Com incremental=True e uma execucao anterior para o mesmo volume base e
+        ROI, reaproveita a tabela, a hierarquia Models e os label maps dela e
+        processa apenas os volumes ainda sem resultado, acrescentando linhas.
+
+        Com localRegistration=True o registro usa apenas um recorte do volume
+        base em volta da ROI (registrationMargin mm) e os volumes Reg tem a
+        grade desse recorte. O fator de normalizacao continua sendo o do
+        registro completo: a media do volume movel reamostrado na grade
+        inteira do volume base (ROIUtils.resampledMean).
+
+        Cancelada (progress.cancel()), termina o exame em andamento, mantem na
+        tabela os que ja terminaram e retorna None.
+        """
+        self.progress.reset()
+        statisticsCache().runner = self.worker.call
+        try:
+            return self.process(inputVolume, ROI, maxConcurrentRegistrations, useTransformCache, normalizeROIOnly, incremental,
+                preAlign, localRegistration)
+        except Cancelled:
+            logging.info('Processamento cancelado')
+            self.profiler.publish()
+            return None
+        finally:
+            statisticsCache().runner = None
+            self.worker.close()
+
+    def process(self, inputVolume, ROI, maxConcurrentRegistrations, useTransformCache, normalizeROIOnly, incremental, preAlign,
+        localRegistration):
+        "Etapas de run(); o progresso e' informado por etapa e exame"
+        label=1
+        perc=0.75
+        self.labelMaps = []
+        self.labelStore = None
+        self.profiler.reset()
 
-            # Executar BrainsFit para corresgistro dos exames mais novos com o mais antigo
-            logging.info('Registrando o volume')
-            fixedVolume = inputVolume
-            movingVolume = node
-            registeredVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", node.GetName() + ' Reg')
-            brainsfitParameters = {'fixedVolume': fixedVolume.GetID(), 'movingVolume': movingVolume.GetID(), 'outputVolume': registeredVolume.GetID(), 'useRigid': True}
-            self.cliNode = slicer.cli.run(slicer.modules.brainsfit, None, brainsfitParameters)
-
-            while (self.cliNode.IsBusy()):
-                slicer.app.processEvents()
-
-            # Normalizar volumes
-            logging.info('Normalizando o volume')
-            arrayRegisteredVolume = slicer.util.array(registeredVolume.GetName())
-            meanRegisteredVolume = arrayRegisteredVolume.mean()
-            factor = meanRegisteredVolume / meanInputVolume
-            arrayRegisteredVolume[:] = arrayRegisteredVolume / factor
-            arrayRegisteredVolume[:] = numpy.around(arrayRegisteredVolume, 0)
-
-            # Crop Interpolated
-            logging.info('Crop do volume')
-            outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", registeredVolume.GetName() + ' cropped')
-            cropLogic.CropInterpolated(ROI, registeredVolume, outputVolume, False, 1.0, 2, 0)
-
-            # Calculo dos pontos mais intensos do volume corregistrado
-            print("Calculando")
-            arrayNode = slicer.util.array(outputVolume.GetName())
-            arrayNode[:] = numpy.around(arrayNode, 0)
-            min = arrayNode.min()
-            max = arrayNode.max()
-            minValue = max - ((max-min)*perc)
-            arrayValue = arrayNode[arrayNode>=minValue]
-            meanValue = arrayValue.mean()
-            countValue = len(arrayValue)
-
-            # Atualiza tela
-            slicer.app.processEvents()
-
-            #segmentando o volume
-            logging.info('Segmentando Volume')
-            label = label + 1
-            labelMap = volumesLogic.CreateAndAddLabelVolume(slicer.mrmlScene, outputVolume, outputVolume.GetName() + '-label' )
-            labelArray = slicer.util.array(labelMap.GetName())
-            labelArray[arrayNode>minValue] = label
-            labelMap.GetImageData().Modified()
-
-            # Apagando o volume cropped
-            slicer.mrmlScene.RemoveNode(outputVolume)
-
-            # Criar modelo 3D
-            logging.info('Criar Modelo 3D')
-            parameters = {}
-            parameters["InputVolume"] = labelMap.GetID()
-            parameters["Name"] = labelMap.GetName() + '-model'
-            parameters['ModelSceneFile'] = modelHNode.GetID()
-            modelMaker = slicer.modules.modelmaker
-            slicer.cli.run(modelMaker, None, parameters, True)
-
-            # Atualiza tela
-            slicer.app.processEvents()
+        logging.info('Processing started')
 
-            # Popular tabela com os dados
+        table = self.findTable(inputVolume, ROI) if incremental else None
+        self.progress.addSteps(1)
+        if table:
+            logging.info('Continuando a tabela ' + table.GetName())
+            tableWasModified = table.StartModify()
+            modelHNode = slicer.mrmlScene.GetNodeByID(table.GetAttribute('TOFVol.ModelsID'))
+            label = int(table.GetAttribute('TOFVol.LastLabel'))
+            self.labelStore = LabelStore(table) if self.compactLabels else None
+            processed = self.resultLabelMaps(table)
+            self.labelMaps = list(processed.values())
+            processed.update(dict.fromkeys(LabelStore(table).sourceIDs()))
+            surfaceBuilder = SurfaceBuilder(modelHNode, self.modelSmoothing, self.modelDecimation, profiler=self.profiler)
+            with self.profiler.stage('media', inputVolume.GetName()):
+                meanInputVolume = statisticsCache().mean(inputVolume)
+            self.progress.step('media')
+        else:
+            processed = {}
+
+            # Criar tabela para os dados
+            logging.info('Criando a tabela')
+            table = slicer.vtkMRMLTableNode()
+            tableWasModified = table.StartModify()
+            table.SetName("Export Table")
+            table.SetUseColumnNameAsColumnHeader(True)
+            for name in self.tableColumns:
+                col = table.AddColumn(); col.SetName(name)
+            self.labelStore = LabelStore(table) if self.compactLabels else None
+
+            # Hierarquia para modelos 3D
+            modelHNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelHierarchyNode')
+            modelHNode.SetName('Models')
+            modelHNode = slicer.mrmlScene.AddNode(modelHNode)
+            surfaceBuilder = SurfaceBuilder(modelHNode, self.modelSmoothing, self.modelDecimation, profiler=self.profiler)
+
+            # Calculando media do volume inicial
+            logging.info('Calcular media volume inicial: ' + inputVolume.GetName())
+            with self.profiler.stage('media', inputVolume.GetName()):
+                meanInputVolume = statisticsCache().mean(inputVolume)
+
+            # Crop, calculo dos pontos mais intensos e segmentacao do primeiro volume
+            logging.info("Calculando pontos mais intensos e segmentando o volume inicial")
+            labelMap, min, max, minValue, countValue, meanValue = self.segmentROI(ROI, inputVolume, perc, label, inputVolume.GetName(),
+                sourceVolume=inputVolume)
+            if labelMap:
+                self.labelMaps.append(labelMap)
+
+            # Criar modelo 3D (em segundo plano)
+            logging.info('Criar modelo 3D do volume inicial')
+            self.addModel(surfaceBuilder, labelMap, inputVolume, label, inputVolume.GetName() + ' cropped-label')
+
+            # Popular tabela com os dados do primeiro volume
             logging.info('Popular tabela')
             rowIndex = table.AddEmptyRow()
-            table.SetCellText(rowIndex, 0, node.GetName())
+            table.SetCellText(rowIndex, 0, inputVolume.GetName())
             table.SetCellText(rowIndex, 1, str(countValue))
             table.SetCellText(rowIndex, 2, str(int(min)) + " - " + str(int(max)))
             table.SetCellText(rowIndex, 3, str(int(minValue)) + " - " + str(int(max)))
-            rowIndex += 1
 
-        # Exibir o resultado
-        logging.info('Exibir resultado')
-        for color in ['Red', 'Yellow', 'Green']:
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(inputVolume.GetID())
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(inputLabelMap.GetID())
-
-        # Add table to the scene and show it
-        logging.info('Adicionar tabela e exibir')
-        slicer.mrmlScene.AddNode(table)
-        slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
-        slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(table.GetID())
-        slicer.app.applicationLogic().PropagateTableSelection()
-        table.EndModify(tableWasModified)
+            # Adicionar tabela a cena (o ID e' usado para marcar os resultados)
+            logging.info('Adicionar tabela')
+            slicer.mrmlScene.AddNode(table)
+            table.SetAttribute('TOFVol.BaseVolumeID', inputVolume.GetID())
+            table.SetAttribute('TOFVol.ROIID', ROI.GetID())
+            table.SetAttribute('TOFVol.ModelsID', modelHNode.GetID())
+            self.markLabelMap(labelMap, inputVolume, table, rowIndex)
+            self.progress.step('volume base')
+
+        # Identificar todos os volumes e agendar o registro
+        transformCache = TransformCache() if useTransformCache else None
+        scheduler = RegistrationScheduler(maxConcurrentRegistrations, transformCache, PreAligner() if preAlign else None, self.progress)
+        volumes = sceneIndex().scalarVolumes()
+        fixedVolume = inputVolume
+        if localRegistration:
+            with self.profiler.stage('recorte do registro', inputVolume.GetName()):
+                fixedVolume = self.registrationVolume(inputVolume, ROI)
+        for node in volumes:
+            logging.info('\nProcessando ' + node.GetName())
+            if node.GetID() == inputVolume.GetID():
+                logging.info('Ignorando volume: ' + node.GetName())
+                continue
+            if node.GetClassName() == "vtkMRMLLabelMapVolumeNode":
+                logging.info('Ignorando label: ' + node.GetName())
+                continue
+            if incremental and sceneIndex().source(node):
+                logging.info('Ignorando volume derivado: ' + node.GetName())
+                continue
+            if node.GetID() in processed:
+                logging.info('Ja processado: ' + node.GetName())
+                continue
 
-        # Atualiza tela
-        slicer.app.processEvents()
+            # A linha e o label sao reservados na ordem da cena, os registros terminam em qualquer ordem.
+            # Um volume cujo registro falhou antes reaproveita a sua linha.
+            label = label + 1
+            rowText = table.GetAttribute('TOFVol.Row.' + node.GetID())
+            if rowText is not None:
+                rowIndex = int(rowText)
+            else:
+                rowIndex = table.AddEmptyRow()
+                table.SetAttribute('TOFVol.Row.' + node.GetID(), str(rowIndex))
+            table.SetCellText(rowIndex, 0, node.GetName())
+
+            # Executar BrainsFit para corresgistro dos exames mais novos com o mais antigo
+            registeredVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", node.GetName() + ' Reg')
+            sceneIndex().link(node, registeredVolume, 'registered')
+            # Registro, normalizacao e segmentacao
+            self.progress.addSteps(3)
+            scheduler.addRegistration(fixedVolume, node, registeredVolume,
+                functools.partial(self.processRegistered, ROI=ROI, meanInputVolume=meanInputVolume, label=label, perc=perc,
+                    table=table, rowIndex=rowIndex, surfaceBuilder=surfaceBuilder, normalizeROIOnly=normalizeROIOnly,
+                    localRegistration=fixedVolume is not inputVolume),
+                preAlignVolume=inputVolume, keepTransform=fixedVolume is not inputVolume)
+        table.SetAttribute('TOFVol.LastLabel', str(label))
+
+        logging.info('Registrando os volumes')
+        self.progress.addSteps(1)
+        with self.profiler.stage('registros e processamento'):
+            scheduler.wait()
+        if fixedVolume is not inputVolume:
+            slicer.mrmlScene.RemoveNode(fixedVolume)
+
+        logging.info('Aguardando os modelos 3D')
+        with self.profiler.stage('aguardar modelos 3D'):
+            surfaceBuilder.wait()
+        self.progress.step('modelos 3D')
+
+        # Label maps na ordem das linhas da tabela
+        self.labelMaps.sort(key=lambda labelMap: int(table.GetAttribute('TOFVol.Row.' + sceneIndex().source(labelMap).GetID())))
+        table.EndModify(tableWasModified)
+        # Cancelada: os exames ja processados ficam na tabela (e podem ser continuados)
+        self.progress.check()
 
         logging.info('Processing completed')
+        self.profiler.publish()
+
+        return table
+
+    def registrationVolume(self, inputVolume, ROI):
+        "Recorte do volume base em volta da ROI usado como volume fixo no registro local"
+        bounds = ROIUtils.roiIJKBounds(ROI, inputVolume, padding=self.registrationMargin)
+        if not bounds:
+            logging.warning('ROI fora do volume base, registrando o volume inteiro')
+            return inputVolume
+        fixedVolume = ROIUtils.subVolume(inputVolume, bounds, inputVolume.GetName() + ' ROI')
+        sceneIndex().link(inputVolume, fixedVolume, 'registrationROI')
+        return fixedVolume
+
+    def segmentROI(self, ROI, volumeNode, perc, label, timepoint, roundValues=False, sourceVolume=None):
+        """Recorta volumeNode pela ROI e segmenta os pontos mais intensos.
+
+        Com a ROI alinhada com a grade do volume o recorte e' uma view do
+        array (ROIUtils.cropView), sem copia e sem no' temporario; senao usa o
+        CropInterpolated. Com labelStore a mascara do exame sourceVolume e'
+        guardada compactada na tabela e nenhum label map e' criado (None).
+        Retorna (label map, min, max, limiar, quantidade, media).
+        """
+        with self.profiler.stage('crop', timepoint):
+            view = ROIUtils.cropView(ROI, volumeNode) if self.zeroCopyCrop else None
+            if view is None:
+                outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", volumeNode.GetName() + ' cropped')
+                slicer.modules.cropvolume.logic().CropInterpolated(ROI, volumeNode, outputVolume, False, 1.0, 2, 0)
+
+        with self.profiler.stage('threshold/label', timepoint):
+            labelMap = None
+            if view is not None:
+                # Voxels do proprio volume: nada a arredondar (normalizeBlock ja arredonda)
+                arrayNode = view.array
+                ijkToRAS = view.ijkToRAS
+                transformNodeID = volumeNode.GetTransformNodeID()
+                if not self.labelStore:
+                    labelMap = view.createLabelVolume(volumeNode.GetName() + ' cropped-label')
+            else:
+                arrayNode = slicer.util.arrayFromVolume(outputVolume)
+                if roundValues:
+                    arrayNode[:] = numpy.around(arrayNode, 0)
+                ijkToRAS = vtk.vtkMatrix4x4()
+                outputVolume.GetIJKToRASMatrix(ijkToRAS)
+                transformNodeID = outputVolume.GetTransformNodeID()
+                if not self.labelStore:
+                    labelMap = slicer.modules.volumes.logic().CreateAndAddLabelVolume(slicer.mrmlScene, outputVolume, outputVolume.GetName() + '-label' )
+            if labelMap:
+                labelArray = slicer.util.arrayFromVolume(labelMap)
+                statistics = self.worker.call(Kernels.thresholdLabel, arrayNode, perc, labelArray, label)
+                labelMap.GetImageData().Modified()
+            else:
+                mask = numpy.zeros(arrayNode.shape, dtype=bool)
+                statistics = self.worker.call(Kernels.thresholdLabel, arrayNode, perc, mask, True)
+                self.labelStore.add(sourceVolume or volumeNode, mask, ijkToRAS, label, volumeNode.GetName() + ' cropped-label', transformNodeID)
 
-        self.applyButton.setText("Iniciar")
-        self.applyButton.setEnabled(True)
-        self.progressBar.setVisible(False)
+        # Apagando o volume cropped
+        if view is None:
+            slicer.mrmlScene.RemoveNode(outputVolume)
+        return (labelMap,) + tuple(statistics)
 
-        return
+    def addModel(self, surfaceBuilder, labelMap, sourceVolume, label, name):
+        "Agenda o modelo 3D do label map, ou da mascara guardada no labelStore"
+        if labelMap:
+            surfaceBuilder.addLabelMap(labelMap, label)
+            return
+        colorNode = slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeFileGenericAnatomyColors.txt')
+        sourceID = sourceVolume.GetID()
+        surfaceBuilder.addImage(self.labelStore.imageData(sourceID), self.labelStore.ijkToRAS(sourceID), label, name + '-model',
+            sourceVolume, colorNode)
+
+    def processRegistered(self, job, ROI, meanInputVolume, label, perc, table, rowIndex, surfaceBuilder, normalizeROIOnly=False,
+        localRegistration=False):
+        "Normaliza, recorta, segmenta e gera o modelo de um volume ja registrado"
+        if job.preAlignTime is not None:
+            self.profiler.record('pre-alinhamento', job.movingVolume.GetName(), job.preAlignTime)
+        self.profiler.record(job.stageName(), job.movingVolume.GetName(), job.elapsed())
+        self.progress.step('registro ' + job.movingVolume.GetName())
+        if not job.succeeded:
+            self.progress.step('', 2)
+            return
+        self.progress.check()
+        registeredVolume = job.outputVolume
+        timepoint = job.movingVolume.GetName()
+        if self.volumeStore:
+            with self.profiler.stage('memmap', timepoint):
+                self.volumeStore.store(registeredVolume)
+
+        # Normalizar volumes
+        logging.info('Normalizando o volume ' + registeredVolume.GetName())
+        with self.profiler.stage('normalizar', timepoint):
+            arrayRegisteredVolume = slicer.util.arrayFromVolume(registeredVolume)
+            if localRegistration and job.transformNode:
+                # O volume Reg cobre apenas a vizinhanca da ROI: a media e' a do volume movel
+                # reamostrado na grade inteira do volume base, a mesma do registro completo
+                meanRegisteredVolume = ROIUtils.resampledMean(job.movingVolume, job.preAlignVolume, job.transformNode)
+            elif localRegistration:
+                logging.warning('Transformacao do registro indisponivel, usando a media do volume movel')
+                meanRegisteredVolume = statisticsCache().mean(job.movingVolume)
+            else:
+                meanRegisteredVolume = statisticsCache().mean(registeredVolume)
+            factor = meanRegisteredVolume / meanInputVolume
+            bounds = None
+            if normalizeROIOnly:
+                # Apenas o sub-bloco lido pelo CropInterpolated
+                bounds = ROIUtils.roiIJKBounds(ROI, registeredVolume)
+            self.worker.call(Kernels.normalizeBlock, arrayRegisteredVolume, factor, bounds)
+            registeredVolume.GetImageData().Modified()
+        self.progress.step('normalizar ' + timepoint)
+        self.progress.check()
+
+        # Crop, calculo dos pontos mais intensos e segmentacao do volume corregistrado
+        logging.info('Calculando pontos mais intensos e segmentando o volume')
+        labelMap, min, max, minValue, countValue, meanValue = self.segmentROI(ROI, registeredVolume, perc, label, timepoint, True,
+            job.movingVolume)
+        self.markLabelMap(labelMap, job.movingVolume, table, rowIndex)
+        if labelMap:
+            self.labelMaps.append(labelMap)
+
+        # Criar modelo 3D (em segundo plano)
+        logging.info('Criar Modelo 3D')
+        self.addModel(surfaceBuilder, labelMap, job.movingVolume, label, registeredVolume.GetName() + ' cropped-label')
+
+        # Popular tabela com os dados
+        logging.info('Popular tabela')
+        table.SetCellText(rowIndex, 1, str(countValue))
+        table.SetCellText(rowIndex, 2, str(int(min)) + " - " + str(int(max)))
+        table.SetCellText(rowIndex, 3, str(int(minValue)) + " - " + str(int(max)))
+        self.progress.step('segmentar ' + timepoint)